@@ -1,9 +1,13 @@
 import csv
+import sys
 import pandas 
 import pathlib
 import numpy as np
 import pdb
 
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+from transition_log import load_transition_log
+
 ## metrics to get
 ## 2. number of actions to complete a stack/row 
 ## 3. error percentages (topple, incorrect ordering, time out)
@@ -19,16 +23,21 @@ def read_csv(path):
     return data 
 
 
+def read_log(transitions_dir, name):
+    """Read a transition log as a list of rows, from the binary transition log (or name.log.txt),
+    falling back to the name.log.csv files that are only written with --text_logs."""
+    log = load_transition_log(str(transitions_dir), name, ndmin=2)
+    if log is None:
+        return read_csv(transitions_dir.joinpath(name + ".log.csv"))
+    return log
+
+
 def get_correct_color_percentage(log_dir):
     ## 1. percentage of correct color pickups
     log_dir = log_dir.joinpath("transitions")
-    color_path = log_dir.joinpath("grasp-color-success.log.csv")
-    action_path = log_dir.joinpath("executed-action.log.csv")
-    grasp_path = log_dir.joinpath("grasp-success.log.csv")
-
-    color_data = read_csv(color_path)
-    action_data = read_csv(action_path)
-    grasp_data = read_csv(grasp_path)
+    color_data = read_log(log_dir, "grasp-color-success")
+    action_data = read_log(log_dir, "executed-action")
+    grasp_data = read_log(log_dir, "grasp-success")
     assert(len(color_data) == len(action_data) == len(grasp_data))
     total = 0
     n_successful = 0
@@ -44,12 +53,9 @@ def get_correct_color_percentage(log_dir):
 
 def get_number_actions_to_complete(log_dir):
     log_dir = log_dir.joinpath("transitions")
-    clearance_path = log_dir.joinpath("clearance.log.csv")
-    trial_num_path = log_dir.joinpath("trial.log.csv") 
-    trial_success_path = log_dir.joinpath("trial-success.log.csv")
-    clearance_data = read_csv(clearance_path)
-    trial_num_data = read_csv(trial_num_path)
-    trial_success_data = read_csv(trial_success_path)    
+    clearance_data = read_log(log_dir, "clearance")
+    trial_num_data = read_log(log_dir, "trial")
+    trial_success_data = read_log(log_dir, "trial-success")
 
 
     trial_lens = []
@@ -11,6 +11,7 @@ import matplotlib.patches as patches
 from IPython.display import clear_output
 from tqdm import tqdm 
 from skimage.util import random_noise
+from transition_log import load_transition_log
 
 def check_success(data, idx):
     return data[idx][0] == 1
@@ -60,9 +61,12 @@ class Pair:
 
     @classmethod
     def from_jsonline(cls, jsonline):
+        return cls.from_dict(json.loads(jsonline))
+
+    @classmethod
+    def from_dict(cls, data):
         image_keys = ["next_image", "prev_image"]
         numpy_keys = ["prev_state_image", "next_state_image", "prev_image_for_inference", "next_image_for_inference", "prev_location", "next_location"]
-        data = json.loads(jsonline)
         for k in image_keys + numpy_keys:
             if k not in data.keys():
                 data[k] = None 
@@ -126,6 +130,16 @@ class Pair:
             next_depth = cv2.resize(next_depth, (self.resolution,self.resolution), interpolation = cv2.INTER_AREA)
             self.next_image = np.concatenate([next_image, next_depth], axis=-1)
 
+        self.resize_state() 
+
+        # normalize location and width
+        self.w *= self.ratio
+        self.w = int(self.w)
+
+    def resize_state(self):
+        """
+        resize just the block state image and locations, for metrics that don't need the images 
+        """
         self.ratio = self.resolution / 224
 
         # don't double-resize
@@ -143,10 +157,6 @@ class Pair:
                 self.next_location = self.next_location.astype(float).copy() * self.ratio
                 self.next_location = self.next_location.astype(int)
 
-        # normalize location and width
-        self.w *= self.ratio
-        self.w = int(self.w)
-
 
     def get_mask(self, location):
         w, h, __ = self.prev_image.shape
@@ -637,24 +647,16 @@ def get_pairs(data_home, resolution = 224, w = 40, is_sim = False, is_row = True
     image_home = data_home.joinpath("data/color-heightmaps")
     if is_sim:
         json_home = data_home.joinpath("data/variables")
-    executed_action_path = data_home.joinpath("transitions/executed-action.log.txt")
-    place_successes_path = data_home.joinpath("transitions/place-success.log.txt")
-    grasp_successes_path = data_home.joinpath("transitions/grasp-success.log.txt")
-
-    if long_command:
-        clearance_path = data_home.joinpath("transitions/clearance.log.txt")
-        stack_height_path = data_home.joinpath("transitions/stack-height.log.txt")
-
+    transitions_directory = str(data_home.joinpath("transitions"))
 
-    kwargs = {'delimiter': ' ', 'ndmin': 2}
-    executed_action_data = np.loadtxt(executed_action_path, **kwargs)
-    place_succ_data = np.loadtxt(place_successes_path, **kwargs)
-    grasp_succ_data = np.loadtxt(grasp_successes_path, **kwargs)
+    executed_action_data = load_transition_log(transitions_directory, "executed-action", ndmin=2)
+    place_succ_data = load_transition_log(transitions_directory, "place-success", ndmin=2)
+    grasp_succ_data = load_transition_log(transitions_directory, "grasp-success", ndmin=2)
 
     if long_command:
         # elias: use json data to get final block order 
-        clearance_data = np.loadtxt(clearance_path, **kwargs).astype(int)
-        stack_height_data = np.loadtxt(stack_height_path, **kwargs).astype(int)
+        clearance_data = load_transition_log(transitions_directory, "clearance", ndmin=2).astype(int)
+        stack_height_data = load_transition_log(transitions_directory, "stack-height", ndmin=2).astype(int)
         color_sequences = {}
         trial_start = 0
         for i, trial_end in enumerate(clearance_data):
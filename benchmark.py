@@ -0,0 +1,1085 @@
+#!/usr/bin/env python
+""" Micro-benchmarks for performance sensitive code paths.
+
+    python benchmark.py trainer_forward --cpu
+    python benchmark.py replay --iterations 20000
+    python benchmark.py transition_log --iterations 2000
+    python benchmark.py heightmap
+    python benchmark.py infect_mask --trials 500
+    python benchmark.py language_mask
+    python benchmark.py attention --batch_size 16
+    python benchmark.py local_attention --batch_size 4
+    python benchmark.py validation_metrics --batch_size 64
+    python benchmark.py check_row --trials 100
+    python benchmark.py sim_state --round_trip_ms 1
+    python benchmark.py camera_capture --trials 100
+    python benchmark.py sim_workers --trials 400
+    python benchmark.py block_world --trials 200
+"""
+import argparse
+import time
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy import ndimage
+
+
+def time_it(fn, repeats):
+    """ Returns the mean wall clock time of fn() in milliseconds, after one warm up call.
+    """
+    fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeats):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeats * 1000
+
+
+def legacy_preprocess_heightmaps(color_heightmap, depth_heightmap):
+    """ The numpy preprocessing Trainer.forward() used before Trainer.preprocess_heightmaps(), kept for comparison.
+    """
+    color_heightmap_2x = ndimage.zoom(color_heightmap, zoom=[2,2,1], order=0)
+    depth_heightmap_2x = ndimage.zoom(depth_heightmap, zoom=[2,2,1], order=0)
+    diag_length = float(color_heightmap_2x.shape[0]) * np.sqrt(2)
+    diag_length = np.ceil(diag_length/32)*32
+    padding_width = int((diag_length - color_heightmap_2x.shape[0])/2)
+    color_heightmap_2x = np.concatenate([np.pad(color_heightmap_2x[:,:,c], padding_width, 'constant', constant_values=0)[:,:,None] for c in range(3)], axis=2)
+    depth_heightmap_2x = np.concatenate([np.pad(depth_heightmap_2x[:,:,c], padding_width, 'constant', constant_values=0)[:,:,None] for c in range(3)], axis=2)
+    image_mean = [0.485, 0.456, 0.406]
+    image_std = [0.229, 0.224, 0.225]
+    input_color_image = color_heightmap_2x.astype(float)/255
+    for c in range(3):
+        input_color_image[:,:,c] = (input_color_image[:,:,c] - image_mean[c])/image_std[c]
+    image_mean = [0.01, 0.01, 0.01]
+    image_std = [0.03, 0.03, 0.03]
+    input_depth_image = depth_heightmap_2x.astype(float)
+    for c in range(3):
+        input_depth_image[:,:,c] = (input_depth_image[:,:,c] - image_mean[c])/image_std[c]
+    input_color_image.shape = (input_color_image.shape[0], input_color_image.shape[1], input_color_image.shape[2], 1)
+    input_depth_image.shape = (input_depth_image.shape[0], input_depth_image.shape[1], input_depth_image.shape[2], 1)
+    input_color_data = torch.from_numpy(input_color_image.astype(np.float32)).permute(3,2,0,1)
+    input_depth_data = torch.from_numpy(input_depth_image.astype(np.float32)).permute(3,2,0,1)
+    return input_color_data, input_depth_data, padding_width, color_heightmap_2x.shape[0]
+
+
+def legacy_crop_predictions(output_prob, padding_width, padded_size, softmax=None):
+    """ The per-rotation crop and concatenate loop Trainer.forward() used before Trainer.crop_predictions(), kept for comparison.
+    """
+    start, end = int(padding_width/2), int(padded_size/2 - padding_width/2)
+    predictions = [None] * len(output_prob[0])
+    for rotate_idx in range(len(output_prob)):
+        for action_idx in range(len(output_prob[rotate_idx])):
+            prediction = output_prob[rotate_idx][action_idx]
+            if softmax is not None:
+                prediction = softmax(prediction, dim=1)
+            prediction = prediction.cpu().data.numpy()[:,0,start:end,start:end]
+            if rotate_idx == 0:
+                predictions[action_idx] = prediction
+            else:
+                predictions[action_idx] = np.concatenate((predictions[action_idx], prediction), axis=0)
+    return predictions
+
+
+def benchmark_trainer_forward(args):
+    """ Compare the Trainer.forward() heightmap preprocessing and prediction cropping with the old numpy path.
+    """
+    from trainer import Trainer
+    trainer = Trainer('reinforcement', push_rewards=True, future_reward_discount=0.65, is_testing=True, snapshot_file=None,
+                      force_cpu=args.cpu, place=True, network='densenet')
+    size = args.heightmap_pixels
+    color_heightmap = np.random.randint(0, 255, size=(size, size, 3)).astype(np.uint8)
+    depth_heightmap = np.random.uniform(0, 0.2, size=(size, size, 3))
+
+    legacy_color, legacy_depth, padding_width, padded_size = legacy_preprocess_heightmaps(color_heightmap, depth_heightmap)
+    input_color_data, input_depth_data, _ = trainer.preprocess_heightmaps(color_heightmap, depth_heightmap)
+    print('preprocess max abs difference: color ' + str((legacy_color - input_color_data.cpu()).abs().max().item()) +
+          ' depth ' + str((legacy_depth - input_depth_data.cpu()).abs().max().item()))
+
+    # random stand-in for the network output of every rotation
+    output_size = int(padded_size / 2)
+    output_prob = [[torch.rand(1, 1, output_size, output_size, device=trainer.device) for _ in range(3)] for _ in range(args.num_rotations)]
+    crop = slice(int(padding_width/2), int(padded_size/2 - padding_width/2))
+    legacy_predictions = legacy_crop_predictions(output_prob, padding_width, padded_size)
+    predictions = trainer.crop_predictions(output_prob, crop, 0)
+    assert all(np.array_equal(a, b) for a, b in zip(legacy_predictions, predictions))
+    # the reactive method applies a softmax over two channels before keeping channel 0
+    output_logits = [[torch.randn(1, 2, output_size, output_size, device=trainer.device) for _ in range(3)] for _ in range(args.num_rotations)]
+    legacy_predictions = legacy_crop_predictions(output_logits, padding_width, padded_size, F.softmax)
+    predictions = trainer.crop_predictions(output_logits, crop, 0, F.softmax)
+    assert all(np.allclose(a, b, atol=1e-6) for a, b in zip(legacy_predictions, predictions))
+
+    # the legacy path stopped at cpu tensors, include the device transfer to compare like for like
+    legacy_ms = time_it(lambda: [x.to(trainer.device) for x in legacy_preprocess_heightmaps(color_heightmap, depth_heightmap)[:2]], args.repeats)
+    new_ms = time_it(lambda: trainer.preprocess_heightmaps(color_heightmap, depth_heightmap), args.repeats)
+    print('preprocess ' + str(size) + 'x' + str(size) + ': legacy %.2f ms, vectorized %.2f ms, speedup %.1fx' % (legacy_ms, new_ms, legacy_ms / new_ms))
+    legacy_ms = time_it(lambda: legacy_crop_predictions(output_prob, padding_width, padded_size), args.repeats)
+    new_ms = time_it(lambda: trainer.crop_predictions(output_prob, crop, 0), args.repeats)
+    print('crop ' + str(args.num_rotations) + ' rotations: legacy %.2f ms, vectorized %.2f ms, speedup %.1fx' % (legacy_ms, new_ms, legacy_ms / new_ms))
+    legacy_ms = time_it(lambda: legacy_crop_predictions(output_logits, padding_width, padded_size, F.softmax), args.repeats)
+    new_ms = time_it(lambda: trainer.crop_predictions(output_logits, crop, 0, F.softmax), args.repeats)
+    print('crop and softmax ' + str(args.num_rotations) + ' rotations: legacy %.2f ms, vectorized %.2f ms, speedup %.1fx' % (legacy_ms, new_ms, legacy_ms / new_ms))
+
+
+def legacy_replay_sample(executed_action_log, success_log, predicted_value_log, label_value_log, log_len, action_id, success):
+    """ The argsort based sampling experience_replay() used before PrioritizedReplay, kept for comparison.
+    """
+    actions = np.asarray(executed_action_log)[1:log_len, 0]
+    sample_ind = np.argwhere(np.logical_and(np.asarray(success_log)[1:log_len, 0] == success, actions == action_id))
+    sample_surprise_values = np.abs(np.asarray(predicted_value_log)[sample_ind[:, 0]] - np.asarray(label_value_log)[sample_ind[:, 0]])
+    sorted_sample_ind = sample_ind[np.argsort(sample_surprise_values[:, 0]), 0]
+    return sorted_sample_ind[int(np.round(np.random.power(2, 1)[0] * (sample_ind.size - 1)))]
+
+
+def benchmark_replay(args):
+    """ Compare experience replay sampling from PrioritizedReplay with the old argsort over the whole history.
+
+    With the same surprise values and random seed, 'rank' mode must draw the same iterations as the old argsort,
+    also after update(). 'proportional' mode has no old equivalent, so its sample frequencies on a small history
+    are compared with the (surprise + epsilon) ** alpha probabilities instead.
+    """
+    from replay import PrioritizedReplay
+    n = args.iterations
+    executed_action_log = [[1, 0, 0, 0]] * n
+    grasp_success_log = np.random.randint(0, 2, size=(n, 1)).tolist()
+    predicted_value_log = np.random.uniform(size=(n, 1)).tolist()
+    label_value_log = np.random.uniform(size=(n, 1)).tolist()
+    for mode in ['rank', 'proportional']:
+        replay = PrioritizedReplay(mode)
+        start = time.time()
+        for j in range(n - 1):
+            replay.add(j, (1, grasp_success_log[j + 1][0]), abs(predicted_value_log[j][0] - label_value_log[j][0]), include_in_all=j >= 1)
+        print(mode + ' build %d iterations: %.2f ms' % (n, (time.time() - start) * 1000))
+        new_ms = time_it(lambda: replay.sample((1, 1)), args.repeats)
+        print(mode + ' sample: %.4f ms' % new_ms)
+        if mode == 'rank':
+            mismatches = 0
+            for trial in range(args.trials):
+                if trial == args.trials // 2:
+                    # change some surprise values like experience replay does after training on a sample
+                    for j in np.random.choice(n - 1, max(1, n // 10), replace=False):
+                        label_value_log[j] = [np.random.uniform()]
+                        replay.update(j, abs(predicted_value_log[j][0] - label_value_log[j][0]))
+                np.random.seed(trial)
+                legacy_iteration = legacy_replay_sample(executed_action_log, grasp_success_log, predicted_value_log, label_value_log, n, 1, 1)
+                np.random.seed(trial)
+                mismatches += int(replay.sample((1, 1))[0] != legacy_iteration)
+            print('rank sample: %d/%d draws differ from the legacy argsort with the same seed' % (mismatches, args.trials))
+            assert mismatches == 0, 'PrioritizedReplay rank sampling does not match the legacy argsort sampling'
+
+    # proportional sample frequencies on a small history
+    replay = PrioritizedReplay('proportional')
+    surprise = np.random.uniform(size=20)
+    for j, value in enumerate(surprise):
+        replay.add(j, (1, 1), value)
+    probability = (surprise + replay.epsilon) ** replay.alpha
+    probability /= probability.sum()
+    draws = 20000
+    counts = np.bincount([replay.sample((1, 1))[0] for _ in range(draws)], minlength=len(surprise))
+    distance = np.abs(counts / draws - probability).sum() / 2
+    print('proportional sample: total variation distance %.4f from the expected probabilities over %d draws' % (distance, draws))
+    assert distance < 0.03, 'PrioritizedReplay proportional sampling does not follow the surprise values'
+    legacy_ms = time_it(lambda: legacy_replay_sample(executed_action_log, grasp_success_log, predicted_value_log, label_value_log, n, 1, 1), args.repeats)
+    print('legacy argsort sample: %.4f ms' % legacy_ms)
+
+
+def write_fake_run(logger, iterations):
+    """ Log a random stacking run through logger.write_to_log() like main.py, rewriting every whole log each iteration.
+
+    Like experience replay in main.py, an earlier predicted-value row is replaced in place every iteration.
+    Returns the logs and the seconds each iteration took.
+    """
+    logs = {'executed-action': [], 'stack-height': [], 'grasp-success': [], 'place-success': [], 'trial-success': [], 'trial': [],
+            'clearance': [], 'predicted-value': []}
+    height, trial, successes = 1, 0, 0
+    iteration_seconds = []
+    for i in range(iterations):
+        start = time.time()
+        action = 1 if i % 2 == 0 else 2
+        grasp_success = int(np.random.random() < 0.7)
+        if action == 2:
+            height = height + 1 if np.random.random() < 0.6 else 1
+        logs['executed-action'].append([action, np.random.randint(16), np.random.randint(224), np.random.randint(224)])
+        logs['stack-height'].append([height])
+        logs['grasp-success'].append([grasp_success])
+        logs['place-success'].append([int(action == 2 and height > 1)])
+        if height >= 4:
+            successes += 1
+            trial += 1
+            height = 1
+            logs['clearance'].append([i])
+        logs['trial-success'].append([successes])
+        logs['trial'].append([trial])
+        logs['predicted-value'].append([np.random.random()])
+        sample_iteration = np.random.randint(i + 1)
+        logs['predicted-value'][sample_iteration] = [np.random.random()]
+        logger.mark_log_row_changed('predicted-value', sample_iteration)
+        for name, log in logs.items():
+            if len(log):
+                logger.write_to_log(name, log)
+        iteration_seconds.append(time.time() - start)
+    return logs, np.array(iteration_seconds)
+
+
+def benchmark_transition_log(args):
+    """ Log a run through Logger.write_to_log() like main.py, then check that it reads back and that plot.plot_it() can plot it.
+    """
+    import io
+    import os
+    import shutil
+    import tempfile
+    import contextlib
+    import matplotlib
+    matplotlib.use('Agg')
+    import plot
+    from logger import Logger
+    from transition_log import load_transition_log
+    directory = tempfile.mkdtemp()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            logger = Logger(False, directory, dir_name='run')
+        logs, iteration_seconds = write_fake_run(logger, args.iterations)
+        mismatches = sum(int(not np.array_equal(load_transition_log(logger.transitions_directory, name, ndmin=2), np.asarray(log, dtype=float)))
+                         for name, log in logs.items())
+        # write_to_log() only appends the new rows, so later iterations should not be slower than the first ones
+        tenth = max(1, args.iterations // 10)
+        print('transition log %d iterations: %.3f ms per iteration to write %d logs (%.3f ms in the first tenth, %.3f ms in the last), '
+              '%d logs read back differently'
+              % (args.iterations, iteration_seconds.mean() * 1000, len(logs), iteration_seconds[:tenth].mean() * 1000,
+                 iteration_seconds[-tenth:].mean() * 1000, mismatches))
+        # plot_it() also saves the plot in the working directory
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                best_dict, current_dict = plot.plot_it(logger.base_directory, 'benchmark', window=min(200, args.iterations // 4), place=True)
+        finally:
+            os.chdir(cwd)
+        assert mismatches == 0, 'the transition log did not read back what was written'
+        assert 'trial_success_rate_current_value' in current_dict, 'plot_it() did not plot the trial success rate'
+        print('plot_it() trial success rate %.3f, grasp success rate %.3f'
+              % (current_dict['trial_success_rate_current_value'], current_dict['grasp_success_rate_current_value']))
+    finally:
+        shutil.rmtree(directory)
+
+
+def legacy_get_heightmap(color_img, depth_img, cam_intrinsics, cam_pose, workspace_limits, heightmap_resolution, median_filter_pixels=5, color_median_filter_pixels=5):
+    """ The sorting utils.get_heightmap() used before utils.HeightmapProjector, kept for comparison.
+    """
+    import utils
+    if median_filter_pixels > 0:
+        depth_img = ndimage.median_filter(depth_img, size=median_filter_pixels)
+    heightmap_size = np.round(((workspace_limits[1][1] - workspace_limits[1][0])/heightmap_resolution, (workspace_limits[0][1] - workspace_limits[0][0])/heightmap_resolution)).astype(int)
+    depth_heightmap = np.zeros(heightmap_size)
+    surface_pts, color_pts = utils.get_pointcloud(color_img, depth_img, cam_intrinsics)
+    surface_pts = np.transpose(np.dot(cam_pose[0:3,0:3],np.transpose(surface_pts)) + np.tile(cam_pose[0:3,3:],(1,surface_pts.shape[0])))
+    # a stable sort, so exact ties in z resolve the same way as the scatter-max
+    sort_z_ind = np.argsort(surface_pts[:,2], kind='stable')
+    surface_pts = surface_pts[sort_z_ind]
+    color_pts = color_pts[sort_z_ind]
+    heightmap_valid_ind = np.logical_and(np.logical_and(np.logical_and(np.logical_and(surface_pts[:,0] >= workspace_limits[0][0], surface_pts[:,0] < workspace_limits[0][1]), surface_pts[:,1] >= workspace_limits[1][0]), surface_pts[:,1] < workspace_limits[1][1]), surface_pts[:,2] < workspace_limits[2][1])
+    surface_pts = surface_pts[heightmap_valid_ind]
+    color_pts = color_pts[heightmap_valid_ind]
+    heightmap_pix_x = np.floor((surface_pts[:,0] - workspace_limits[0][0])/heightmap_resolution).astype(int)
+    heightmap_pix_y = np.floor((surface_pts[:,1] - workspace_limits[1][0])/heightmap_resolution).astype(int)
+    depth_heightmap[heightmap_pix_y,heightmap_pix_x] = surface_pts[:,2]
+    z_bottom = workspace_limits[2][0]
+    depth_heightmap = depth_heightmap - z_bottom
+    depth_heightmap[depth_heightmap < 0] = 0
+    if median_filter_pixels > 0:
+        depth_heightmap = ndimage.median_filter(depth_heightmap, size=median_filter_pixels)
+    depth_heightmap[depth_heightmap == -z_bottom] = np.nan
+    color_heightmap = []
+    for c in range(3):
+        color_heightmap_c = np.zeros((heightmap_size[0], heightmap_size[1], 1), dtype=np.uint8)
+        color_heightmap_c[heightmap_pix_y,heightmap_pix_x] = color_pts[:,[c]]
+        if color_median_filter_pixels > 0:
+            color_heightmap_c = ndimage.median_filter(color_heightmap_c, size=color_median_filter_pixels)
+        color_heightmap.append(color_heightmap_c)
+    return np.concatenate(color_heightmap, axis=2), depth_heightmap
+
+
+def benchmark_heightmap(args):
+    """ Compare utils.HeightmapProjector with the old sorting heightmap projection on a simulated camera view.
+    """
+    import utils
+    # the simulation camera intrinsics and a pose looking down at the simulation workspace
+    cam_intrinsics = np.asarray([[618.62, 0, 320], [0, 618.62, 240], [0, 0, 1]])
+    cam_pose = np.eye(4)
+    cam_pose[0:3, 0:3] = np.linalg.inv(utils.euler2rotm([-np.pi, -0.6, np.pi/2]))
+    cam_pose[0:3, 3] = [-1.0, 0.0, 0.5]
+    workspace_limits = np.asarray([[-0.724, -0.276], [-0.224, 0.224], [-0.0001, 0.5]])
+    heightmap_resolution = 0.448 / args.heightmap_pixels
+    depth_img = np.random.uniform(0.6, 0.9, size=(480, 640))
+    color_img = np.random.randint(0, 255, size=(480, 640, 3)).astype(np.uint8)
+
+    projector = utils.HeightmapProjector(cam_intrinsics, cam_pose, workspace_limits, heightmap_resolution)
+    legacy_color, legacy_depth = legacy_get_heightmap(color_img, depth_img, cam_intrinsics, cam_pose, workspace_limits, heightmap_resolution)
+    color_heightmap, depth_heightmap = projector.project(color_img, depth_img)
+    print('identical: color ' + str(np.array_equal(legacy_color, color_heightmap)) + ' depth ' + str(np.array_equal(legacy_depth, depth_heightmap, equal_nan=True)))
+    for filter_pixels in [5, 0]:
+        legacy_ms = time_it(lambda: legacy_get_heightmap(color_img, depth_img, cam_intrinsics, cam_pose, workspace_limits, heightmap_resolution, filter_pixels, filter_pixels), args.repeats)
+        new_ms = time_it(lambda: projector.project(color_img, depth_img, median_filter_pixels=filter_pixels, color_median_filter_pixels=filter_pixels), args.repeats)
+        print('heightmap median filter %d: legacy %.2f ms, projector %.2f ms, speedup %.1fx' % (filter_pixels, legacy_ms, new_ms, legacy_ms / new_ms))
+
+
+def legacy_infect_mask(language_mask, curr_mask, block_width = 16):
+    """ The python region growing utils.infect_mask() used before it was vectorized, kept for comparison.
+    """
+    # expand out from intersection: if any pixel of a block is yes under language mask, then whole block should be yes
+    curr_mask = 1 - curr_mask
+    intersection_mask = np.logical_and(curr_mask,  language_mask).astype(float)
+    # use inf as sentinel value
+    orig_intersection_mask = intersection_mask.copy()
+    intersection_mask *= 1000
+    # top-down, left to right across mask
+    language_mask = language_mask[0]
+    curr_mask = curr_mask[0]
+    intersection_mask = intersection_mask[0]
+    curr_mask[intersection_mask == 1000] = 1000
+
+    def get_neighbors(idxs):
+        neighbors = []
+        for (x,y) in idxs:
+            neighbors.append((x-1, y))
+            neighbors.append((x+1, y))
+            neighbors.append((x, y-1))
+            neighbors.append((x, y+1))
+            neighbors.append((x-1, y-1))
+            neighbors.append((x+1, y+1))
+            neighbors.append((x-1, y+1))
+            neighbors.append((x-1, y+1))
+        return neighbors
+
+    total_infected = 0
+    total_it = 0
+    max_it = block_width * 2
+    # for it in range(block_width * 2):
+    while total_infected < (2*block_width)**2 and total_it < max_it:
+        # get selected indices
+
+        curr_idxs = np.where(curr_mask == 1000)
+        curr_idxs = list(zip(curr_idxs[0], curr_idxs[1]))
+        total_infected = len(curr_idxs)
+        # look one pix in each direction
+        neighbors = get_neighbors(curr_idxs)
+        done = []
+        for x,y in neighbors:
+            try:
+                if curr_mask[x,y] == 1000:
+                    continue
+                if curr_mask[x,y] == 1:
+                    curr_mask[x,y] = 1000
+                else:
+                    # if you hit a zero, that's the border
+                    continue
+            except IndexError:
+                continue
+        total_it += 1
+
+    curr_mask[curr_mask < 1000] = 0
+    curr_mask[curr_mask == 1000] = 1
+    curr_mask = curr_mask.astype(bool).reshape(1, 224, 224)
+    curr_mask = np.tile(curr_mask, (16, 1, 1))
+    return 1 - curr_mask
+
+
+def random_block_masks(num_blocks, heightmap_pixels, num_rotations):
+    """ A curr_mask with num_blocks random square blocks unmasked, and a language mask of a few pixels around one block.
+    """
+    curr_mask = np.ones((heightmap_pixels, heightmap_pixels), dtype=bool)
+    language_mask = np.zeros((heightmap_pixels, heightmap_pixels), dtype=bool)
+    # keep the blocks off the top and left edge, where the legacy version wraps around to the other side
+    for i in range(num_blocks):
+        size = np.random.randint(14, 22)
+        x, y = np.random.randint(2, heightmap_pixels - size, size=2)
+        curr_mask[x:x + size, y:y + size] = False
+        if i == 0:
+            px, py = x + np.random.randint(0, size), y + np.random.randint(0, size)
+            language_mask[max(px - 2, 0):px + 2, max(py - 2, 0):py + 2] = True
+    curr_mask = np.tile(curr_mask, (num_rotations, 1, 1))
+    return np.broadcast_to(language_mask, curr_mask.shape), curr_mask
+
+
+def benchmark_infect_mask(args):
+    """ Check utils.infect_mask() against the legacy region growing on random block layouts and compare their speed.
+    """
+    import utils
+    mismatches = 0
+    for trial in range(args.trials):
+        language_mask, curr_mask = random_block_masks(np.random.randint(1, 9), 224, 16)
+        legacy = legacy_infect_mask(language_mask, curr_mask.copy())
+        mismatches += int(not np.array_equal(legacy, utils.infect_mask(language_mask, curr_mask.copy())))
+    print('infect_mask mismatches: %d of %d random layouts' % (mismatches, args.trials))
+    language_mask, curr_mask = random_block_masks(8, 224, 16)
+    legacy_ms = time_it(lambda: legacy_infect_mask(language_mask, curr_mask.copy()), args.repeats)
+    new_ms = time_it(lambda: utils.infect_mask(language_mask, curr_mask.copy()), args.repeats)
+    print('infect_mask: legacy %.2f ms, vectorized %.2f ms, speedup %.1fx' % (legacy_ms, new_ms, legacy_ms / new_ms))
+
+
+def legacy_language_masking(language_data, predictions, threshold, single_max, tile_size=4):
+    """ The numpy, cv2 and torch round trips utils.process_prediction_language_masking() used before
+    utils.language_action_masks(), without the plotting, kept for comparison.
+    """
+    import cv2
+    from scipy.special import softmax
+    from transformer import tiles_to_image
+    curr_mask = np.ma.getmask(predictions).copy()
+    language_data = tiles_to_image(language_data, tile_size=tile_size, output_type="per-patch")
+    language_data = softmax(language_data, axis=1)
+    language_mask = language_data[:,1,:,:]
+    language_mask = np.float32(language_mask).reshape(64,64, 1).copy()
+    new_w = curr_mask.shape[1]
+    if single_max:
+        language_mask = cv2.resize(language_mask, (new_w, new_w), interpolation=cv2.INTER_NEAREST)
+        language_mask *= 1 - curr_mask[0,:,:]
+        language_mask = torch.tensor(language_mask)
+        row_values, row_indices = torch.max(language_mask, axis=0)
+        col_values, col_idx = torch.max(row_values, dim=0)
+        row_idx = row_indices[col_idx]
+        threshold = None
+        language_mask *= 0
+        language_mask[row_idx, col_idx] = 1
+        language_mask[language_mask != 1] = 0
+        language_mask = language_mask.detach().cpu().numpy()
+    else:
+        language_mask = cv2.resize(language_mask, (new_w, new_w), interpolation=cv2.INTER_NEAREST)
+        language_mask[language_mask > threshold] = 1
+        language_mask[language_mask <= threshold] = 0
+    language_mask = cv2.resize(language_mask, (new_w, new_w), interpolation=cv2.INTER_NEAREST)
+    language_mask = np.broadcast_to(language_mask, predictions.shape, subok=True)
+    predictions.mask = legacy_infect_mask(language_mask.astype(bool), curr_mask.copy().astype(bool))
+    return predictions
+
+
+def benchmark_language_mask(args):
+    """ Check utils.common_sense_language_model_mask() against the legacy per action masking on random
+    transformer outputs and block layouts, and compare their speed.
+    """
+    import utils
+    device = torch.device('cpu' if args.cpu or not torch.cuda.is_available() else 'cuda')
+
+    def random_inputs():
+        language_mask, curr_mask = random_block_masks(np.random.randint(1, 9), 224, 16)
+        predictions = np.random.uniform(size=curr_mask.shape)
+        output = {'prev_position': torch.randn(1, 256, 2, 1, device=device) * 3,
+                  'next_position': torch.randn(1, 256, 2, 1, device=device) * 3}
+        return output, predictions, curr_mask
+
+    def legacy(output, predictions, curr_mask, check_row):
+        grasp = legacy_language_masking(output['prev_position'].cpu(), np.ma.masked_array(predictions, curr_mask), 0.1, True)
+        place = legacy_language_masking(output['next_position'].cpu(), np.ma.masked_array(predictions, curr_mask), 0.1, not check_row)
+        return grasp, place
+
+    def new(output, predictions, curr_mask, check_row):
+        return utils.common_sense_language_model_mask(output, predictions, np.ma.masked_array(predictions, curr_mask), np.ma.masked_array(predictions, curr_mask), check_row=check_row)[1:]
+
+    mismatches = 0
+    for trial in range(args.trials):
+        output, predictions, curr_mask = random_inputs()
+        check_row = trial % 2 == 1
+        for legacy_masked, new_masked in zip(legacy(output, predictions, curr_mask, check_row), new(output, predictions, curr_mask, check_row)):
+            mismatches += int(not np.array_equal(np.ma.getmaskarray(legacy_masked), np.ma.getmaskarray(new_masked)))
+    print('language mask mismatches: %d of %d masks' % (mismatches, 2 * args.trials))
+    output, predictions, curr_mask = random_inputs()
+    legacy_ms = time_it(lambda: legacy(output, predictions, curr_mask, False), args.repeats)
+    new_ms = time_it(lambda: new(output, predictions, curr_mask, False), args.repeats)
+    print('language mask on %s: legacy %.2f ms, batched %.2f ms, speedup %.1fx' % (device, legacy_ms, new_ms, legacy_ms / new_ms))
+
+
+def random_transformer_batch(batch_size, image_size, channels, max_len, vocab):
+    """ A TransformerEncoder batch of random images and random padded commands.
+    """
+    commands, lengths = [], []
+    for _ in range(batch_size):
+        length = np.random.randint(max_len // 2, max_len + 1)
+        commands.append(list(np.random.choice(sorted(vocab), length)) + ['<PAD>'] * (max_len - length))
+        lengths.append(length)
+    return {'command': commands, 'command_lengths': torch.tensor(lengths),
+            'prev_pos_input': torch.rand(batch_size, channels, image_size, image_size)}
+
+
+def saved_activation_bytes(fn):
+    """ Returns the bytes of the distinct tensors autograd saves for backward while running fn(), i.e. the training memory of the activations.
+    """
+    storages = {}
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return sum(storages.values())
+
+
+def benchmark_attention(args):
+    """ Compare the training memory and throughput of TransformerEncoder with the fused sdpa attention and the einsum attention.
+    """
+    from spacy.lang.en import English
+    from spacy.tokenizer import Tokenizer
+    from language_embedders import RandomEmbedder
+    from transformer import TransformerEncoder, SDPA_AVAILABLE
+    vocab = set('pick up the red blue green yellow block and put it on top of left right'.split())
+    batch = random_transformer_batch(args.batch_size, 64, 6, 60, vocab)
+    if not SDPA_AVAILABLE:
+        print('torch ' + torch.__version__ + ' has no F.scaled_dot_product_attention(scale=...), sdpa falls back to einsum')
+    encoders = {}
+    for attention_impl in ['einsum', 'sdpa']:
+        torch.manual_seed(12)
+        embedder = RandomEmbedder(Tokenizer(English().vocab), vocab, 64)
+        encoders[attention_impl] = TransformerEncoder(64, 4, embedder, 2, 2, channels=6, n_heads=8, hidden_dim=256, ff_dim=512,
+                                                      dropout=0.0, embed_dropout=0.0, output_type='per-patch', attention_impl=attention_impl)
+
+    outputs = {impl: encoder(batch)['next_position'] for impl, encoder in encoders.items()}
+    print('attention max abs difference: ' + str((outputs['einsum'] - outputs['sdpa']).abs().max().item()))
+
+    def train_step(encoder):
+        encoder.zero_grad()
+        output = encoder(batch)
+        (output['next_position'].sum() + output['prev_position'].sum()).backward()
+
+    for impl, encoder in encoders.items():
+        activation_mb = saved_activation_bytes(lambda: encoder(batch)['next_position'].sum()) / 2**20
+        step_ms = time_it(lambda: train_step(encoder), args.repeats)
+        print('%s attention, batch %d, %d tokens: %.1f MB saved activations, %.1f ms per training step, %.1f examples/s'
+              % (impl, args.batch_size, 64 // 4 * 64 // 4 + 1 + 60, activation_mb, step_ms, args.batch_size / step_ms * 1000))
+
+
+def benchmark_local_attention(args):
+    """ Compare local window attention with dense attention masked by the same local mask as the resolution grows.
+
+    Attention only uses local_window_attention() from transformer.LOCAL_WINDOW_MIN_GRID patches per side,
+    below that the dense masked attention saves fewer activations.
+    """
+    from transformer import Attention, local_attention_mask, LOCAL_WINDOW_MIN_GRID
+    torch.manual_seed(12)
+    attention = Attention(256, heads=8, attention_impl='einsum')
+    neighborhood, num_tokens = 5, 60
+    for resolution in [64, 128, 192]:
+        num_patches = (resolution // 4) ** 2
+        n = num_patches + 1 + num_tokens
+        x = torch.randn(args.batch_size, n, 256, requires_grad=True)
+        mask = torch.ones(args.batch_size, n, dtype=torch.bool)
+        mask[:, -num_tokens // 2:] = False
+        attn_mask = local_attention_mask(num_patches, n, neighborhood)
+
+        def local():
+            # always use local_window_attention(), even where Attention would pick the dense mask
+            attention.local_window_min_grid = 0
+            try:
+                return attention(x, mask, local_window=(num_patches, neighborhood))
+            finally:
+                attention.local_window_min_grid = LOCAL_WINDOW_MIN_GRID
+
+        dense = lambda: attention(x, mask, attn_mask=attn_mask)
+        difference = (dense() - local()).abs().max().item()
+        activation_mb = {}
+        for name, fn in [('dense masked', dense), ('local window', local)]:
+            activation_mb[name] = saved_activation_bytes(lambda: fn().sum()) / 2**20
+            step_ms = time_it(lambda: fn().sum().backward(), args.repeats)
+            print('resolution %d, %d patches, %s: %.1f MB saved activations, %.1f ms forward and backward'
+                  % (resolution, num_patches, name, activation_mb[name], step_ms))
+        chosen, other = ('local window', 'dense masked') if resolution // 4 >= LOCAL_WINDOW_MIN_GRID else ('dense masked', 'local window')
+        print('resolution %d max abs difference: %s, Attention uses %s, %.1f MB instead of %.1f MB'
+              % (resolution, difference, chosen, activation_mb[chosen], activation_mb[other]))
+
+
+def random_block_boards(batch_size, resolution, block_size, num_blocks=4):
+    """ prev_pos_for_acc and next_pos_for_acc style boards of block ids, where one random block moves between them.
+    """
+    prev = torch.zeros(batch_size, resolution, resolution, 1, 1)
+    blocks_to_move = torch.randint(1, num_blocks + 1, (batch_size, 1)).float()
+    for i in range(batch_size):
+        for block_id in range(1, num_blocks + 1):
+            row, col = np.random.randint(0, resolution - block_size, 2)
+            prev[i, row:row + block_size, col:col + block_size] = block_id
+    nxt = prev.clone()
+    for i in range(batch_size):
+        nxt[i][nxt[i] == blocks_to_move[i]] = 0
+        row, col = np.random.randint(0, resolution - block_size, 2)
+        nxt[i, row:row + block_size, col:col + block_size] = blocks_to_move[i]
+    return prev, nxt, blocks_to_move
+
+
+def benchmark_validation_metrics(args):
+    """ Check the batched F1 and teleportation metrics against the per-example ones and compare a validation batch of each.
+    """
+    from metrics import F1Metric, TransformerTeleportationMetric, sync_scores
+    device = torch.device('cpu' if args.cpu or not torch.cuda.is_available() else 'cuda')
+    resolution, patch_size, block_size = 64, 4, 4
+    f1_metric = F1Metric()
+    tele_metric = TransformerTeleportationMetric(block_size, resolution, patch_size)
+
+    def random_batch():
+        prev, nxt, blocks_to_move = random_block_boards(args.batch_size, resolution, block_size)
+        pred_prev = torch.randn(args.batch_size, 2, resolution, resolution, 1, device=device)
+        pred_next = torch.randn(args.batch_size, (resolution // patch_size) ** 2, 2, 1, device=device)
+        return prev, nxt, blocks_to_move, pred_prev, pred_next
+
+    def legacy(prev, nxt, blocks_to_move, pred_prev, pred_next):
+        scores = {'f1': f1_metric.compute_f1((prev != 0).float(), pred_prev)[2]}
+        tele_dicts = [tele_metric.get_metric(nxt[i].clone(), prev[i].clone(), pred_prev[i].clone(), pred_next[i].clone(), blocks_to_move[i].clone())
+                      for i in range(prev.shape[0])]
+        for key in ['distance', 'oracle_distance', 'block_acc']:
+            scores[key] = np.mean([tele_dict[key] for tele_dict in tele_dicts])
+        return scores
+
+    def batched(prev, nxt, blocks_to_move, pred_prev, pred_next):
+        tele_dict = tele_metric.get_batch_metric(nxt, prev, pred_prev, pred_next, blocks_to_move)
+        scores = {key: tele_dict[key].mean() for key in ['distance', 'oracle_distance', 'block_acc']}
+        scores['f1'] = f1_metric.compute_f1_tensors((prev != 0).float(), pred_prev)[2]
+        return scores
+
+    max_difference = 0.0
+    for trial in range(args.trials // 10):
+        batch = random_batch()
+        legacy_scores, batched_scores = legacy(*batch), sync_scores([batched(*batch)])[0]
+        max_difference = max([max_difference] + [abs(legacy_scores[k] - batched_scores[k]) for k in legacy_scores])
+    print('validation metrics max abs difference over %d batches: %s' % (args.trials // 10, max_difference))
+    batch = random_batch()
+    legacy_ms = time_it(lambda: legacy(*batch), args.repeats)
+    # the batched scores are only synced once per epoch, so time a whole epoch of batches and one sync
+    batched_ms = time_it(lambda: sync_scores([batched(*batch) for _ in range(args.repeats)]), 1) / args.repeats
+    print('validation metrics on %s, batch %d: per-example %.2f ms, batched %.2f ms per batch, speedup %.1fx'
+          % (device, args.batch_size, legacy_ms, batched_ms, legacy_ms / batched_ms))
+
+
+def legacy_check_row(pos, row_length, distance_threshold, separation_threshold, num_obj=None,
+                     color_names=None, object_color_sequence=None, sort_by_x=True):
+    """ The per permutation row search Robot.check_row() used before utils.find_row(), kept for comparison.
+    """
+    import itertools
+    import warnings
+    import utils
+    if num_obj is None:
+        num_obj = len(pos)
+    for block_indices in map(list, itertools.permutations(np.arange(num_obj), row_length)):
+        xs = pos[block_indices][:, 0]
+        ys = pos[block_indices][:, 1]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            m, b = np.polyfit(xs, ys, 1)
+        theta = np.arctan(m)
+        c = np.cos(theta)
+        s = np.sin(theta)
+        R = np.array([[c, s, 0], [-s, c, 0], [0, 0, 1]])
+        T = np.array([0, -b, 0])
+        aligned_pos = np.array([np.matmul(R, p + T) for p in pos[block_indices]])
+        aligned = True
+        median_z = np.median(aligned_pos[:, 2])
+        for p in aligned_pos:
+            if abs(p[1]) > distance_threshold or abs(p[2] - median_z) > distance_threshold:
+                aligned = False
+                break
+        xs = np.sort(aligned_pos[:, 0]) if sort_by_x else aligned_pos[:, 0]
+        try:
+            separation_p = utils.check_separation(xs, separation_threshold)
+        except AssertionError:
+            separation_p = False
+        if aligned and separation_p:
+            success = True
+            if color_names is not None:
+                block_inds = np.array(block_indices)
+                detected_colors = np.array(color_names)[block_inds[0:row_length]]
+                detected_colors_reverse = np.array(color_names)[block_inds[::-1][0:row_length]]
+                expected_colors = np.array(color_names)[np.array(object_color_sequence[0:row_length])]
+                success = (detected_colors == expected_colors).all() or (detected_colors_reverse == expected_colors).all()
+            if success:
+                return True, row_length, block_indices
+    return False, 1, []
+
+
+def random_block_positions(num_blocks, row_length, with_row, block_spacing=0.05):
+    """ Random block positions on a 0.448m square workspace, optionally with row_length of them placed in a row.
+    """
+    pos = np.random.uniform(-0.224, 0.224, size=(num_blocks, 3))
+    pos[:, 2] = 0.026
+    if with_row:
+        theta = np.random.uniform(0, np.pi)
+        direction = np.array([np.cos(theta), np.sin(theta), 0.0])
+        start = np.random.uniform(-0.1, 0.1, size=3)
+        start[2] = 0.026
+        row = start + np.arange(row_length)[:, None] * block_spacing * direction
+        row[:, :2] += np.random.normal(0, 0.002, size=(row_length, 2))
+        pos[np.random.choice(num_blocks, row_length, replace=False)] = row
+    return pos
+
+
+def benchmark_check_row(args):
+    """ Compare the per permutation row search with the batched utils.find_row() for 4, 8 and 12 blocks.
+    """
+    import utils
+    row_length = 4
+    distance_threshold, separation_threshold = 0.02, 0.1
+    colors = ['blue', 'green', 'yellow', 'red']
+    for num_blocks in [4, 8, 12]:
+        color_names = [colors[i % len(colors)] for i in range(num_blocks)]
+        mismatches = 0
+        for trial in range(args.trials):
+            pos = random_block_positions(num_blocks, row_length, with_row=trial % 2 == 0)
+            kwargs = dict(sort_by_x=trial % 3 != 0)
+            if trial % 4 == 1:
+                kwargs.update(color_names=color_names, object_color_sequence=np.random.permutation(len(colors)))
+            legacy_row = legacy_check_row(pos, row_length, distance_threshold, separation_threshold, **kwargs)
+            batched_row = utils.find_row(pos, row_length, distance_threshold, separation_threshold, **kwargs)
+            mismatches += int(legacy_row != batched_row)
+        repeats = max(1, args.repeats // num_blocks)
+        # time the worst case, where there is no row and every permutation is checked
+        pos = random_block_positions(num_blocks, row_length, with_row=False)
+        while legacy_check_row(pos, row_length, distance_threshold, separation_threshold)[0]:
+            pos = random_block_positions(num_blocks, row_length, with_row=False)
+        legacy_ms = time_it(lambda: legacy_check_row(pos, row_length, distance_threshold, separation_threshold), repeats)
+        batched_ms = time_it(lambda: utils.find_row(pos, row_length, distance_threshold, separation_threshold), repeats)
+        # and the best case, where the first blocks are a row
+        row_pos = pos.copy()
+        row_pos[:row_length] = random_block_positions(row_length, row_length, with_row=True)
+        assert legacy_check_row(row_pos, row_length, distance_threshold, separation_threshold)[0]
+        legacy_early_ms = time_it(lambda: legacy_check_row(row_pos, row_length, distance_threshold, separation_threshold), repeats)
+        batched_early_ms = time_it(lambda: utils.find_row(row_pos, row_length, distance_threshold, separation_threshold), repeats)
+        print('check_row %d blocks, %d permutations: %d/%d mismatches, no row: per permutation %.2f ms, batched %.2f ms, speedup %.1fx, '
+              'row in the first blocks: per permutation %.2f ms, batched %.2f ms, speedup %.1fx'
+              % (num_blocks, np.prod(range(num_blocks - row_length + 1, num_blocks + 1)), mismatches, args.trials,
+                 legacy_ms, batched_ms, legacy_ms / batched_ms, legacy_early_ms, batched_early_ms, legacy_early_ms / batched_early_ms))
+
+
+class FakeRemoteApi(object):
+    """ Local stand-in for the simulation.vrep object pose calls, which sleeps round_trip_ms for each blocking call.
+    """
+    def __init__(self, object_handles, num_other_shapes=20, round_trip_ms=1.0):
+        from simulation import vrepConst
+        self.simx_opmode_blocking = vrepConst.simx_opmode_blocking
+        self.simx_return_ok = vrepConst.simx_return_ok
+        self.sim_object_shape_type = vrepConst.sim_object_shape_type
+        self.round_trip_ms = round_trip_ms
+        self.round_trips = 0
+        # the scene also holds robot and table shapes, with handles mixed in with the objects
+        handles = list(object_handles) + list(range(1000, 1000 + num_other_shapes))
+        np.random.shuffle(handles)
+        self.poses = {handle: np.random.uniform(-0.5, 0.5, size=6).astype(np.float32) for handle in handles}
+
+    def round_trip(self):
+        self.round_trips += 1
+        time.sleep(self.round_trip_ms / 1000.0)
+
+    def simxGetObjectPosition(self, client_id, handle, relative_to_handle, operation_mode):
+        self.round_trip()
+        return self.simx_return_ok, [float(v) for v in self.poses[handle][:3]]
+
+    def simxGetObjectOrientation(self, client_id, handle, relative_to_handle, operation_mode):
+        self.round_trip()
+        return self.simx_return_ok, [float(v) for v in self.poses[handle][3:]]
+
+    def simxSetObjectPosition(self, client_id, handle, relative_to_handle, position, operation_mode):
+        self.round_trip()
+        self.poses[handle][:3] = position
+        return self.simx_return_ok
+
+    def simxSetObjectOrientation(self, client_id, handle, relative_to_handle, orientation, operation_mode):
+        self.round_trip()
+        self.poses[handle][3:] = orientation
+        return self.simx_return_ok
+
+    def simxGetObjectGroupData(self, client_id, object_type, data_type, operation_mode):
+        self.round_trip()
+        handles = list(self.poses.keys())
+        float_data = [float(v) for handle in handles for v in self.poses[handle]]
+        return self.simx_return_ok, handles, [], float_data, []
+
+    def set_camera_images(self, color_img, depth_img):
+        """ Set the images returned by the vision sensor calls, in the flipped and scaled format the simulator sends.
+        """
+        self.resolution = [color_img.shape[1], color_img.shape[0]]
+        raw_image = np.fliplr(color_img).astype(int)
+        # the simulator sends signed bytes
+        raw_image[raw_image > 127] -= 256
+        self.raw_image = raw_image.flatten().tolist()
+        zNear, zFar = 0.01, 10
+        self.depth_buffer = ((np.fliplr(depth_img) - zNear) / (zFar - zNear)).flatten().tolist()
+
+    def simxGetVisionSensorImage(self, client_id, handle, options, operation_mode):
+        self.round_trip()
+        return self.simx_return_ok, self.resolution, self.raw_image
+
+    def simxGetVisionSensorDepthBuffer(self, client_id, handle, operation_mode):
+        self.round_trip()
+        return self.simx_return_ok, self.resolution, self.depth_buffer
+
+
+def legacy_get_obj_positions_and_orientations(remote_api, sim_client, object_handles):
+    """ The one call per object pose query Robot.get_obj_positions_and_orientations() used before Robot.get_sim_state(), kept for comparison.
+    """
+    obj_positions = []
+    obj_orientations = []
+    for object_handle in object_handles:
+        sim_ret, object_position = remote_api.simxGetObjectPosition(sim_client, object_handle, -1, remote_api.simx_opmode_blocking)
+        sim_ret, object_orientation = remote_api.simxGetObjectOrientation(sim_client, object_handle, -1, remote_api.simx_opmode_blocking)
+        obj_positions.append(object_position)
+        obj_orientations.append(object_orientation)
+    return obj_positions, obj_orientations
+
+
+def fake_sim_robot(remote_api, object_handles):
+    """ A simulation Robot which talks to remote_api instead of the simulator, without running Robot.__init__().
+    """
+    import robot as robot_module
+    robot_module.vrep = remote_api
+    robot = robot_module.Robot.__new__(robot_module.Robot)
+    robot.is_sim = True
+    robot.sim_client = 0
+    robot.object_handles = object_handles
+    robot.workspace_limits = np.asarray([[-0.724, -0.276], [-0.224, 0.224], [-0.0001, 0.5]])
+    robot.heightmap_resolution = 0.002
+    robot.sim_state = None
+    robot.motion_count = 0
+    robot.camera_capture = robot_module.CameraCapture(robot)
+    robot.camera_frame = None
+    return robot
+
+
+def benchmark_sim_state(args):
+    """ Compare per object pose queries with the cached Robot.get_sim_state() snapshot on a stand-in remote API.
+
+    Each step moves one block, then reads the poses three times like check_row(), check_stack() and
+    dump_sim_object_state_to_json() do after a place.
+    """
+    num_obj = 10
+    object_handles = list(range(20, 20 + num_obj))
+    remote_api = FakeRemoteApi(object_handles, round_trip_ms=args.round_trip_ms)
+    robot = fake_sim_robot(remote_api, object_handles)
+    steps = max(1, args.trials // 10)
+
+    def run_steps(read_poses):
+        """ Returns mismatches against the per object queries, and the ms and round trips per step spent in read_poses().
+        """
+        mismatches, seconds, round_trips = 0, 0.0, 0
+        for step in range(steps):
+            robot.reposition_object_randomly(object_handles[step % num_obj])
+            for _ in range(3):
+                start, start_round_trips = time.time(), remote_api.round_trips
+                poses = read_poses()
+                seconds += time.time() - start
+                round_trips += remote_api.round_trips - start_round_trips
+                mismatches += int(poses != legacy_get_obj_positions_and_orientations(remote_api, 0, object_handles))
+        return mismatches, seconds * 1000 / steps, round_trips / steps
+
+    _, legacy_ms, legacy_round_trips = run_steps(lambda: legacy_get_obj_positions_and_orientations(remote_api, 0, object_handles))
+    mismatches, snapshot_ms, snapshot_round_trips = run_steps(robot.get_obj_positions_and_orientations)
+    print('sim state %d objects, %.1f ms round trips, %d steps: %d mismatches after moves' % (num_obj, args.round_trip_ms, steps, mismatches))
+    print('per object queries %.1f round trips %.2f ms per step, snapshot %.1f round trips %.2f ms per step, speedup %.1fx'
+          % (legacy_round_trips, legacy_ms, snapshot_round_trips, snapshot_ms, legacy_ms / snapshot_ms))
+
+
+def benchmark_camera_capture(args):
+    """ Compare serial Robot.get_camera_data() calls with request_camera_data() prefetching on a stand-in remote API.
+
+    Each step runs an action, then a training step, then gets the next observation, like the main.py loop.
+    The arm's return home and the training step are simulated with sleeps.
+    """
+    import types
+    import utils
+    import robot as robot_module
+    home_ms, train_ms, action_ms = 100.0, 100.0, 50.0
+    object_handles = list(range(20, 30))
+    remote_api = FakeRemoteApi(object_handles, round_trip_ms=args.round_trip_ms)
+    robot = fake_sim_robot(remote_api, object_handles)
+    # the simulation camera intrinsics and a pose looking down at the simulation workspace, like benchmark_heightmap()
+    robot.cam_handle = 0
+    robot.cam_intrinsics = np.asarray([[618.62, 0, 320], [0, 618.62, 240], [0, 0, 1]])
+    robot.cam_pose = np.eye(4)
+    robot.cam_pose[0:3, 0:3] = np.linalg.inv(utils.euler2rotm([-np.pi, -0.6, np.pi/2]))
+    robot.cam_pose[0:3, 3] = [-1.0, 0.0, 0.5]
+    robot.cam_depth_scale = 1
+    robot.background_heightmap = None
+    robot.heightmap_projector = None
+    robot.logoblock_dataset = False
+    # depth of the table plane z = 0 seen through each pixel
+    pix_x, pix_y = np.meshgrid(np.arange(640), np.arange(480))
+    rays = np.stack([(pix_x - 320) / 618.62, (pix_y - 240) / 618.62, np.ones_like(pix_x, dtype=float)], axis=-1)
+    depth_img = -robot.cam_pose[2, 3] / rays.dot(robot.cam_pose[2, 0:3])
+    remote_api.set_camera_images(np.random.randint(0, 255, size=(480, 640, 3)).astype(np.uint8), depth_img)
+
+    def go_home(self, block_until_home=False, timeout_seconds=7):
+        time.sleep(home_ms / 1000.0)
+        return True
+    robot.go_home = types.MethodType(robot_module.moves_objects(go_home), robot)
+
+    def action():
+        robot.reposition_object_randomly(object_handles[0])
+        time.sleep(action_ms / 1000.0)
+
+    reference = robot.get_camera_data(return_heightmaps=True)
+    steps = max(1, args.trials // 10)
+    results = {}
+    for prefetch in [False, True]:
+        mismatches, stale = 0, 0
+        start = time.time()
+        for step in range(steps):
+            action()
+            if prefetch:
+                robot.request_camera_data(return_heightmaps=True)
+            if step % 5 == 4:
+                # something moves after the prefetch, so the prefetched frame must not be used
+                robot.reposition_object_randomly(object_handles[1])
+            time.sleep(train_ms / 1000.0)
+            camera_data = robot.get_camera_data(return_heightmaps=True)
+            stale += int(robot.camera_frame.motion_count != robot.motion_count)
+            mismatches += int(not all(np.array_equal(a, b, equal_nan=True) for a, b in zip(camera_data, reference)))
+        results[prefetch] = (time.time() - start) * 1000 / steps
+        print('camera capture %s: %.1f ms per step, %d/%d mismatched frames, %d stale frames used'
+              % ('prefetched' if prefetch else 'serial', results[prefetch], mismatches, steps, stale))
+    print('simulated return home %.0f ms, training step %.0f ms, speedup %.2fx' % (home_ms, train_ms, results[False] / results[True]))
+
+
+def benchmark_sim_workers(args):
+    """ Run the generate_sim_stacking_demo.py demos on 1, 2 and 4 SimWorkerPool workers with FakeSimRobot.
+
+    Every stack is seeded by its task, so the merged sessions must be identical whatever the number of workers.
+    Each arm motion sleeps 0.2 seconds in place of the simulator, the wall times include starting the worker processes,
+    so there are at least 20 stacks to amortize the few seconds each worker takes to start.
+    """
+    import os
+    import shutil
+    import tempfile
+    import functools
+    import generate_sim_stacking_demo
+    from sim_workers import SimWorkerPool, FakeSimRobot
+    from transition_log import TransitionLog, transition_log_directory
+    num_stacks = max(20, args.trials // 10)
+    tasks = [(stack, num_stacks, 1234 + stack) for stack in range(num_stacks)]
+    make_robot = functools.partial(FakeSimRobot, num_obj=8, motion_seconds=0.2)
+    run_task = functools.partial(generate_sim_stacking_demo.make_stack_demo, final_stack_height=4)
+    directory = tempfile.mkdtemp()
+    sessions = {}
+    try:
+        for num_workers in [1, 2, 4]:
+            start = time.time()
+            logger, results = SimWorkerPool(num_workers, make_robot).run(tasks, run_task, directory, dir_name='workers-%d' % num_workers)
+            seconds = time.time() - start
+            num_iterations = sum(n for _, n, _ in results)
+            busy = sum(task_seconds for _, _, task_seconds in results) / (num_workers * seconds)
+            logs = TransitionLog(transition_log_directory(logger.transitions_directory)).read_all()
+            image_directory = os.path.join(logger.base_directory, 'data', 'color-heightmaps')
+            images = sorted(os.listdir(image_directory))
+            contiguous = sorted(set(int(name.split('.')[0]) for name in images)) == list(range(num_iterations))
+            images = [open(os.path.join(image_directory, name), 'rb').read() for name in images]
+            # one trial per stack, numbered in task order
+            expected_trials = np.concatenate([np.full(n, stack) for stack, (_, n, _) in enumerate(results)])
+            assert np.array_equal(logs['trial'][:, 0], expected_trials), 'the merged trial log is not numbered 0, 1, 2, ... by stack'
+            # the worker column of the worker-task log is the only part which may differ
+            logs['worker-task'] = logs['worker-task'][:, :1]
+            sessions[num_workers] = (logs, images, seconds)
+            same = all(np.array_equal(logs[name], sessions[1][0][name]) for name in sessions[1][0]) and images == sessions[1][1]
+            print('sim workers %d: %d stacks, %d iterations in %.1f s, %.1f stacks per minute, workers busy %.0f%% of the time, '
+                  'executed-action rows %d, images contiguous %s, same as 1 worker %s'
+                  % (num_workers, num_stacks, num_iterations, seconds, num_stacks * 60 / seconds, busy * 100,
+                     len(logs['executed-action']), contiguous, same))
+    finally:
+        shutil.rmtree(directory)
+    print('speedup 2 workers %.2fx, 4 workers %.2fx' % (sessions[1][2] / sessions[2][2], sessions[1][2] / sessions[4][2]))
+
+
+def benchmark_block_world(args):
+    """ Scripted stacking and row trials in block_world.BlockWorldRobot, every action chosen from the rendered heightmaps like main.py.
+
+    Checks that check_stack() and check_row() see the finished structures, and that the depth heightmap shows them
+    at the right height. Checks that a held block is not in the heightmaps but is still the highest object, like
+    check_correct_color_grasped() expects. Then reports the trials per hour.
+    """
+    import io
+    import contextlib
+    from block_world import BlockWorldRobot
+    np.random.seed(1234)
+    robot = BlockWorldRobot(num_obj=4, place=True)
+    separation = 0.055
+
+    def pixel_of(color_heightmap, object_index):
+        """ Heightmap pixel at the middle of the visible part of a block.
+        """
+        color = np.round(robot.obj_mesh_color[object_index] * 255).astype(np.uint8)
+        ys, xs = np.where((color_heightmap == color).all(axis=-1))
+        return int(np.round(xs.mean())), int(np.round(ys.mean()))
+
+    def to_pixel(position):
+        return (int((position[0] - robot.workspace_limits[0][0]) / robot.heightmap_resolution),
+                int((position[1] - robot.workspace_limits[1][0]) / robot.heightmap_resolution))
+
+    for task in ['stack', 'row']:
+        successes, height_matches, actions, held_visible, held_not_highest = 0, 0, 0, 0, 0
+        start = time.time()
+        for trial in range(args.trials):
+            with contextlib.redirect_stdout(io.StringIO()):
+                robot.restart_sim()
+                robot.add_objects()
+                order = np.random.permutation(robot.num_obj)
+                base = np.asarray(robot.get_obj_positions()[order[0]])
+                # rows grow towards the middle of the workspace
+                row_direction = np.array([1.0 if base[0] < robot.workspace_limits[0].mean() else -1.0, 0, 0])
+                for k, block in enumerate(order[1:]):
+                    valid_depth_heightmap, color_heightmap, _, _, _, _ = robot.get_camera_data(return_heightmaps=True)
+                    x_pixel, y_pixel = pixel_of(color_heightmap, block)
+                    position, _ = robot.action_heightmap_coordinate_to_3d_robot_pose(x_pixel, y_pixel, 'grasp', valid_depth_heightmap)
+                    robot.grasp(position, 0.0)
+                    valid_depth_heightmap, color_heightmap, _, _, _, _ = robot.get_camera_data(return_heightmaps=True)
+                    if robot.held_object is not None:
+                        held_color = np.round(robot.obj_mesh_color[robot.held_object] * 255).astype(np.uint8)
+                        held_visible += int((color_heightmap == held_color).all(axis=-1).any())
+                        held_not_highest += int(not robot.check_correct_color_grasped(robot.held_object))
+                    if task == 'row':
+                        x_pixel, y_pixel = to_pixel(base + (k + 1) * separation * row_direction)
+                    elif robot.held_object == order[k]:
+                        # the block to stack on was grasped by mistake and is out of view, put it back down
+                        x_pixel, y_pixel = to_pixel(position)
+                    else:
+                        x_pixel, y_pixel = pixel_of(color_heightmap, order[k])
+                    position, _ = robot.action_heightmap_coordinate_to_3d_robot_pose(x_pixel, y_pixel, 'place', valid_depth_heightmap)
+                    robot.place(position, 0.0)
+                    actions += 2
+                valid_depth_heightmap = robot.get_camera_data(return_heightmaps=True)[0]
+                if task == 'stack':
+                    success, height = robot.check_stack(order)
+                    expected_height = robot.num_obj * robot.block_size
+                else:
+                    success, height = robot.check_row(order, num_obj=robot.num_obj)
+                    expected_height = robot.block_size
+            successes += int(success)
+            height_matches += int(np.isclose(valid_depth_heightmap.max(), expected_height))
+        seconds = time.time() - start
+        print('block world %s: %d/%d trials successful, %d/%d with the expected heightmap height, %.2f ms per action, %.0f trials per hour'
+              % (task, successes, args.trials, height_matches, args.trials, seconds * 1000 / actions, args.trials * 3600 / seconds))
+        assert held_visible == 0, 'a held block was rendered in the heightmap after %d grasps' % held_visible
+        assert held_not_highest == 0, 'a held block was not the highest object after %d grasps' % held_not_highest
+
+
+BENCHMARKS = {
+    'trainer_forward': benchmark_trainer_forward,
+    'replay': benchmark_replay,
+    'transition_log': benchmark_transition_log,
+    'heightmap': benchmark_heightmap,
+    'infect_mask': benchmark_infect_mask,
+    'language_mask': benchmark_language_mask,
+    'attention': benchmark_attention,
+    'local_attention': benchmark_local_attention,
+    'validation_metrics': benchmark_validation_metrics,
+    'check_row': benchmark_check_row,
+    'sim_state': benchmark_sim_state,
+    'camera_capture': benchmark_camera_capture,
+    'sim_workers': benchmark_sim_workers,
+    'block_world': benchmark_block_world,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run micro-benchmarks of performance sensitive code paths.')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()), help='which benchmark to run')
+    parser.add_argument('--cpu', dest='cpu', action='store_true', default=False, help='force the benchmark to run on the cpu')
+    parser.add_argument('--repeats', dest='repeats', type=int, default=20, help='number of timed repetitions')
+    parser.add_argument('--heightmap_pixels', dest='heightmap_pixels', type=int, default=224, help='heightmap width and height')
+    parser.add_argument('--num_rotations', dest='num_rotations', type=int, default=16, help='number of rotations output by the network')
+    parser.add_argument('--iterations', dest='iterations', type=int, default=20000, help='number of logged iterations in the replay benchmark')
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=16, help='batch size of the attention and validation metric benchmarks')
+    parser.add_argument('--round_trip_ms', dest='round_trip_ms', type=float, default=1.0, help='simulated remote api round trip time in the sim_state and camera_capture benchmarks')
+    parser.add_argument('--trials', dest='trials', type=int, default=200, help='number of random inputs checked against the legacy version')
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
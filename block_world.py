@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+""" Headless in-process block world, a stand-in for the V-REP simulation Robot when physics fidelity is not needed.
+
+    Blocks are cubes which move kinematically: a grasp lifts the top block under the gripper, and a place
+    drops the held block onto whatever is below it, or onto the table if it would hang off the edge.
+    Color and depth heightmaps are rendered directly from the block poses, so there is no simulator process
+    and no camera projection. Useful for policy evaluation and language mask debugging:
+
+        python main.py --is_sim --block_world --place --num_obj 4 --is_testing --max_test_trials 100
+        python benchmark.py block_world --trials 200
+"""
+import time
+import numpy as np
+from robot import Robot, CameraCapture, CameraFrame, moves_objects
+
+
+def render_heightmaps(positions, orientations, colors, block_size, workspace_limits, heightmap_resolution):
+    """ Render top down color and depth heightmaps of square blocks, in the layout of utils.get_heightmap().
+
+    # Arguments
+
+        positions: Nx3 block center positions in robot coordinates.
+        orientations: N rotations of the blocks around the z axis.
+        colors: Nx3 block colors with values from 0 to 1.
+
+    # Returns
+
+        color_heightmap, depth_heightmap, with depth as the height above workspace_limits[2][0].
+    """
+    heightmap_size = np.round(((workspace_limits[1][1] - workspace_limits[1][0]) / heightmap_resolution,
+                               (workspace_limits[0][1] - workspace_limits[0][0]) / heightmap_resolution)).astype(int)
+    color_heightmap = np.zeros((heightmap_size[0], heightmap_size[1], 3), dtype=np.uint8)
+    depth_heightmap = np.zeros(heightmap_size)
+    # pixel centers in robot coordinates
+    pix_x = workspace_limits[0][0] + (np.arange(heightmap_size[1]) + 0.5) * heightmap_resolution
+    pix_y = workspace_limits[1][0] + (np.arange(heightmap_size[0]) + 0.5) * heightmap_resolution
+    tops = np.asarray(positions)[:, 2] + block_size / 2 - workspace_limits[2][0]
+    reach = block_size / np.sqrt(2)
+    # draw from the lowest to the highest block, so higher blocks cover lower ones
+    for i in np.argsort(tops):
+        x, y, z = positions[i]
+        if z > workspace_limits[2][1]:
+            # held by the gripper, above the camera's workspace
+            continue
+        cols = np.where(np.abs(pix_x - x) < reach)[0]
+        rows = np.where(np.abs(pix_y - y) < reach)[0]
+        if len(cols) == 0 or len(rows) == 0:
+            continue
+        dx = pix_x[cols][np.newaxis, :] - x
+        dy = pix_y[rows][:, np.newaxis] - y
+        c, s = np.cos(orientations[i]), np.sin(orientations[i])
+        inside = (np.abs(c * dx + s * dy) < block_size / 2) & (np.abs(-s * dx + c * dy) < block_size / 2)
+        region = np.ix_(rows, cols)
+        depth_heightmap[region] = np.where(inside, tops[i], depth_heightmap[region])
+        color_heightmap[region] = np.where(inside[:, :, np.newaxis], np.round(np.asarray(colors[i]) * 255).astype(np.uint8), color_heightmap[region])
+    return color_heightmap, depth_heightmap
+
+
+class BlockWorldRobot(Robot):
+    """ Robot with the simulator replaced by an in-process kinematic block world, see the module docstring.
+
+    Implements the parts of Robot that main.py uses in simulation: add_objects, grasp, place, push,
+    get_camera_data, get_obj_positions and check_stack, while check_row and the other checks
+    are inherited since they only need the object positions. Object handles are list indices.
+
+        block_size: edge length of the cube blocks in meters, the simulation blocks are 5 cm.
+    """
+    def __init__(self, num_obj=4, workspace_limits=None, is_testing=False, test_preset_arr=None,
+                 place=False, grasp_color_task=False, unstack=False, heightmap_resolution=0.002,
+                 task_type=None, language=False, block_size=0.05):
+        self.is_sim = True
+        if workspace_limits is None:
+            workspace_limits = np.asarray([[-0.724, -0.276], [-0.224, 0.224], [-0.0001, 0.5]]) # Cols: min max, Rows: x y z (define workspace limits in robot coordinates)
+        self.workspace_limits = workspace_limits
+        self.heightmap_resolution = heightmap_resolution
+        self.place_task = place
+        self.unstack = unstack
+        self.place_pose_history_limit = 6
+        self.place_pose_history = []
+        self.grasp_color_task = grasp_color_task
+        self.language = language
+        self.task_type = task_type
+        self.sim_home_position = [-0.3, 0.0, 0.45]
+        self.push_vertical_offset = 0.026
+        self.background_heightmap = None
+        self.heightmap_projector = None
+        self.logoblock_dataset = False
+        self.sim_state = None
+        self.motion_count = 0
+        self.camera_capture = CameraCapture(self)
+        self.camera_frame = None
+        # heightmaps are rendered directly, so these only describe a camera looking straight down for the logs
+        self.cam_intrinsics = np.eye(3)
+        self.cam_pose = np.eye(4)
+        self.cam_depth_scale = 1
+
+        if grasp_color_task:
+            self.color_names = ['red', 'blue', 'green', 'yellow']
+        else:
+            self.color_names = ['red', 'blue', 'green', 'yellow', 'brown', 'orange', 'gray', 'purple', 'cyan', 'pink']
+        self.color_space = np.asarray([
+                                [255.0, 87.0, 89.0], # red
+                                [78.0, 121.0, 167.0], # blue
+                                [89.0, 161.0, 79.0], # green
+                                [237.0, 201.0, 72.0], # yellow
+                                [156, 117, 95], # brown
+                                [242, 142, 43], # orange
+                                [186, 176, 172], # gray
+                                [176, 122, 161], # purple
+                                [118, 183, 178], # cyan
+                                [255, 157, 167]])[:len(self.color_names)]/255.0 #pink
+        self.num_obj = num_obj
+        self.obj_mesh_color = self.color_space[np.asarray(range(self.num_obj)) % self.color_space.shape[0], :]
+        self.object_colors = [self.color_names[i % len(self.color_names)] for i in range(self.num_obj)]
+        self.object_handles = list(range(self.num_obj))
+        self.block_size = block_size
+        self.is_testing = is_testing
+        self.test_preset_cases = False
+        self.test_preset_arr = test_preset_arr
+        self.randomized = True
+        # list index of the block in the gripper, None when the gripper is empty
+        self.held_object = None
+        self.add_objects()
+
+    def drop_object(self, index, position, orientation):
+        """ Set the block at index down at the x, y of position, resting on the highest block below it or on the table.
+
+        A block whose center is not over the top face of the block below slides off its edge.
+        """
+        xy = np.asarray(position[:2], dtype=float)
+        others = np.asarray([i for i in range(self.num_obj) if i != index and i != self.held_object])
+        z = self.workspace_limits[2][0] + self.block_size / 2
+        for _ in range(self.num_obj):
+            if len(others) == 0:
+                break
+            distances = np.linalg.norm(self.positions[others, :2] - xy, axis=1)
+            below = others[distances < self.block_size]
+            if len(below) == 0:
+                break
+            support = below[np.argmax(self.positions[below, 2])]
+            offset = xy - self.positions[support, :2]
+            if np.linalg.norm(offset) <= self.block_size / 2:
+                z = self.positions[support, 2] + self.block_size
+                break
+            # off balance, so it falls next to the block below
+            xy = self.positions[support, :2] + offset / np.linalg.norm(offset) * self.block_size
+        self.positions[index] = [xy[0], xy[1], z]
+        self.orientations[index] = [0, 0, orientation]
+
+    @moves_objects
+    def add_objects(self):
+        self.positions = np.zeros((self.num_obj, 3))
+        # start far outside the workspace, so blocks which are not placed yet are not in the way
+        self.positions[:, 0] = self.workspace_limits[0][1] + 10.0
+        self.orientations = np.zeros((self.num_obj, 3))
+        self.held_object = None
+        for object_idx in range(self.num_obj):
+            drop_x, drop_y, object_position, object_orientation = self.generate_random_object_pose()
+            if self.test_preset_arr is not None:
+                object_position = self.test_preset_arr[object_idx][0]
+                object_orientation = self.test_preset_arr[object_idx][1]
+            self.drop_object(object_idx, object_position, object_orientation[2])
+        self.prev_obj_positions = []
+        self.obj_positions = []
+        if self.task_type == 'unstack':
+            self.reposition_objects()
+
+    @moves_objects
+    def restart_sim(self, connect=False):
+        self.held_object = None
+
+    def check_sim(self, restart_if_not_ok=True):
+        return True
+
+    def stop_sim(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def go_home(self, block_until_home=False, timeout_seconds=7):
+        return True
+
+    def block_until_home(self, timeout_seconds=7):
+        return True
+
+    def check_obj_in_scene(self, obj_handle, workspace_limits=None, buffer_meters=0.1):
+        if workspace_limits is None:
+            workspace_limits = self.workspace_limits
+        x, y, _ = self.positions[obj_handle]
+        return (workspace_limits[0][0] - buffer_meters < x < workspace_limits[0][1] + buffer_meters and
+                workspace_limits[1][0] - buffer_meters < y < workspace_limits[1][1] + buffer_meters)
+
+    def get_sim_state(self):
+        return self.positions.tolist(), self.orientations.tolist()
+
+    @moves_objects
+    def reposition_objects(self, unstack_drop_height=0.05, action_log=None, logger=None,
+            goal_condition=None, workspace_limits=None):
+        self.held_object = None
+        if self.task_type == 'unstack':
+            # one stack of all the blocks, in random order
+            _, _, obj_pos, obj_ori = self.generate_random_object_pose()
+            for i in np.random.permutation(self.num_obj):
+                self.positions[i, 0] = self.workspace_limits[0][1] + 10.0
+            for i in np.random.permutation(self.num_obj):
+                self.drop_object(i, obj_pos, obj_ori[2])
+        else:
+            for i in range(self.num_obj):
+                self.positions[i, 0] = self.workspace_limits[0][1] + 10.0
+            for i in range(self.num_obj):
+                _, _, obj_pos, obj_ori = self.generate_random_object_pose()
+                self.drop_object(i, obj_pos, obj_ori[2])
+        return True
+
+    def capture_camera_frame(self, workspace_limits=None, heightmap_resolution=None, return_heightmaps=False, go_home=True, z_height_retake_threshold=0.3, median_filter_size=5, color_median_filter_size=5):
+        """ Render a CameraFrame now, the color and depth images are the heightmaps since the camera looks straight down.
+        """
+        if workspace_limits is None:
+            workspace_limits = self.workspace_limits
+        if heightmap_resolution is None:
+            heightmap_resolution = self.heightmap_resolution
+        sequence = self.camera_capture.next_sequence()
+        timestamp = time.time()
+        color_heightmap, depth_heightmap = render_heightmaps(
+            self.positions, self.orientations[:, 2], self.obj_mesh_color, self.block_size, workspace_limits, heightmap_resolution)
+        color_img, depth_img = color_heightmap, depth_heightmap
+        if return_heightmaps:
+            camera_data = depth_heightmap.copy(), color_heightmap, depth_heightmap, np.max(depth_heightmap), color_img, depth_img
+        else:
+            camera_data = color_img, depth_img
+        return CameraFrame(sequence, timestamp, self.motion_count, camera_data)
+
+    @moves_objects
+    def grasp(self, position, heightmap_rotation_angle, object_color=None, workspace_limits=None, go_home=True):
+        """ Lift the highest block within half a block of position, if the gripper fingers reach its sides
+        and no other block sits on it. The gripper closes 4 cm below position like the simulation.
+
+        object_color: The index in the list self.color_names expected for the object to be grasped. If object_color is None the color does not matter.
+        """
+        if workspace_limits is None:
+            workspace_limits = self.workspace_limits
+        print('Executing: grasp at (%f, %f, %f) orientation: %f' % (position[0], position[1], position[2], heightmap_rotation_angle))
+        if self.held_object is not None:
+            # drop whatever is still in the gripper
+            held_object, self.held_object = self.held_object, None
+            self.drop_object(held_object, position, heightmap_rotation_angle)
+        grasp_z = max(position[2] - 0.04, workspace_limits[2][0] + 0.02)
+        distances = np.linalg.norm(self.positions[:, :2] - np.asarray(position[:2]), axis=1)
+        reachable = np.where((distances < self.block_size / 2) & (np.abs(self.positions[:, 2] - grasp_z) < self.block_size / 2))[0]
+        grasp_success = False
+        if len(reachable):
+            grasped = reachable[np.argmax(self.positions[reachable, 2])]
+            on_top = (np.linalg.norm(self.positions[:, :2] - self.positions[grasped, :2], axis=1) < self.block_size) & \
+                     (self.positions[:, 2] > self.positions[grasped, 2] + self.block_size / 2)
+            grasp_success = not on_top.any()
+        color_success = False
+        if grasp_success:
+            # held blocks are the highest object, above the workspace so they are not in the heightmaps
+            self.held_object = grasped
+            self.positions[grasped] = [self.sim_home_position[0], self.sim_home_position[1], self.workspace_limits[2][1] + self.block_size]
+            if self.grasp_color_task:
+                color_success = self.check_correct_color_grasped(object_color)
+                print('Correct color was grasped: ' + str(color_success))
+            elif self.language:
+                color_success = self.check_correct_color_grasped_from_string(object_color)
+                print('Correct color was grasped: ' + str(color_success))
+            if not self.place_task:
+                # we are pushing and grasping, so move the objects outside the workspace
+                self.positions[grasped, 0] = workspace_limits[0][1] + 10.0
+                self.held_object = None
+        return grasp_success, color_success
+
+    @moves_objects
+    def place(self, position, heightmap_rotation_angle, workspace_limits=None, distance_threshold=0.06, go_home=True, save_history=True, over_block=True, intended_position=None):
+        """ Drop the held block at position, successful if it comes to rest within distance_threshold of
+        a block on the surface at position, or of intended_position.
+        """
+        place_pose = (position[0], position[1], position[2], heightmap_rotation_angle)
+        print('Executing: Place at (%f, %f, %f) angle: %f' % place_pose)
+        if save_history:
+            self.place_pose_history.append(place_pose)
+            while len(self.place_pose_history) > self.place_pose_history_limit:  # only store x most recent place attempts
+                self.place_pose_history.pop(0)
+        if self.held_object is None:
+            # There is no object present, so we cannot possibly place!
+            return False
+        placed_object, self.held_object = self.held_object, None
+        self.drop_object(placed_object, position, heightmap_rotation_angle)
+        if intended_position is None:
+            goal_position = np.array([position[0], position[1], position[2] + self.block_size / 2])
+        else:
+            goal_position = np.asarray(intended_position[0])
+        place_success = np.linalg.norm(self.positions[placed_object] - goal_position) < distance_threshold
+        print('place_success: ' + str(place_success))
+        return place_success
+
+    @moves_objects
+    def push(self, position, heightmap_rotation_angle, workspace_limits=None, go_home=True, push_length=0.1, finger_width=0.02):
+        """ Sweep a finger push_length from position, blocks it touches slide ahead of it with the blocks stacked on them.
+        """
+        print('Executing: Push at (%f, %f, %f) angle: %f' % (position[0], position[1], position[2], heightmap_rotation_angle))
+        direction = np.array([np.cos(heightmap_rotation_angle), np.sin(heightmap_rotation_angle)])
+        offsets = self.positions[:, :2] - np.asarray(position[:2])
+        along = offsets.dot(direction)
+        across = offsets.dot([-direction[1], direction[0]])
+        finger_z = position[2] + self.push_vertical_offset
+        touched = (np.abs(across) < (self.block_size + finger_width) / 2) & \
+                  (along > -self.block_size / 2) & (along < push_length + self.block_size / 2) & \
+                  (self.positions[:, 2] - self.block_size / 2 < finger_z)
+        moved = np.zeros(self.num_obj, dtype=bool)
+        for i in np.where(touched)[0]:
+            shift = (push_length + self.block_size / 2 - along[i]) * direction
+            # the blocks stacked on a pushed block move with it
+            stacked = (np.linalg.norm(self.positions[:, :2] - self.positions[i, :2], axis=1) < self.block_size / 2) & \
+                      (self.positions[:, 2] >= self.positions[i, 2]) & ~moved
+            self.positions[stacked, :2] += shift
+            moved |= stacked
+        return True
+
+    def check_stack(self, object_color_sequence, crop_stack_sequence=True,
+            horiz_distance_threshold=0.06, vert_distance_threshold=0.06, top_idx=-1,
+            pos=None, return_inds=False, goal_num_obj=4):
+        """ Check for a complete stack in the correct order from bottom to top, like Robot.check_stack().
+
+        The stack is followed down from the block at top_idx in height order, each block resting on the
+        block within horiz_distance_threshold / 2 of it and one block height below, as set by drop_object().
+        The order only matters for the grasp color and language tasks.
+
+        # Returns
+
+        List [success, height_count], and the stack's block indices from bottom to top if return_inds is True.
+        """
+        if pos is None:
+            pos = self.positions
+        pos = np.asarray(pos)
+        if len(object_color_sequence) <= 1:
+            print('check_stack() object_color_sequence length is 0 or 1, so there is nothing to check and it passes automatically')
+            if return_inds:
+                return True, len(object_color_sequence), []
+            return True, len(object_color_sequence)
+        in_scene = pos[:, 2] < self.workspace_limits[2][1]
+        stack = [np.argsort(np.where(in_scene, pos[:, 2], -np.inf))[top_idx]]
+        while True:
+            below = np.where(in_scene &
+                             (np.linalg.norm(pos[:, :2] - pos[stack[-1], :2], axis=1) < horiz_distance_threshold / 2) &
+                             (pos[stack[-1], 2] - pos[:, 2] > vert_distance_threshold / 2) &
+                             (pos[stack[-1], 2] - pos[:, 2] < vert_distance_threshold))[0]
+            if len(below) == 0:
+                break
+            stack.append(below[np.argmax(pos[below, 2])])
+        stack = stack[::-1]
+        if self.grasp_color_task or self.language:
+            goal = np.array(self.object_colors)[np.asarray(object_color_sequence, dtype=int)]
+            detected = np.array(self.object_colors)[stack]
+            height = 0
+            while height < min(len(goal), len(detected)) and goal[height] == detected[height]:
+                height += 1
+            height = max(height, 1)
+        else:
+            height = len(stack)
+        success = height >= len(object_color_sequence)
+        print('check_stack() stack: ' + str(stack) + ' height: ' + str(height) + ' success: ' + str(success))
+        if return_inds:
+            return success, height, np.array(stack)
+        return success, height
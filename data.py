@@ -18,6 +18,7 @@ from matplotlib import pyplot as plt
 from skimage.util import random_noise
 
 from annotate_data import Pair, flip_pair, rotate_pair, gaussian_augment 
+from language_embedders import commands_to_ids
 np.random.seed(12) 
 torch.manual_seed(12) 
 
@@ -382,6 +383,8 @@ class DatasetReader:
         self.augment_with_noise = augment_with_noise 
         self.noise_num_samples = noise_num_samples
         self.noise_gaussian_params = [0.0, 0.05]
+        # embedder word ids, batches include command_ids once set, see set_token_to_id() 
+        self.token_to_id = None
 
         if self.image_path is None:
             self.trajectory_class = SimpleTrajectory
@@ -530,16 +533,31 @@ class DatasetReader:
         next_pos_for_regression = torch.cat(next_pos_for_regression, 0) 
         block_to_move = torch.cat(block_to_move, 0) 
 
-        return {"command": commands,
-                "prev_pos_input": prev_pos_input,
-                "prev_pos_for_acc": prev_pos_for_acc,
-                "prev_pos_for_pred": prev_pos_for_pred,
-                "next_pos_for_acc": next_pos_for_acc,
-                "next_pos_for_pred": next_pos_for_pred,
-                "next_pos_for_regression": next_pos_for_regression,
-                "block_to_move": block_to_move,
-                "image": image,
-                "length": length} 
+        batch = {"command": commands,
+                 "prev_pos_input": prev_pos_input,
+                 "prev_pos_for_acc": prev_pos_for_acc,
+                 "prev_pos_for_pred": prev_pos_for_pred,
+                 "next_pos_for_acc": next_pos_for_acc,
+                 "next_pos_for_pred": next_pos_for_pred,
+                 "next_pos_for_regression": next_pos_for_regression,
+                 "block_to_move": block_to_move,
+                 "image": image,
+                 "length": length,
+                 "command_lengths": torch.tensor(length, dtype = torch.long)} 
+        if self.token_to_id is not None:
+            batch["command_ids"] = commands_to_ids(commands, self.token_to_id)
+        return batch 
+
+    def set_token_to_id(self, token_to_id):
+        """
+        set the embedder word ids (e.g. RandomEmbedder.token_to_id) so batches include a command_ids tensor, 
+        batches that were already built get theirs added here 
+        """
+        self.token_to_id = token_to_id
+        for split_data in self.data.values():
+            for batch in split_data:
+                if isinstance(batch, dict):
+                    batch["command_ids"] = commands_to_ids(batch["command"], token_to_id)
 
     def shuffle_and_batch_trajectories(self, split=None): 
         """
@@ -571,6 +589,230 @@ class DatasetReader:
 
             self.data[key] = batches  
 
+PAIR_STORE_DIR = "pair_store"
+
+class PairStore:
+    """
+    Binary columnar store for Pairs. Images are kept as memory-mapped .npy columns
+    (uint8 RGB, float16 depth, uint8 state/inference images) and everything else
+    (codes, locations, etc.) as one small metadata line per pair.
+    """
+    rgb_keys = ["prev_image", "next_image"]
+    uint8_keys = ["prev_state_image", "next_state_image", "prev_image_for_inference", "next_image_for_inference"]
+
+    def __init__(self, store_path):
+        self.store_path = pathlib.Path(store_path)
+        with open(self.store_path.joinpath("metadata.jsonlines")) as f1:
+            self.metadata = [json.loads(line) for line in f1]
+        self.arrays = None
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def __getstate__(self):
+        # don't pickle the memory maps, they get re-opened on first access
+        state = self.__dict__.copy()
+        state["arrays"] = None
+        return state
+
+    def open(self):
+        if self.arrays is None:
+            self.arrays = {npy_file.stem: np.load(npy_file, mmap_mode = "r") for npy_file in self.store_path.glob("*.npy")}
+        return self.arrays
+
+    def get_image(self, idx, key):
+        """
+        read a single image for a pair, upcast to float like Pair.from_jsonline does
+        """
+        if key not in self.metadata[idx]["stored_keys"]:
+            return None
+        arrays = self.open()
+        if key in PairStore.rgb_keys:
+            rgb = arrays[f"{key}.rgb"][idx].astype(np.float64)
+            depth = arrays[f"{key}.depth"][idx].astype(np.float64)
+            return np.concatenate([rgb, depth], axis=-1)
+        return arrays[key][idx].astype(np.float64)
+
+    def get_pair(self, idx):
+        return StoredPair.from_store(self, idx)
+
+    @staticmethod
+    def to_uint8(value, key):
+        if value.size > 0 and (np.min(value) < 0 or np.max(value) > 255 or not np.all(np.round(value) == value)):
+            raise ValueError(f"{key} does not hold 8-bit values, can't store it as uint8")
+        return value.astype(np.uint8)
+
+    @staticmethod
+    def get_manifest(json_files):
+        return {"sources": [[str(x), os.path.getsize(x)] for x in json_files]}
+
+    @classmethod
+    def load_or_convert(cls, json_files, store_path):
+        """
+        open the store at store_path, (re)building it from json_files if it is missing or stale
+        """
+        json_files = list(json_files)
+        store_path = pathlib.Path(store_path)
+        manifest_path = store_path.joinpath("manifest.json")
+        if manifest_path.exists():
+            with open(manifest_path) as f1:
+                manifest = json.load(f1)
+            if len(json_files) == 0 or manifest["sources"] == cls.get_manifest(json_files)["sources"]:
+                return cls(store_path)
+            print(f"pair store at {store_path} is stale, rebuilding")
+        return cls.from_jsonlines(json_files, store_path)
+
+    @classmethod
+    def from_jsonlines(cls, json_files, store_path):
+        """
+        one-time conversion from Pair jsonlines, streaming one line at a time
+        """
+        json_files = list(json_files)
+        store_path = pathlib.Path(store_path)
+        store_path.mkdir(parents = True, exist_ok = True)
+        manifest_path = store_path.joinpath("manifest.json")
+        if manifest_path.exists():
+            # manifest is written last, so a partial store is never read
+            manifest_path.unlink()
+
+        num_pairs = 0
+        for json_file in json_files:
+            with open(json_file) as f1:
+                num_pairs += sum([1 for line in f1 if line.strip() != ""])
+
+        arrays = {}
+        def write(name, idx, value, dtype):
+            if name not in arrays:
+                arrays[name] = np.lib.format.open_memmap(store_path.joinpath(f"{name}.npy"), mode="w+",
+                                                          dtype=dtype, shape=(num_pairs,) + value.shape)
+            arrays[name][idx] = value
+
+        print(f"converting {num_pairs} pairs to binary store at {store_path}")
+        idx = 0
+        with open(store_path.joinpath("metadata.jsonlines"), "w") as meta_f:
+            for json_file in json_files:
+                with open(json_file) as f1:
+                    for line in tqdm(f1):
+                        if line.strip() == "":
+                            continue
+                        data = json.loads(line)
+                        stored_keys = []
+                        for key in cls.rgb_keys + cls.uint8_keys:
+                            if data.get(key, None) is None:
+                                continue
+                            value = np.array(data[key])
+                            if key in cls.rgb_keys:
+                                write(f"{key}.rgb", idx, cls.to_uint8(value[:,:,0:3], key), np.uint8)
+                                write(f"{key}.depth", idx, value[:,:,3:], np.float16)
+                            else:
+                                write(key, idx, cls.to_uint8(value, key), np.uint8)
+                            data[key] = None
+                            stored_keys.append(key)
+                        data["stored_keys"] = stored_keys
+                        meta_f.write(json.dumps(data) + "\n")
+                        idx += 1
+
+        for array in arrays.values():
+            array.flush()
+        del arrays
+        with open(manifest_path, "w") as f1:
+            json.dump(cls.get_manifest(json_files), f1)
+        return cls(store_path)
+
+class StoredPair(Pair):
+    """
+    A view of one Pair in a PairStore. Images are read from the memory map when accessed,
+    and are only held in memory once they're assigned (e.g. by resize() or augmentation).
+    """
+    @classmethod
+    def from_store(cls, store, idx):
+        pair = cls.from_dict(dict(store.metadata[idx]))
+        for key in store.metadata[idx]["stored_keys"]:
+            del pair.__dict__[key]
+        pair._store = store
+        pair._idx = idx
+        return pair
+
+    def __getattr__(self, name):
+        # only called when name isn't set on the pair itself
+        if name.startswith("_") or name not in PairStore.rgb_keys + PairStore.uint8_keys:
+            raise AttributeError(name)
+        return self._store.get_image(self._idx, name)
+
+    def __deepcopy__(self, memo):
+        # copies share the store instead of copying the memory maps
+        new_pair = self.__class__.__new__(self.__class__)
+        memo[id(self)] = new_pair
+        for k, v in self.__dict__.items():
+            new_pair.__dict__[k] = v if k == "_store" else copy.deepcopy(v, memo)
+        return new_pair
+
+class AugmentedPair:
+    """
+    Index transform over a Pair: which flip axis, number of rotations and whether to add noise.
+    The augmented copy is only made at batch time, so the train split holds one copy of each pair. 
+    """
+    def __init__(self, pair, flip_axis = 0, rotation = 0, noise_params = None):
+        self.pair = pair
+        self.flip_axis = flip_axis
+        self.rotation = rotation
+        self.noise_params = noise_params
+
+    def generate(self):
+        # commands don't depend on the flip/rotation 
+        return self.pair.generate()
+
+    def load(self):
+        # same order as the eager expansion: flip, then rotate, then noise 
+        pair = self.pair
+        if self.flip_axis > 0:
+            pair = flip_pair(pair, self.flip_axis)
+        if self.rotation > 0:
+            pair = rotate_pair(pair, self.rotation)
+        if self.noise_params is not None:
+            pair = gaussian_augment(pair, self.noise_params)
+        if pair is self.pair:
+            pair = copy.deepcopy(pair)
+        return pair
+
+def seed_worker(worker_id):
+    # forked workers start with the same numpy state, re-seed so noise augmentation differs per worker and epoch 
+    np.random.seed(torch.initial_seed() % 2**32)
+
+class LazyBatches:
+    """
+    Batches over a list of data that are built when they're needed rather than up front,
+    via a torch DataLoader with batchify as the collate function. With num_workers > 0, 
+    batches are built in worker processes and prefetched (at most prefetch_factor per worker) 
+    while the model trains on the current batch. If shuffle is set, the data is reshuffled every epoch. 
+    """
+    def __init__(self, data, batchify, batch_size, shuffle = True, num_workers = 0, pin_memory = False, prefetch_factor = 2):
+        self.data = data
+        self.batchify = batchify
+        self.batch_size = batch_size
+        loader_kwargs = dict(batch_size = batch_size,
+                             shuffle = shuffle, 
+                             collate_fn = batchify,
+                             num_workers = num_workers,
+                             pin_memory = pin_memory)
+        if num_workers > 0:
+            loader_kwargs["prefetch_factor"] = prefetch_factor
+            loader_kwargs["worker_init_fn"] = seed_worker
+        self.loader = torch.utils.data.DataLoader(data, **loader_kwargs)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getitem__(self, idx):
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"batch {idx} out of range")
+        return self.batchify(self.data[idx * self.batch_size: (idx + 1) * self.batch_size])
+
+    def __iter__(self):
+        for batch in self.loader:
+            if batch is not None:
+                yield batch
+
 class GoodRobotDatasetReader: 
     def __init__(self, 
                 path_or_obj: str,
@@ -589,24 +831,38 @@ class GoodRobotDatasetReader:
                 is_bert: bool = True,
                 data_subset: float = None, 
                 overfit: bool = False,
-                prep_code: str = None):
+                prep_code: str = None,
+                use_store: bool = True,
+                num_workers: int = 0,
+                pin_memory: bool = False,
+                prefetch_factor: int = 2):
         self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.prefetch_factor = prefetch_factor
         self.is_bert = is_bert 
         self.resolution = resolution 
         self.max_seq_length = max_seq_length
 
         self.noise_gaussian_params = [0.0, 0.05]
         self.noise_num_samples = noise_num_samples
+        # embedder word ids, batches include command_ids once set, see set_token_to_id() 
+        self.token_to_id = None
 
 
         if type(path_or_obj) == str:
             self.path = pathlib.Path(path_or_obj)
-            self.json_files = self.path.glob("*/*.jsonlines")    
-            self.all_data = []
-            for json_file in self.json_files:
-                with open(json_file) as f1:
-                    lines = f1.readlines()
-                    self.all_data += [Pair.from_jsonline(line.strip()) for line in lines]
+            self.json_files = list(self.path.glob("*/*.jsonlines"))
+            if use_store:
+                # convert once to a memory-mapped binary store, pairs are read lazily from it 
+                store = PairStore.load_or_convert(self.json_files, self.path.joinpath(PAIR_STORE_DIR))
+                self.all_data = [store.get_pair(i) for i in range(len(store))]
+            else:
+                self.all_data = []
+                for json_file in self.json_files:
+                    with open(json_file) as f1:
+                        lines = f1.readlines()
+                        self.all_data += [Pair.from_jsonline(line.strip()) for line in lines]
             #self.pkl_files = self.path.glob("*/*.pkl")
             #self.all_data = []
             #for pkl_file in self.pkl_files:
@@ -671,32 +927,32 @@ class GoodRobotDatasetReader:
             train_data = list(new_train_data)
 
         # only augment train data 
+        # augmentations are index transforms over the original pairs, applied at batch time 
+        train_data = [AugmentedPair(pair) for pair in train_data]
         # augment by flipping across 4 axes 
         if augment_by_flipping:
             new_data = []
-            for pair in train_data:
+            for aug_pair in train_data:
                 for axis in range(1,5):
-                    new_pair = flip_pair(pair, axis) 
-                    new_data.append(new_pair) 
+                    new_data.append(AugmentedPair(aug_pair.pair, flip_axis = axis)) 
             train_data += new_data 
 
         if augment_by_rotating:
             new_data = []
-            for pair in train_data:
+            for aug_pair in train_data:
                 for rot in range(1, 4):
-                    new_pair = rotate_pair(pair, rot)
-                    new_data.append(new_pair)
+                    new_data.append(AugmentedPair(aug_pair.pair, flip_axis = aug_pair.flip_axis, rotation = rot))
             train_data += new_data
 
         if augment_with_noise:
             new_data = []
-            print(f"augmenting with noise")
-            for pair in tqdm(train_data):
+            for aug_pair in train_data:
                 for i in range(self.noise_num_samples):
-                    new_pair = gaussian_augment(pair, self.noise_gaussian_params)
-                    new_data.append(new_pair)
+                    new_data.append(AugmentedPair(aug_pair.pair, 
+                                                  flip_axis = aug_pair.flip_axis,
+                                                  rotation = aug_pair.rotation,
+                                                  noise_params = self.noise_gaussian_params))
             train_data += new_data
-            print(f"added")
 
 
         self.color_names = ['blue', 'green', 'yellow', 'red', 'brown', 'orange', 'gray', 'purple', 'cyan', 'pink']
@@ -721,6 +977,8 @@ class GoodRobotDatasetReader:
 
         self.vocab = set()
         for pair in self.data['train']:
+            if isinstance(pair, AugmentedPair):
+                pair = pair.pair
             if 'bad' in [pair.source_code, pair.target_code]:
                 continue
             command = pair.generate()
@@ -746,7 +1004,9 @@ class GoodRobotDatasetReader:
 
     def shuffle_and_batch_trajectories(self, split=None): 
         """
-        shuffle the trajectories and batch them together 
+        shuffle the trajectories and set up batching them together 
+        batches are built lazily (in worker processes if num_workers > 0), 
+        train is reshuffled every epoch while dev/test keep a fixed shuffled order 
         """
         if split is None:
             keys = self.data.keys()
@@ -754,25 +1014,16 @@ class GoodRobotDatasetReader:
             keys = [split]
         for key in keys:
             split_data = self.data[key]
-            # shuffle data 
-            np.random.shuffle(split_data)
-            # batchify
-            batches = []
-            curr_batch = []
-            for i in range(len(split_data)):
-                curr_batch.append(split_data[i]) 
-                if (i + 1) % self.batch_size == 0:
-                    batch = self.batchify(curr_batch)
-                    if batch is not None:
-                        batches.append(batch) 
-                    curr_batch = []
-            # append last one 
-            if len(curr_batch) > 0: 
-                batch = self.batchify(curr_batch)
-                if batch is not None: 
-                    batches.append(batch) 
-
-            self.data[key] = batches  
+            if key != "train":
+                # shuffle data once 
+                np.random.shuffle(split_data)
+            self.data[key] = LazyBatches(split_data, 
+                                         self.batchify,
+                                         self.batch_size,
+                                         shuffle = key == "train",
+                                         num_workers = self.num_workers,
+                                         pin_memory = self.pin_memory,
+                                         prefetch_factor = self.prefetch_factor)
 
     def batchify(self, batch_as_list): 
         """
@@ -800,7 +1051,10 @@ class GoodRobotDatasetReader:
 
         length = []
         for idx in range(len(batch_as_list)):
-            pair = copy.deepcopy(batch_as_list[idx])
+            if isinstance(batch_as_list[idx], AugmentedPair):
+                pair = batch_as_list[idx].load() 
+            else:
+                pair = copy.deepcopy(batch_as_list[idx])
             # trim! 
             command = re.split("\s+", pair.generate()) 
             if len(command) > max_length:
@@ -848,18 +1102,29 @@ class GoodRobotDatasetReader:
 
         block_to_move = torch.tensor(block_to_move)
 
-        return {"command": commands,
-                "prev_pos_input": prev_pos_input,
-                "prev_pos_for_acc": prev_pos_for_acc,
-                "prev_pos_for_pred": prev_pos_for_pred,
-                "prev_pos_for_vis": prev_pos_for_vis,
-                "next_pos_for_acc": next_pos_for_acc,
-                "next_pos_for_vis": next_pos_for_vis,
-                "next_pos_for_pred": next_pos_for_pred,
-                "next_pos_for_regression": None,
-                "block_to_move":  block_to_move,
-                "pairs": pairs, 
-                "length": length} 
+        batch = {"command": commands,
+                 "prev_pos_input": prev_pos_input,
+                 "prev_pos_for_acc": prev_pos_for_acc,
+                 "prev_pos_for_pred": prev_pos_for_pred,
+                 "prev_pos_for_vis": prev_pos_for_vis,
+                 "next_pos_for_acc": next_pos_for_acc,
+                 "next_pos_for_vis": next_pos_for_vis,
+                 "next_pos_for_pred": next_pos_for_pred,
+                 "next_pos_for_regression": None,
+                 "block_to_move":  block_to_move,
+                 "pairs": pairs, 
+                 "length": length,
+                 "command_lengths": torch.tensor(length, dtype = torch.long)} 
+        if self.token_to_id is not None:
+            batch["command_ids"] = commands_to_ids(commands, self.token_to_id)
+        return batch 
+
+    def set_token_to_id(self, token_to_id):
+        """
+        set the embedder word ids (e.g. RandomEmbedder.token_to_id) so batches include a command_ids tensor, 
+        batches are built lazily so every later batch gets them 
+        """
+        self.token_to_id = token_to_id
 
 if __name__ == "__main__":
     reader = DatasetReader("blocks_data/devset.json", "blocks_data/devset.json", "blocks_data/devset.json")  
@@ -2,14 +2,13 @@ import numpy as np
 import cv2
 import os
 from utils import ACTION_TO_ID
+from transition_log import load_transition_log
 
 class Demonstration():
     def __init__(self, path, demo_num, check_z_height, task_type='stack'):
-        try:
-            # path is expected to be <logs/exp_name>
-            self.action_log = np.loadtxt(os.path.join(path, 'transitions',
-                'executed-actions-' + str(demo_num) + '.log.txt'))
-        except OSError:
+        # path is expected to be <logs/exp_name>
+        self.action_log = load_transition_log(os.path.join(path, 'transitions'), 'executed-actions-' + str(demo_num))
+        if self.action_log is None:
             raise OSError("Demo Number " + str(demo_num) + " does not exist.")
 
         self.rgb_dir = os.path.join(path, 'data', 'color-heightmaps')
@@ -4,6 +4,7 @@ import os
 import argparse
 import numpy as np
 import matplotlib.pyplot as plt
+from transition_log import load_transition_log
 
 
 # Parse session directories
@@ -40,13 +41,13 @@ preset_trials_per_case = args.preset_num_trials
 # Parse data from session (action executed, reward values)
 # NOTE: reward_value_log just stores some value which is indicative of successful grasping, which could be a class ID (reactive) or actual reward value (from MDP, reinforcement)
 transitions_directory = os.path.join(session_directory, 'transitions')
-executed_action_log = np.loadtxt(os.path.join(transitions_directory, 'executed-action.log.txt'), delimiter=' ')
+executed_action_log = load_transition_log(transitions_directory, 'executed-action')
 max_iteration = executed_action_log.shape[0]
 executed_action_log = executed_action_log[0:max_iteration,:]
-reward_value_log = np.loadtxt(os.path.join(transitions_directory, 'reward-value.log.txt'), delimiter=' ')
-grasp_success_log = np.loadtxt(os.path.join(transitions_directory, 'grasp-success.log.txt'), delimiter=' ')
+reward_value_log = load_transition_log(transitions_directory, 'reward-value')
+grasp_success_log = load_transition_log(transitions_directory, 'grasp-success')
 reward_value_log = reward_value_log[0:max_iteration]
-clearance_log = np.loadtxt(os.path.join(transitions_directory, 'clearance.log.txt'), delimiter=' ')
+clearance_log = load_transition_log(transitions_directory, 'clearance')
 # work around a bug where the clearance steps were written twice per clearance
 clearance_log = np.unique(clearance_log)
 max_trials = len(clearance_log)
@@ -1,3 +1,7 @@
+import os
+import sys
+import json
+import hashlib
 import torch
 import numpy as np
 from spacy.tokenizer import Tokenizer 
@@ -7,6 +11,14 @@ import pdb
 np.random.seed(12) 
 torch.manual_seed(12) 
 
+# id of <UNK> in RandomEmbedder and GloveEmbedder, every word outside the vocab maps to it, including <PAD> 
+UNK_ID = 0
+
+def commands_to_ids(commands, token_to_id):
+    """ Map a padded batch of commands to a (batch, seq_len) LongTensor of embedder ids, see RandomEmbedder.token_to_id 
+    """
+    return torch.tensor([[token_to_id.get(w, UNK_ID) for w in command] for command in commands], dtype = torch.long)
+
 class RandomEmbedder(torch.nn.Module):
     def __init__(self, 
                  tokenizer: Tokenizer,
@@ -25,6 +37,8 @@ class RandomEmbedder(torch.nn.Module):
         self.word_to_idx = {word:i+2 for i, word in enumerate(vocab)}
         self.word_to_idx["<UNK>"] = 0
         self.word_to_idx["<PAD>"] = 1
+        # ids of the words in the vocab, the dataset readers use it to emit command_ids 
+        self.token_to_id = {word: self.word_to_idx[word] for word in vocab}
 
         self.embeddings = torch.nn.Embedding(len(self.vocab) + 2, embedding_dim)
         self.output_dim = embedding_dim 
@@ -34,6 +48,14 @@ class RandomEmbedder(torch.nn.Module):
         if "cuda" in str(device):
             self.embeddings = self.embeddings.cuda(self.device) 
 
+    def embed_ids(self, lookup_tensor):
+        """ Embed a tensor of ids from commands_to_ids(), e.g. the command_ids of a dataset reader batch 
+        """
+        return self.embeddings(lookup_tensor.to(self.device))
+
+    def embed_batch(self, language):
+        return self.embed_ids(commands_to_ids(language, self.token_to_id))
+
     def forward(self, words):
         words = [w if w in self.vocab else "<UNK>" for w in words]
         lookup_tensor = torch.tensor([self.word_to_idx[w] for w in words], dtype = torch.long)
@@ -41,6 +63,64 @@ class RandomEmbedder(torch.nn.Module):
         output = self.embeddings(lookup_tensor)
         return output 
 
+def glove_binary_paths(embedding_file):
+    """ Paths of the float32 matrix and vocab index convert_glove() writes next to a GloVe text file 
+    """
+    return embedding_file + ".f32.npy", embedding_file + ".vocab.json"
+
+def convert_glove(embedding_file):
+    """ Convert a GloVe text file once into a (num_words, dim) float32 .npy matrix and a json list of its words. 
+    Lines are streamed into the memory mapped matrix so the text file is never held in memory. 
+    """
+    matrix_path, vocab_path = glove_binary_paths(embedding_file)
+    print(f"converting {embedding_file} to {matrix_path}...") 
+    num_words, dim = 0, None
+    with open(embedding_file) as f1:
+        for line in f1:
+            if dim is None:
+                dim = len(line.rstrip("\n").split(" ")) - 1
+            num_words += 1
+
+    # write then rename so a concurrent run never reads a partial file, the vocab index is written last 
+    tmp_matrix_path = matrix_path + ".%d.tmp" % os.getpid()
+    matrix = np.lib.format.open_memmap(tmp_matrix_path, mode="w+", dtype=np.float32, shape=(num_words, dim))
+    words = []
+    with open(embedding_file) as f1:
+        for i, line in enumerate(f1):
+            line = line.rstrip("\n").split(" ")
+            assert(len(line) - 1 == dim)
+            words.append(line[0])
+            matrix[i] = np.array(line[1:], dtype=np.float64)
+    matrix.flush()
+    del matrix
+    os.replace(tmp_matrix_path, matrix_path)
+
+    stat = os.stat(embedding_file)
+    tmp_vocab_path = vocab_path + ".%d.tmp" % os.getpid()
+    with open(tmp_vocab_path, "w") as f1:
+        json.dump({"source_size": stat.st_size, "source_mtime": stat.st_mtime, "words": words}, f1)
+    os.replace(tmp_vocab_path, vocab_path)
+
+def load_glove(embedding_file):
+    """ Returns the memory mapped float32 GloVe matrix and a dict of word to row, converting the text file on first use. 
+    A word that appears more than once maps to its last row, like the text file overriding earlier lines. 
+    """
+    matrix_path, vocab_path = glove_binary_paths(embedding_file)
+    stat = os.stat(embedding_file)
+    index = None
+    if os.path.exists(vocab_path) and os.path.exists(matrix_path):
+        with open(vocab_path) as f1:
+            index = json.load(f1)
+        if index["source_size"] != stat.st_size or index["source_mtime"] != stat.st_mtime:
+            # the text file changed since it was converted 
+            index = None
+    if index is None:
+        convert_glove(embedding_file)
+        with open(vocab_path) as f1:
+            index = json.load(f1)
+    matrix = np.load(matrix_path, mmap_mode="r")
+    return matrix, {word: i for i, word in enumerate(index["words"])}
+
 class GloveEmbedder(torch.nn.Module):
     def __init__(self, 
                  tokenizer: Tokenizer,
@@ -53,11 +133,6 @@ class GloveEmbedder(torch.nn.Module):
         self.tokenizer = tokenizer
         self.trainable = trainable
         
-        # read embeddings from file 
-        print(f"reading embeddings...") 
-        with open(embedding_file) as f1:
-            contents = f1.readlines()
-
         # set embeddings 
         self.unk_embedding = torch.zeros((1, embedding_dim))
         self.pad_token = torch.ones((1, embedding_dim))
@@ -65,22 +140,23 @@ class GloveEmbedder(torch.nn.Module):
         self.word_to_idx = {word:i+2 for i, word in enumerate(vocab)}
         self.word_to_idx["<UNK>"] = 0
         self.word_to_idx["<PAD>"] = 1
+        # ids of the words in the vocab, the dataset readers use it to emit command_ids 
+        self.token_to_id = {word: self.word_to_idx[word] for word in vocab}
 
         self.embeddings = torch.nn.Embedding(len(self.vocab) + 2, embedding_dim)
         self.output_dim = embedding_dim 
 
         fake_weight = torch.clone(self.embeddings.weight)
 
-        for line in contents: 
-            line = line.split(" ")
-            key = line[0]
-            embeddings = [float(x) for x in line[1:]]
-            assert(len(embeddings) == embedding_dim)
-
-            if key in self.vocab:
-                # initialize with glove embedding when you can, otherwise keep random for unks 
-                key_idx = self.word_to_idx[key]
-                fake_weight[key_idx] = torch.tensor(np.array(embeddings)) 
+        # initialize with glove embedding when you can, otherwise keep random for unks 
+        matrix, glove_words = load_glove(embedding_file)
+        assert(matrix.shape[1] == embedding_dim)
+        found = [(glove_words[word], self.word_to_idx[word]) for word in self.vocab if word in glove_words]
+        if len(found) > 0:
+            # sorted rows keep the gather from the memory map sequential 
+            rows, key_idxs = zip(*sorted(found))
+            fake_weight[list(key_idxs)] = torch.from_numpy(np.asarray(matrix[list(rows)], dtype=np.float32))
+        print(f"initialized {len(found)} of {len(self.vocab)} words from {embedding_file}") 
 
         self.embeddings.load_state_dict({"weight": fake_weight}) 
         if not trainable:
@@ -93,6 +169,14 @@ class GloveEmbedder(torch.nn.Module):
         if "cuda" in str(device):
             self.embeddings = self.embeddings.cuda(self.device) 
 
+    def embed_ids(self, lookup_tensor):
+        """ Embed a tensor of ids from commands_to_ids(), e.g. the command_ids of a dataset reader batch 
+        """
+        return self.embeddings(lookup_tensor.to(self.device))
+
+    def embed_batch(self, language):
+        return self.embed_ids(commands_to_ids(language, self.token_to_id))
+
     def forward(self, words):
         words = [w if w in self.vocab else "<UNK>" for w in words]
         lookup_tensor = torch.tensor([self.word_to_idx[w] for w in words], dtype = torch.long)
@@ -100,11 +184,28 @@ class GloveEmbedder(torch.nn.Module):
         output = self.embeddings(lookup_tensor)
         return output 
 
+def embed_batch(embedder, language, command_ids = None):
+    """ Embed a batch of commands into a (batch, seq_len, output_dim) tensor, in one call if the embedder supports it. 
+    command_ids are the ids from commands_to_ids() if the dataset reader provided them. 
+    """
+    if command_ids is not None and hasattr(embedder, "embed_ids"):
+        return embedder.embed_ids(command_ids)
+    if hasattr(embedder, "embed_batch"):
+        return embedder.embed_batch(language)
+    return torch.cat([embedder(x).unsqueeze(0) for x in language], dim = 0)
+
 class BERTEmbedder(torch.nn.Module): 
     def __init__(self, 
                  model_name: str = "bert-base-uncased", 
                  max_seq_len: int = 60, 
-                 trainable: bool = False): 
+                 trainable: bool = False,
+                 cache_dir: str = None): 
+        """ Frozen BERT embeddings of commands. 
+
+        When not trainable, the output for each command is cached in memory and saved to cache_dir, keyed 
+        by the model name and token ids, so training runs and the robot share every command embedded so far. 
+        cache_dir defaults to ~/.cache/bert_embeddings, pass "" to only cache in memory. 
+        """
         super(BERTEmbedder, self).__init__()
 
         self.model_name = model_name 
@@ -115,13 +216,23 @@ class BERTEmbedder(torch.nn.Module):
         self.bert_model = BertModel.from_pretrained(self.model_name) 
         self.output_dim = 768
         self.bert_model.eval() 
+        self.device = "cpu"
+
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "bert_embeddings")
+        self.cache_dir = os.path.join(cache_dir, self.model_name.replace("/", "_")) if cache_dir else None
+        # token ids tuple -> (max_seq_len, output_dim) tensor on self.device 
+        self.cache = {}
 
     def set_device(self, device):
         self.device = device
         if "cuda" in str(device):
             self.bert_model = self.bert_model.to(device) 
+        self.cache = {k: v.to(device) for k, v in self.cache.items()}
 
-    def forward(self, words):
+    def tokenize(self, words):
+        """ Token ids of a command, truncated or padded with [PAD] to max_seq_len 
+        """
         words = [x if x != "<PAD>" else "[PAD]" for x  in words]
         text = " ".join(words)
         tokenized_text = self.tokenizer.tokenize(text)[0:self.max_seq_len ]
@@ -130,17 +241,75 @@ class BERTEmbedder(torch.nn.Module):
             pads = ["[PAD]" for i in range(self.max_seq_len - len(tokenized_text))]
             tokenized_text += pads 
 
-        indexed_tokens = self.tokenizer.convert_tokens_to_ids(tokenized_text)
-        tokens_tensor = torch.tensor([indexed_tokens]).to(self.device) 
-        
+        return tuple(self.tokenizer.convert_tokens_to_ids(tokenized_text))
+
+    def cache_path(self, indexed_tokens):
+        key = hashlib.sha1(np.asarray(indexed_tokens, dtype=np.int64).tobytes()).hexdigest()
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def load_cached(self, indexed_tokens):
+        if indexed_tokens in self.cache:
+            return self.cache[indexed_tokens]
+        if self.cache_dir is not None and os.path.exists(self.cache_path(indexed_tokens)):
+            try:
+                encoded = torch.from_numpy(np.load(self.cache_path(indexed_tokens))).to(self.device)
+            except (OSError, ValueError):
+                # a damaged file, it will be recomputed and rewritten 
+                return None
+            self.cache[indexed_tokens] = encoded
+            return encoded
+        return None
+
+    def save_cached(self, indexed_tokens, encoded):
+        self.cache[indexed_tokens] = encoded
+        if self.cache_dir is None:
+            return
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.cache_path(indexed_tokens)
+        # write then rename so a concurrent run never reads a partial file 
+        tmp_path = path + ".%d.tmp" % os.getpid()
+        with open(tmp_path, "wb") as f1:
+            np.save(f1, encoded.cpu().numpy())
+        os.replace(tmp_path, path)
+
+    def encode(self, tokens_tensor):
         if not self.trainable: 
             with torch.no_grad():
                 outputs = self.bert_model(tokens_tensor) 
         else:
             self.bert_model.train()
-            outputs = self.bert_model(tokens_tensor, token_type_ids=segments_tensors)
+            outputs = self.bert_model(tokens_tensor)
 
         # use top layer 
-        encoded_sequence = outputs[0]
+        return outputs[0]
+
+    def embed_batch(self, language):
+        """ Embed a batch of commands with one BertModel call for every command that is not cached 
+        """
+        batch_tokens = [self.tokenize(words) for words in language]
+        if self.trainable:
+            return self.encode(torch.tensor(batch_tokens).to(self.device))
+
+        encoded = [self.load_cached(indexed_tokens) for indexed_tokens in batch_tokens]
+        missing = list(set(indexed_tokens for indexed_tokens, e in zip(batch_tokens, encoded) if e is None))
+        if len(missing) > 0:
+            outputs = self.encode(torch.tensor(missing).to(self.device))
+            for indexed_tokens, output in zip(missing, outputs):
+                self.save_cached(indexed_tokens, output)
+            encoded = [self.cache[indexed_tokens] for indexed_tokens in batch_tokens]
+        return torch.stack(encoded, dim = 0)
+
+    def precompute(self, commands, batch_size = 64):
+        """ Fill the cache for a list of commands, e.g. every command a template generator can produce 
+        """
+        for i in range(0, len(commands), batch_size):
+            self.embed_batch(commands[i:i + batch_size])
+
+    def forward(self, words):
+        return self.embed_batch([words])[0]
 
-        return encoded_sequence.squeeze(0) 
+if __name__ == "__main__":
+    # one time conversion of a GloVe text file, e.g. python language_embedders.py glove/glove.840B.300d.txt 
+    for embedding_file in sys.argv[1:]:
+        convert_glove(embedding_file)
@@ -1,17 +1,97 @@
 import time
 import datetime
 import os
+import queue
+import atexit
+import threading
 import numpy as np
 import cv2
 import torch
 import glob
 import json
 import utils
+from transition_log import TransitionLog, transition_log_directory, convert_text_logs
 # import h5py
 
+
+class ImageWriter(object):
+    """ Writes images with cv2.imwrite on a background thread, fed by a bounded queue.
+
+    write() only blocks when the queue is full, so the disk can fall behind by at most max_queue_size images.
+    wait() is a barrier for reading images back, and stats() reports how far behind the disk is.
+    """
+    def __init__(self, max_queue_size=32):
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        # number of queued writes for each path that have not finished yet
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.max_queue_depth = 0
+        self.written = 0
+        self.blocked_seconds = 0.0
+        self.write_seconds = 0.0
+        self.thread = threading.Thread(target=self.run, name='ImageWriter', daemon=True)
+        self.thread.start()
+
+    def write(self, path, image):
+        """ Queue image to be written to path, image must not be modified afterwards.
+        """
+        with self.condition:
+            self.pending[path] = self.pending.get(path, 0) + 1
+        start = time.time()
+        self.queue.put((path, image))
+        self.blocked_seconds += time.time() - start
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def run(self):
+        while True:
+            path, image = self.queue.get()
+            if path is None:
+                self.queue.task_done()
+                return
+            start = time.time()
+            try:
+                if not cv2.imwrite(path, image):
+                    print('ImageWriter: cv2.imwrite() failed to write ' + path)
+            except Exception as e:
+                # any error, e.g. an image with an unsupported dtype, must not stop the thread or wait() and write() never return
+                print('ImageWriter: cv2.imwrite() failed to write ' + path + ' with error: ' + repr(e))
+            finally:
+                with self.condition:
+                    self.write_seconds += time.time() - start
+                    self.written += 1
+                    self.pending[path] -= 1
+                    if not self.pending[path]:
+                        del self.pending[path]
+                    self.condition.notify_all()
+                self.queue.task_done()
+
+    def wait(self, paths=None):
+        """ Block until the queued writes to paths are on disk, or every queued write if paths is None.
+        """
+        with self.condition:
+            if paths is None:
+                self.condition.wait_for(lambda: not self.pending)
+            else:
+                self.condition.wait_for(lambda: not any(path in self.pending for path in paths))
+
+    def stats(self):
+        with self.condition:
+            return {'queue_depth': self.queue.qsize(), 'max_queue_depth': self.max_queue_depth,
+                    'queue_size': self.queue.maxsize, 'written': self.written,
+                    'blocked_seconds': self.blocked_seconds,
+                    'mean_write_ms': self.write_seconds / max(self.written, 1) * 1000}
+
+    def close(self):
+        """ Write everything that is queued and stop the thread.
+        """
+        if self.thread.is_alive():
+            self.queue.put((None, None))
+            self.thread.join()
+
+
 class Logger():
 
-    def __init__(self, continue_logging, logging_directory, args=None, dir_name=''):
+    def __init__(self, continue_logging, logging_directory, args=None, dir_name='', text_logs=False, async_images=False, image_queue_size=32):
 
         # Create directory to save data
         self.continue_logging = continue_logging
@@ -52,6 +132,20 @@ class Logger():
         if not os.path.exists(self.transitions_directory):
             os.makedirs(os.path.join(self.transitions_directory, 'data'))
 
+        # transition logs are appended to a binary log, text_logs also rewrites the old .txt and .csv files on every write
+        self.text_logs = text_logs
+        if self.continue_logging and not TransitionLog.exists(transition_log_directory(self.transitions_directory)):
+            print('Converting text transition logs to a binary transition log in: ' + transition_log_directory(self.transitions_directory))
+            self.transition_log = convert_text_logs(self.transitions_directory)
+        else:
+            self.transition_log = TransitionLog(transition_log_directory(self.transitions_directory))
+
+        # async_images writes every image and visualization on a background thread, see flush_images()
+        self.image_writer = None
+        if async_images:
+            self.image_writer = ImageWriter(image_queue_size)
+            atexit.register(self.image_writer.close)
+
         if args is not None:
             params_path = os.path.join(self.base_directory, 'commandline_args.json')
             with open(params_path, 'w') as f:
@@ -66,11 +160,32 @@ class Logger():
         np.savetxt(os.path.join(self.info_directory, 'heightmap-boundaries.txt'), boundaries, delimiter=' ')
         np.savetxt(os.path.join(self.info_directory, 'heightmap-resolution.txt'), [resolution], delimiter=' ')
 
+    def imwrite(self, path, image):
+        """ cv2.imwrite(), on the background thread if async_images is enabled.
+        """
+        if self.image_writer is None:
+            cv2.imwrite(path, image)
+        else:
+            self.image_writer.write(path, image)
+
+    def flush_images(self, paths=None):
+        """ Barrier to call before reading images back, waits for queued writes to paths, or all writes if paths is None.
+        """
+        if self.image_writer is not None:
+            self.image_writer.wait(paths)
+
+    def image_queue_stats(self):
+        """ Returns a dict of background image writer queue metrics, or None if async_images is disabled.
+        """
+        if self.image_writer is None:
+            return None
+        return self.image_writer.stats()
+
     def save_images(self, iteration, color_image, depth_image, mode):
         color_image = cv2.cvtColor(color_image, cv2.COLOR_RGB2BGR)
-        cv2.imwrite(os.path.join(self.color_images_directory, '%06d.%s.color.png' % (iteration, mode)), color_image)
+        self.imwrite(os.path.join(self.color_images_directory, '%06d.%s.color.png' % (iteration, mode)), color_image)
         depth_image = np.round(depth_image * 10000).astype(np.uint16) # Save depth in 1e-4 meters
-        cv2.imwrite(os.path.join(self.depth_images_directory, '%06d.%s.depth.png' % (iteration, mode)), depth_image)
+        self.imwrite(os.path.join(self.depth_images_directory, '%06d.%s.depth.png' % (iteration, mode)), depth_image)
 
     def save_heightmaps(self, iteration, color_heightmap, depth_heightmap, mode, poststring=None, debug=False):
         color_heightmap = cv2.cvtColor(color_heightmap, cv2.COLOR_RGB2BGR)
@@ -86,14 +201,15 @@ class Logger():
             depth_filename = '%06d.%s.depth.png' % (iteration, mode)
 
         # save color
-        cv2.imwrite(os.path.join(self.color_heightmaps_directory, color_filename), color_heightmap)
+        self.imwrite(os.path.join(self.color_heightmaps_directory, color_filename), color_heightmap)
 
         # save depth
         depth_heightmap = np.round(depth_heightmap * 100000).astype(np.uint16) # Save depth in 1e-5 meters
         depth_heightmap_path = os.path.join(self.depth_heightmaps_directory, depth_filename)
-        cv2.imwrite(depth_heightmap_path, depth_heightmap)
+        self.imwrite(depth_heightmap_path, depth_heightmap)
 
         if debug:
+            self.flush_images([depth_heightmap_path])
             converted_depth_heightmap = depth_heightmap.astype(np.float32) / 100000
             saved_reloaded_depth_heightmap = np.array(cv2.imread(depth_heightmap_path, cv2.IMREAD_ANYDEPTH)).astype(np.float32) / 100000
             import matplotlib.pyplot as plt
@@ -112,10 +228,16 @@ class Logger():
         if pickle:
             np.savez(os.path.join(self.transitions_directory, '%s.log.txt' % log_name), log)
         else:
-            np.savetxt(os.path.join(self.transitions_directory, '%s.log.txt' % log_name), log, delimiter=' ')
-            shortlog = np.squeeze(log)
-            if len(shortlog.shape) > 0:
-                np.savetxt(os.path.join(self.transitions_directory, '%s.log.csv' % log_name), shortlog, delimiter=', ', header=log_name)
+            self.transition_log.write(log_name, log)
+            if self.text_logs:
+                np.savetxt(os.path.join(self.transitions_directory, '%s.log.txt' % log_name), log, delimiter=' ')
+                shortlog = np.squeeze(log)
+                if len(shortlog.shape) > 0:
+                    np.savetxt(os.path.join(self.transitions_directory, '%s.log.csv' % log_name), shortlog, delimiter=', ', header=log_name)
+
+    def mark_log_row_changed(self, log_name, row):
+        # the transition log only appends new rows of a list log, so rows replaced in place must be marked
+        self.transition_log.mark_changed(log_name, row)
 
     def save_model(self, model, name):
         torch.save(model.state_dict(), os.path.join(self.models_directory, 'snapshot.%s.pth' % (name)))
@@ -124,7 +246,8 @@ class Logger():
         torch.save(model.state_dict(), os.path.join(self.models_directory, 'snapshot-backup.%s.pth' % (name)))
 
     def save_visualizations(self, iteration, affordance_vis, name):
-        cv2.imwrite(os.path.join(self.visualizations_directory, '%06d.%s.png' % (iteration,name)), affordance_vis)
+        # copy because the caller may reuse the array while it waits in the queue
+        self.imwrite(os.path.join(self.visualizations_directory, '%06d.%s.png' % (iteration,name)), np.array(affordance_vis))
 
     # def save_state_features(self, iteration, state_feat):
     #     h5f = h5py.File(os.path.join(self.visualizations_directory, '%06d.state.h5' % (iteration)), 'w')
@@ -143,8 +266,8 @@ class Logger():
 
     def save_transition(self, iteration, transition):
         depth_heightmap = np.round(transition.state * 100000).astype(np.uint16) # Save depth in 1e-5 meters
-        cv2.imwrite(os.path.join(self.transitions_directory, 'data', '%06d.0.depth.png' % (iteration)), depth_heightmap)
+        self.imwrite(os.path.join(self.transitions_directory, 'data', '%06d.0.depth.png' % (iteration)), depth_heightmap)
         next_depth_heightmap = np.round(transition.next_state * 100000).astype(np.uint16) # Save depth in 1e-5 meters
-        cv2.imwrite(os.path.join(self.transitions_directory, 'data', '%06d.1.depth.png' % (iteration)), next_depth_heightmap)
+        self.imwrite(os.path.join(self.transitions_directory, 'data', '%06d.1.depth.png' % (iteration)), next_depth_heightmap)
         # np.savetxt(os.path.join(self.transitions_directory, '%06d.action.txt' % (iteration)), [1 if (transition.action == 'grasp') else 0], delimiter=' ')
         # np.savetxt(os.path.join(self.transitions_directory, '%06d.reward.txt' % (iteration)), [reward_value], delimiter=' ')
@@ -15,8 +15,10 @@ import scipy as sc
 import cv2
 from collections import namedtuple
 from robot import Robot
+from block_world import BlockWorldRobot
 from trainer import Trainer
 from logger import Logger
+from transition_log import load_transition_log
 import utils
 from utils import ACTION_TO_ID
 from utils import ID_TO_ACTION
@@ -43,7 +45,7 @@ def run_title(args):
     title, dirname
     """
     title = ''
-    title += 'Sim ' if args.is_sim else 'Real '
+    title += 'Sim ' if args.is_sim or args.block_world else 'Real '
 
     if args.task_type is not None:
         if args.task_type == 'vertical_square':
@@ -93,7 +95,7 @@ def main(args):
 
     num_problems_detected = 0
     # --------------- Setup options ---------------
-    is_sim = args.is_sim # Run in simulation?
+    is_sim = args.is_sim or args.block_world # Run in simulation?
     obj_mesh_dir = os.path.abspath(args.obj_mesh_dir) if is_sim else None # Directory containing 3D mesh files (.obj) of objects to be added to simulation
     num_obj = args.num_obj if is_sim or args.check_row else None # Number of objects to add to simulation
     goal_num_obj = args.goal_num_obj
@@ -151,6 +153,8 @@ def main(args):
     transfer_grasp_to_place = args.transfer_grasp_to_place
     neural_network_name = args.nn
     num_dilation = args.num_dilation
+    feature_cache_size = args.feature_cache_size
+    replay_sampling = args.replay_sampling
     disable_situation_removal = args.disable_situation_removal
     evaluate_random_objects = args.evaluate_random_objects
     skip_noncontact_actions = args.skip_noncontact_actions
@@ -182,6 +186,7 @@ def main(args):
     primitive_distance_method = args.primitive_distance_method
     cycle_consistency = args.cycle_consistency
     depth_channels_history = args.depth_channels_history
+    prefetch_camera_data = args.prefetch_camera_data
 
     # NOTE(adit98) HACK, make sure we set task_type to 'unstack' and not 'unstacking'
     if task_type is not None and 'unstack' in args.task_type:
@@ -250,12 +255,16 @@ def main(args):
 
     # Initialize pick-and-place system (camera and robot)
     # TODO(zhe) modify the None here to ensure that the test_preset_arr option is set correctly
-    robot = Robot(is_sim, obj_mesh_dir, num_obj, workspace_limits,
-                  tcp_host_ip, tcp_port, rtc_host_ip, rtc_port,
-                  is_testing, test_preset_cases, test_preset_file, None,
-                  place, grasp_color_task, unstack=unstack,
-                  heightmap_resolution=heightmap_resolution, randomized=randomized, obj_scale=obj_scale, task_type=task_type,
-                  language=static_language_mask)
+    if args.block_world:
+        robot = BlockWorldRobot(num_obj, workspace_limits, is_testing, None, place, grasp_color_task, unstack=unstack,
+                                heightmap_resolution=heightmap_resolution, task_type=task_type, language=static_language_mask)
+    else:
+        robot = Robot(is_sim, obj_mesh_dir, num_obj, workspace_limits,
+                      tcp_host_ip, tcp_port, rtc_host_ip, rtc_port,
+                      is_testing, test_preset_cases, test_preset_file, None,
+                      place, grasp_color_task, unstack=unstack,
+                      heightmap_resolution=heightmap_resolution, randomized=randomized, obj_scale=obj_scale, task_type=task_type,
+                      language=static_language_mask)
 
     # Set the "common sense" dynamic action space region around objects,
     # which defines where place actions are permitted. Units are in meters.
@@ -282,7 +291,8 @@ def main(args):
                               place_common_sense=place_common_sense, show_heightmap=show_heightmap,
                               place_dilation=stack_place_dilation, common_sense_backprop=common_sense_backprop,
                               trial_reward='discounted' if discounted_reward else 'spot',
-                              num_dilation=num_dilation)
+                              num_dilation=num_dilation, feature_cache_size=feature_cache_size,
+                              replay_sampling=replay_sampling)
 
         if 'row' in multi_task_snapshot_files:
             row_trainer = Trainer(method, push_rewards, future_reward_discount,
@@ -292,7 +302,8 @@ def main(args):
                               place_common_sense=place_common_sense, show_heightmap=show_heightmap,
                               place_dilation=place_dilation, common_sense_backprop=common_sense_backprop,
                               trial_reward='discounted' if discounted_reward else 'spot',
-                              num_dilation=num_dilation)
+                              num_dilation=num_dilation, feature_cache_size=feature_cache_size,
+                              replay_sampling=replay_sampling)
 
         if 'unstack' in multi_task_snapshot_files:
             unstack_trainer = Trainer(method, push_rewards, future_reward_discount,
@@ -302,7 +313,8 @@ def main(args):
                               place_common_sense=place_common_sense, show_heightmap=show_heightmap,
                               place_dilation=place_dilation, common_sense_backprop=common_sense_backprop,
                               trial_reward='discounted' if discounted_reward else 'spot',
-                              num_dilation=num_dilation)
+                              num_dilation=num_dilation, feature_cache_size=feature_cache_size,
+                              replay_sampling=replay_sampling)
 
         if 'vertical_square' in multi_task_snapshot_files:
             vertical_square_trainer = Trainer(method, push_rewards, future_reward_discount,
@@ -312,7 +324,8 @@ def main(args):
                               place_common_sense=place_common_sense, show_heightmap=show_heightmap,
                               place_dilation=place_dilation, common_sense_backprop=common_sense_backprop,
                               trial_reward='discounted' if discounted_reward else 'spot',
-                              num_dilation=num_dilation)
+                              num_dilation=num_dilation, feature_cache_size=feature_cache_size,
+                              replay_sampling=replay_sampling)
 
         # set trainer reference to stack_trainer to get metadata (e.g. iteration)
         trainer = stack_trainer
@@ -325,15 +338,19 @@ def main(args):
                           place_common_sense=place_common_sense, show_heightmap=show_heightmap,
                           place_dilation=place_dilation, common_sense_backprop=common_sense_backprop,
                           trial_reward='discounted' if discounted_reward else 'spot',
-                          num_dilation=num_dilation, static_language_mask=static_language_mask, check_row = check_row, baseline_language_mask = baseline_language_mask) 
+                          num_dilation=num_dilation, static_language_mask=static_language_mask, check_row = check_row, baseline_language_mask = baseline_language_mask,
+                          feature_cache_size=feature_cache_size,
+                          replay_sampling=replay_sampling)
 
     if transfer_grasp_to_place:
         # Transfer pretrained grasp weights to the place action.
         trainer.model.transfer_grasp_to_place()
+        trainer.model_updated()
 
     # Initialize data logger
     title, dir_name = run_title(args)
-    logger = Logger(continue_logging, logging_directory, args=args, dir_name=dir_name)
+    logger = Logger(continue_logging, logging_directory, args=args, dir_name=dir_name, text_logs=args.text_logs,
+                    async_images=args.async_images, image_queue_size=args.image_queue_size)
     logger.save_camera_info(robot.cam_intrinsics, robot.cam_pose, robot.cam_depth_scale) # Save camera intrinsics and pose
     logger.save_heightmap_info(workspace_limits, heightmap_resolution) # Save heightmap parameters
 
@@ -1260,6 +1277,10 @@ def main(args):
                             '  stack_successes: ' + str(stack_count) + ' trial_success_rate: ' + str(trial_rate) + ' stack goal: ' + str(current_stack_goal) +
                             ' current_height: ' + str(nonlocal_variables['stack_height']))
 
+                if prefetch_camera_data:
+                    # capture the next observation in the background while the training thread runs,
+                    # it is discarded if anything moves before the training thread asks for it
+                    robot.request_camera_data(return_heightmaps=True)
                 # NOTE(zhe) process action loop now stalls after setting executing_action to False
                 nonlocal_variables['executing_action'] = False
 
@@ -1723,7 +1744,8 @@ def main(args):
 
                 push_predictions, grasp_predictions, place_predictions, state_feat, output_prob = \
                         trainer.forward(color_heightmap, valid_depth_heightmap,
-                                is_volatile=True, goal_condition=goal_condition, language_output=language_output)
+                                is_volatile=True, goal_condition=goal_condition, language_output=language_output,
+                                cache_iteration=trainer.iteration)
 
                 # min of 5 active pixels or we kill the sim
                 # if np.sum(1-grasp_predictions.mask) < 5:
@@ -1764,7 +1786,7 @@ def main(args):
                 prev_primitive_action, prev_push_success, prev_grasp_success, change_detected,
                 prev_push_predictions, prev_grasp_predictions, color_heightmap, valid_depth_heightmap,
                 prev_color_success, goal_condition=prev_goal_condition, prev_place_predictions=prev_place_predictions,
-                place_success=prev_partial_stack_success, reward_multiplier=reward_multiplier)
+                place_success=prev_partial_stack_success, reward_multiplier=reward_multiplier, next_iteration=trainer.iteration)
             # label_value is also known as expected_reward in trainer.get_label_value(), this is what the nn predicts.
             trainer.label_value_log.append([label_value])
             logger.write_to_log('label-value', trainer.label_value_log)
@@ -2057,6 +2079,11 @@ def main(args):
 
         iteration_time_1 = time.time()
         print('Time elapsed: %f' % (iteration_time_1-iteration_time_0))
+        image_queue_stats = logger.image_queue_stats()
+        if image_queue_stats is not None:
+            print('Image writer queue depth: %d of %d, max depth: %d, images written: %d, mean write: %.1f ms, main loop blocked on a full queue: %.2f s' % (
+                image_queue_stats['queue_depth'], image_queue_stats['queue_size'], image_queue_stats['max_queue_depth'],
+                image_queue_stats['written'], image_queue_stats['mean_write_ms'], image_queue_stats['blocked_seconds']))
 
         print('Trainer iteration: %d complete' % int(trainer.iteration))
         if use_demo:
@@ -2073,6 +2100,7 @@ def main(args):
             trainer.iteration += 1
 
     nonlocal_pause['process_actions_exit_called'] = True
+    logger.flush_images()
     # Save the final plot when the run has completed cleanly, plus specifically handle preset cases
     best_dict, prev_best_dict, current_dict = save_plot(trainer, plot_window, is_testing, num_trials,
             best_dict, logger, title, place, prev_best_dict, preset_files, task_type=task_type)
@@ -2220,50 +2248,65 @@ def experience_replay(method, prev_primitive_action, prev_reward_value, trainer,
     else:
         trial_reward = False
         log_len = trainer.iteration
-    # executed_action_log includes the action, push grasp or place, and the best pixel index
-    actions = np.asarray(trainer.executed_action_log)[1:log_len, 0]
-
-    # Get samples of the same primitive but with different success results
-    if np.random.random(1) < all_history_prob:
-        # Sample all of history every one out of n times.
-        sample_ind = np.arange(1, log_len-1).reshape(log_len-2, 1)
+    if method == 'reinforcement':
+        # the trainer keeps the surprise values sorted per action and success class, so sampling is O(log N)
+        trainer.sync_replay(trial_reward, log_len)
+        # Get samples of the same primitive but with different success results
+        if np.random.random(1) < all_history_prob:
+            # Sample all of history every one out of n times.
+            sample_key = trainer.replay.ALL
+        else:
+            # Sample from the current specific action
+            if sample_primitive_action not in ['push', 'grasp', 'place']:
+                raise NotImplementedError('ERROR: ' + sample_primitive_action + ' action is not yet supported in experience replay')
+            sample_key = trainer.replay_key(sample_primitive_action_id, train_on_successful_experience)
+
+        if trainer.replay.class_size(sample_key) == 0 and (trial_reward or prev_reward_value is not None) and log_len > 2:
+            print('Experience Replay: We do not have samples for the ' + sample_primitive_action + ' action with a success state of ' + str(train_on_successful_experience) + ', so sampling from the whole history.')
+            sample_key = trainer.replay.ALL
+        sample_iteration, sample_surprise_value = trainer.replay.sample(sample_key)
     else:
-        # Sample from the current specific action
-        if sample_primitive_action == 'push':
-            # sample_primitive_action_id = 0
-            log_to_compare = np.asarray(trainer.change_detected_log)
-        elif sample_primitive_action == 'grasp':
-            # sample_primitive_action_id = 1
-            log_to_compare = np.asarray(trainer.grasp_success_log)
-        elif sample_primitive_action == 'place':
-            log_to_compare = np.asarray(trainer.partial_stack_success_log)
+        # executed_action_log includes the action, push grasp or place, and the best pixel index
+        actions = np.asarray(trainer.executed_action_log)[1:log_len, 0]
+
+        # Get samples of the same primitive but with different success results
+        if np.random.random(1) < all_history_prob:
+            # Sample all of history every one out of n times.
+            sample_ind = np.arange(1, log_len-1).reshape(log_len-2, 1)
         else:
-            raise NotImplementedError('ERROR: ' + sample_primitive_action + ' action is not yet supported in experience replay')
+            # Sample from the current specific action
+            if sample_primitive_action == 'push':
+                # sample_primitive_action_id = 0
+                log_to_compare = np.asarray(trainer.change_detected_log)
+            elif sample_primitive_action == 'grasp':
+                # sample_primitive_action_id = 1
+                log_to_compare = np.asarray(trainer.grasp_success_log)
+            elif sample_primitive_action == 'place':
+                log_to_compare = np.asarray(trainer.partial_stack_success_log)
+            else:
+                raise NotImplementedError('ERROR: ' + sample_primitive_action + ' action is not yet supported in experience replay')
 
-        sample_ind = np.argwhere(np.logical_and(log_to_compare[1:log_len, 0] == train_on_successful_experience,
-                                                actions == sample_primitive_action_id))
+            sample_ind = np.argwhere(np.logical_and(log_to_compare[1:log_len, 0] == train_on_successful_experience,
+                                                    actions == sample_primitive_action_id))
 
-    if sample_ind.size == 0 and (trial_reward or prev_reward_value is not None) and log_len > 2:
-        print('Experience Replay: We do not have samples for the ' + sample_primitive_action + ' action with a success state of ' + str(train_on_successful_experience) + ', so sampling from the whole history.')
-        sample_ind = np.arange(1, log_len-1).reshape(log_len-2, 1)
+        if sample_ind.size == 0 and (trial_reward or prev_reward_value is not None) and log_len > 2:
+            print('Experience Replay: We do not have samples for the ' + sample_primitive_action + ' action with a success state of ' + str(train_on_successful_experience) + ', so sampling from the whole history.')
+            sample_ind = np.arange(1, log_len-1).reshape(log_len-2, 1)
 
-    if sample_ind.size > 0:
-        # Find sample with highest surprise value
-        if method == 'reactive':
+        sample_iteration = None
+        if sample_ind.size > 0:
+            # Find sample with highest surprise value
             # TODO(ahundt) BUG what to do with prev_reward_value? (formerly named sample_reward_value in previous commits)
             sample_surprise_values = np.abs(np.asarray(trainer.predicted_value_log)[sample_ind[:, 0]] - (1 - prev_reward_value))
-        elif method == 'reinforcement':
-            if trial_reward:
-                sample_surprise_values = np.abs(np.asarray(trainer.predicted_value_log)[sample_ind[:, 0]] - np.asarray(trainer.trial_reward_value_log)[sample_ind[:,0]])
-            else:
-                sample_surprise_values = np.abs(np.asarray(trainer.predicted_value_log)[sample_ind[:, 0]] - np.asarray(trainer.label_value_log)[sample_ind[:,0]])
-        sorted_surprise_ind = np.argsort(sample_surprise_values[:, 0])
-        sorted_sample_ind = sample_ind[sorted_surprise_ind, 0]
-        pow_law_exp = 2
-        rand_sample_ind = int(np.round(np.random.power(pow_law_exp, 1)*(sample_ind.size-1)))
-        # sample_iteration is the actual time step on which we will run experience replay
-        sample_iteration = sorted_sample_ind[rand_sample_ind]
-
+            sorted_surprise_ind = np.argsort(sample_surprise_values[:, 0])
+            sorted_sample_ind = sample_ind[sorted_surprise_ind, 0]
+            pow_law_exp = 2
+            rand_sample_ind = int(np.round(np.random.power(pow_law_exp, 1)*(sample_ind.size-1)))
+            # sample_iteration is the actual time step on which we will run experience replay
+            sample_iteration = sorted_sample_ind[rand_sample_ind]
+            sample_surprise_value = sample_surprise_values[sorted_surprise_ind[rand_sample_ind], 0]
+
+    if sample_iteration is not None:
         nonlocal_variables['replay_iteration'] += 1
         # Load the data from disk, and run a forward pass with the current model
         [sample_stack_height, sample_primitive_action_id, sample_grasp_success,
@@ -2273,7 +2316,7 @@ def experience_replay(method, prev_primitive_action, prev_reward_value, trainer,
          sample_depth_heightmap] = trainer.load_sample(sample_iteration, logger, depth_channels_history=args.depth_channels_history)
 
         sample_primitive_action = ID_TO_ACTION[sample_primitive_action_id]
-        print('Experience replay %d: history timestep index %d, action: %s, surprise value: %f' % (nonlocal_variables['replay_iteration'], sample_iteration, str(sample_primitive_action), sample_surprise_values[sorted_surprise_ind[rand_sample_ind]]))
+        print('Experience replay %d: history timestep index %d, action: %s, surprise value: %f' % (nonlocal_variables['replay_iteration'], sample_iteration, str(sample_primitive_action), sample_surprise_value))
         # sample_push_success is always true in the current version, because it only checks if the push action run, not if something was actually pushed, that is handled by change_detected.
         sample_push_success = True
         # TODO(ahundt) deleteme if this has been working for a while, sample reward value isn't actually used for anything...
@@ -2317,9 +2360,12 @@ def experience_replay(method, prev_primitive_action, prev_reward_value, trainer,
         elif sample_primitive_action == 'place':
             trainer.predicted_value_log[sample_iteration] = [np.ma.max(sample_place_predictions)]
             # trainer.predicted_value_log[sample_iteration] = [sample_place_predictions[sample_best_pix_ind[0], sample_best_pix_ind[1], sample_best_pix_ind[2]]]
+        logger.mark_log_row_changed('predicted-value', sample_iteration)
 
         if update_label_value_log:
             trainer.label_value_log[sample_iteration] = [new_sample_label_value]
+            logger.mark_log_row_changed('label-value', sample_iteration)
+        trainer.update_replay_priority(sample_iteration)
 
     else:
         # print('Experience Replay: 0 prior training samples. Skipping experience replay.')
@@ -2381,8 +2427,7 @@ def check_training_complete(args):
     iteration = 0
     if continue_logging:
         transitions_directory = os.path.join(logging_directory, 'transitions')
-        kwargs = {'delimiter': ' ', 'ndmin': 2}
-        iteration = int(np.loadtxt(os.path.join(transitions_directory, 'iteration.log.txt'), **kwargs)[0, 0])
+        iteration = int(load_transition_log(transitions_directory, 'iteration', ndmin=2)[0, 0])
         max_iter_complete = args.max_train_actions is None and (args.max_iter > 0 and iteration > args.max_iter)
         max_train_actions_complete = args.max_train_actions is not None and iteration > args.max_train_actions
         training_complete = max_iter_complete or max_train_actions_complete
@@ -2516,6 +2561,7 @@ if __name__ == '__main__':
 
     # --------------- Setup options ---------------
     parser.add_argument('--is_sim', dest='is_sim', action='store_true', default=False,                                    help='run in simulation?')
+    parser.add_argument('--block_world', dest='block_world', action='store_true', default=False,                          help='simulate with the in-process kinematic block world in block_world.py instead of V-REP, implies --is_sim. No physics, but thousands of trials per hour on a cpu.')
     parser.add_argument('--obj_mesh_dir', dest='obj_mesh_dir', action='store', default='objects/blocks',                  help='directory containing 3D mesh files (.obj) of objects to be added to simulation')
     parser.add_argument('--num_obj', dest='num_obj', type=int, action='store', default=10,                                help='number of objects to add to simulation')
     parser.add_argument('--num_extra_obj', dest='num_extra_obj', type=int, action='store', default=0,                     help='number of secondary objects, like distractors, to add to simulation')
@@ -2562,6 +2608,7 @@ if __name__ == '__main__':
     parser.add_argument('--no_common_sense_backprop', dest='no_common_sense_backprop', action='store_true', default=False,                        help='Disables backprop on masked actions, to evaluate SPOT-Q RL algorithm.')
     parser.add_argument('--random_actions', dest='random_actions', action='store_true', default=False,                              help='By default we select both the action type randomly, like push or place, enabling random_actions will ensure the action x, y, theta is also selected randomly from the allowed regions.')
     parser.add_argument('--depth_channels_history', dest='depth_channels_history', action='store_true', default=False, help='Use 2 steps of history instead of replicating depth values 3 times during training/testing')
+    parser.add_argument('--prefetch_camera_data', dest='prefetch_camera_data', action='store_true', default=False, help='Return home and capture the next RGB-D image and heightmaps in the background as soon as an action finishes, overlapping with the training step. Frames are discarded if anything moves in between.')
     parser.add_argument('--use_demo', dest='use_demo', action='store_true', default=False, help='Use demonstration to chose action')
     parser.add_argument('--task_type', dest='task_type', type=str, default=None)
     parser.add_argument('--primitive_distance_method', dest='primitive_distance_method', type=str, default='l2')
@@ -2600,7 +2647,12 @@ if __name__ == '__main__':
     parser.add_argument('--unstack_snapshot_file', dest='unstack_snapshot_file', action='store', default='',              help='multi model unstack making snapshot file to load for the model (use --snapshot_file if you are training one model)')
     parser.add_argument('--nn', dest='nn', action='store', default='densenet',                                            help='Neural network architecture choice, options are efficientnet, densenet')
     parser.add_argument('--num_dilation', dest='num_dilation', type=int, action='store', default=0,                       help='Number of dilations to apply to efficientnet, each increment doubles output resolution and increases computational expense.')
+    parser.add_argument('--feature_cache_size', dest='feature_cache_size', type=int, action='store', default=2,            help='Number of forward passes to keep so they can be reused until the next weight update, each holds every rotation of the intermediate features. 0 disables the cache.')
+    parser.add_argument('--replay_sampling', dest='replay_sampling', type=str, action='store', default='rank', choices=['rank', 'proportional'], help='Experience replay prioritization, rank samples with a power law over the surprise rank, proportional samples proportional to surprise ** 0.6.')
     parser.add_argument('--resume', dest='resume', nargs='?', default=None, const='last',                                 help='resume a previous run. If no run specified, resumes the most recent')
+    parser.add_argument('--text_logs', dest='text_logs', action='store_true', default=False,                              help='Also rewrite the transition logs as .log.txt and .log.csv text files on every update, slow for long runs. The binary log can be exported with transition_log.py --to_text instead.')
+    parser.add_argument('--async_images', dest='async_images', action='store_true', default=False,                        help='Write images, heightmaps and visualizations on a background thread so the robot loop does not wait for the disk.')
+    parser.add_argument('--image_queue_size', dest='image_queue_size', type=int, action='store', default=32,            help='Maximum number of images waiting to be written with --async_images before saving blocks.')
     parser.add_argument('--save_visualizations', dest='save_visualizations', action='store_true', default=False,          help='save visualizations of FCN predictions? Costs about 0.6 seconds per action.')
     parser.add_argument('--plot_window', dest='plot_window', type=int, action='store', default=500,                       help='Size of action time window to use when plotting current training progress. The testing mode window is set automatically.')
     parser.add_argument('--demo_path', dest='demo_path', type=str, default=None)
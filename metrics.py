@@ -9,23 +9,52 @@ np.set_printoptions(linewidth=400, edgeitems=400)
 np.random.seed(12) 
 torch.manual_seed(12) 
 
+def sync_scores(score_dicts):
+    """
+    convert the tensor scores in a list of score dicts to python floats with a single device sync, 
+    so validation can keep its metrics on device until the end of the epoch 
+    """
+    keys = [(i, k) for i, score_dict in enumerate(score_dicts) for k, v in score_dict.items() if torch.is_tensor(v)]
+    synced = [dict(score_dict) for score_dict in score_dicts]
+    if len(keys) == 0:
+        return synced
+    device = score_dicts[keys[0][0]][keys[0][1]].device
+    values = torch.stack([score_dicts[i][k].detach().reshape(()).float().to(device) for i, k in keys]).tolist() 
+    for (i, k), v in zip(keys, values):
+        synced[i][k] = v
+    return synced
+
+def column_major_argmax(images):
+    """
+    (rows, cols) of the max pixel of each image in a (b, w, h) batch. Ties go to the first column and then the first row, 
+    like the nested torch.max over rows and columns the per-example metrics use 
+    """
+    b, w, h = images.shape
+    idxs = torch.argmax(images.transpose(1, 2).reshape(b, -1), dim=1)
+    return idxs % w, idxs // w
+
+def slice_bounds(starts, length, size):
+    """
+    bounds of the python slice starts:starts+length along an axis of a given size, including negative starts 
+    """
+    ends = starts + length
+    starts = torch.where(starts < 0, (starts + size).clamp(min=0), starts.clamp(max=size))
+    ends = torch.where(ends < 0, (ends + size).clamp(min=0), ends.clamp(max=size))
+    return starts, ends
+
 
 class MSEMetric():
     def __call__(self, true, pred):
-        total = 0
-        total_mse = 0 
-        true = true.reshape(-1).detach().cpu().numpy()
-        pred = pred.reshape(-1).detach().cpu().numpy() 
+        pred = pred.reshape(-1).detach().float() 
+        true = true.reshape(-1).detach().to(pred.device).float() 
         mse_val = (true - pred)**2
-        mse_avg = np.mean(mse_val) 
-        return mse_avg
+        return torch.mean(mse_val) 
 
 class AccuracyMetric():
     def __call__(self, true, pred):
-        pred_idxs = torch.argmax(pred, dim = 2).detach().cpu() 
-        tp = torch.eq(true, pred_idxs) 
-        tp = tp.detach().cpu().numpy()
-        return np.mean(tp) 
+        pred_idxs = torch.argmax(pred, dim = 2).detach() 
+        tp = torch.eq(true.to(pred_idxs.device), pred_idxs) 
+        return torch.mean(tp.float()) 
 
 class EuclideanMetric:
     def __init__(self, 
@@ -48,11 +77,30 @@ class EuclideanMetric:
         # should never happen 
         return (self.block_size/2, self.block_size/2) 
 
+    def get_block_centers(self, block_images):
+        """
+        batched get_block_center over (b, w, h) one-hot images, returns (b, 2) centers 
+        """
+        b, w, h = block_images.shape
+        flat = block_images.reshape(b, -1) 
+        # first pixel in row-major order is the top left corner 
+        idxs = torch.argmax(flat.int(), dim=1)
+        corners = torch.stack([idxs // h, idxs % h], dim=1) 
+        corners = corners * flat.any(dim=1, keepdim=True) 
+        return corners.float() + self.block_size/2
+
 class F1Metric:
     def __init__(self, mask=False):
         self.mask = mask
 
     def compute_f1(self, true_pos, pred_pos):
+        precision, recall, f1 = torch.stack(self.compute_f1_tensors(true_pos, pred_pos)).tolist() 
+        return precision, recall, f1
+
+    def compute_f1_tensors(self, true_pos, pred_pos):
+        """
+        compute_f1 without leaving the device, returns 0-d tensors 
+        """
         eps = 1e-8
         values, pred_pixels = torch.max(pred_pos, dim=1) 
 
@@ -72,14 +120,12 @@ class F1Metric:
             zero_mask = zero_mask.reshape(pred_pixels.shape)
             pred_pixels[zero_mask] = 0 
 
-        pred_pixels = pred_pixels.detach().cpu().float() 
-        gold_pixels = gold_pixels.detach().cpu().float() 
+        pred_pixels = pred_pixels.detach().float() 
+        gold_pixels = gold_pixels.detach().to(pred_pixels.device).float() 
 
-        total_pixels = sum(pred_pixels.shape) 
-        true_pos = torch.sum(pred_pixels * gold_pixels).item() 
-        true_neg = torch.sum((1-pred_pixels) * (1 - gold_pixels)).item() 
-        false_pos = torch.sum(pred_pixels * (1 - gold_pixels)).item() 
-        false_neg = torch.sum((1-pred_pixels) * gold_pixels).item() 
+        true_pos = torch.sum(pred_pixels * gold_pixels) 
+        false_pos = torch.sum(pred_pixels * (1 - gold_pixels)) 
+        false_neg = torch.sum((1-pred_pixels) * gold_pixels) 
         precision = true_pos / (true_pos + false_pos + eps)
         recall = true_pos / (true_pos + false_neg + eps) 
         f1 = 2 * (precision * recall) / (precision + recall + eps)
@@ -232,6 +278,90 @@ class TransformerTeleportationMetric(TeleportationMetric):
 
         return to_ret 
 
+    def select_prev_blocks(self, true_prev_images, pred_prev_images):
+        """
+        batched select_prev_block over (b, w, h) block ids and (b, c, w, h) predictions, returns (b,) block ids 
+        """
+        b, c = pred_prev_images.shape[0:2]
+        if c == 2:
+            pred_prev_images = F.softmax(pred_prev_images, dim=1)[:,1]
+        elif c == 1:
+            pred_prev_images = pred_prev_images[:,0]
+        else:
+            raise AssertionError(f"Wrong number of channels: expected 1 or 2, got {c}") 
+        # overlap 
+        pred_prev_images = pred_prev_images * (true_prev_images != 0).float() 
+        rows, cols = column_major_argmax(pred_prev_images) 
+        return true_prev_images[torch.arange(b, device=rows.device), rows, cols]
+
+    def select_next_locations(self, pred_patches):
+        """
+        batched select_next_location over (b, n, c, 1) patch predictions, returns (b, 2) centers and corners 
+        """
+        b, n, c = pred_patches.shape[0:3]
+        if c == 2: 
+            pred_patches = pred_patches[:,:,1,0]
+        elif c == 1: 
+            pred_patches = pred_patches[:,:,0,0]
+        else: 
+            raise AssertionError(f"Wrong number of channels: expected 1 or 2, got {c}") 
+
+        max_patch_idxs = torch.argmax(pred_patches, dim = 1) 
+        per_row = self.euclid.num_patches_per_row
+        patch_lc = torch.stack([max_patch_idxs // per_row, max_patch_idxs % per_row], dim=1) * self.patch_size
+        return patch_lc.float() + self.patch_size / 2, patch_lc 
+
+    def execute_moves(self, pred_corners, pred_idxs, true_prev_images):
+        """
+        batched execute_move, returns new (b, w, h) images rather than writing into true_prev_images 
+        """
+        b, w, h = true_prev_images.shape
+        row_start, row_end = slice_bounds(pred_corners[:,0], self.block_size, w) 
+        col_start, col_end = slice_bounds(pred_corners[:,1], self.block_size, h) 
+        rows = torch.arange(w, device=true_prev_images.device).reshape(1, w, 1)
+        cols = torch.arange(h, device=true_prev_images.device).reshape(1, 1, h)
+        region = (rows >= row_start.reshape(b, 1, 1)) & (rows < row_end.reshape(b, 1, 1)) & \
+                 (cols >= col_start.reshape(b, 1, 1)) & (cols < col_end.reshape(b, 1, 1))
+        pred_idxs = pred_idxs.reshape(b, 1, 1).to(true_prev_images.dtype) 
+        # zero-out true location of pred block, then add it in at the pred location 
+        moved = torch.where(true_prev_images == pred_idxs, torch.zeros_like(true_prev_images), true_prev_images)
+        return torch.where(region, pred_idxs.expand(b, w, h), moved) 
+
+    def compute_distances(self, pred_block_corners, prev_block_ids, blocks_to_move, true_prev_images, true_next_images):
+        """
+        batched compute_distance, also returns the moved images 
+        """
+        pred_next_images = self.execute_moves(pred_block_corners, prev_block_ids, true_prev_images) 
+        blocks_to_move = blocks_to_move.reshape(-1, 1, 1) 
+        true_block_centers = self.euclid.get_block_centers(true_next_images == blocks_to_move) 
+        pred_block_centers = self.euclid.get_block_centers(pred_next_images == blocks_to_move) 
+        distance_pix = torch.norm(pred_block_centers - true_block_centers, dim=1) 
+        return distance_pix / self.block_size, pred_block_centers, true_block_centers, pred_next_images
+
+    def get_batch_metric(self, true_next_images, true_prev_images, pred_prev_images, pred_next_patches, blocks_to_move): 
+        """
+        get_metric for a whole batch on the device of the predictions. Returns (b,) tensors of 
+        distance, oracle_distance and block_acc, and (b, 2) tensors of pred_center and true_center 
+        """
+        device = pred_prev_images.device
+        bsz, w, h = true_next_images.shape[0:3]
+        true_next_images = true_next_images.detach().reshape(bsz, w, h).to(device) 
+        true_prev_images = true_prev_images.detach().reshape(bsz, w, h).to(device) 
+        pred_prev_images = pred_prev_images.detach().reshape(bsz, -1, w, h) 
+        blocks_to_move = blocks_to_move.detach().reshape(bsz).to(device).to(true_prev_images.dtype) 
+
+        prev_block_ids = self.select_prev_blocks(true_prev_images, pred_prev_images) 
+        __, pred_block_corners = self.select_next_locations(pred_next_patches.detach()) 
+
+        distance, pred_block_centers, true_block_centers, moved_images = self.compute_distances(pred_block_corners, prev_block_ids, blocks_to_move, true_prev_images, true_next_images) 
+        # get_metric moves the gold source block in the image the predicted move was already made in 
+        oracle_distance, __, __, __ = self.compute_distances(pred_block_corners, blocks_to_move, blocks_to_move, moved_images, true_next_images) 
+
+        return {"distance": distance,
+                "oracle_distance": oracle_distance,
+                "block_acc": (prev_block_ids == blocks_to_move).float(),
+                "pred_center": pred_block_centers,
+                "true_center": true_block_centers}
 
 class UNetTeleportationMetric(TransformerTeleportationMetric):
     def __init__(self, block_size = 4, image_size = 64):
@@ -253,6 +383,13 @@ class UNetTeleportationMetric(TransformerTeleportationMetric):
         patch_lc  = (row_idx - int(self.block_size/2), col_idx - int(self.block_size/2))
         return patch_center, patch_lc 
 
+    def select_next_locations(self, pred_next_images):
+        b, c, w, h = pred_next_images.shape[0:4]
+        pred_next_images = F.softmax(pred_next_images.reshape(b, c, w, h), dim=1)[:,1]
+        rows, cols = column_major_argmax(pred_next_images) 
+        patch_center = torch.stack([rows, cols], dim=1) 
+        return patch_center.float(), patch_center - int(self.block_size/2) 
+
     def get_metric(self, true_next_image, true_prev_image, pred_prev_image, pred_next_image, block_to_move): 
         true_next_image = true_next_image.detach().cpu() 
         true_prev_image = true_prev_image.detach().cpu() 
@@ -390,6 +527,46 @@ class GoodRobotTransformerTeleportationMetric(TransformerTeleportationMetric):
                   "true_center": true_block_center} 
         return to_ret 
 
+    def resize_pair(self, pair):
+        # the metric only needs the block state and locations, so skip copying and resizing the images 
+        pair = copy.copy(pair)
+        pair.resolution = self.image_size
+        pair.resize_state()
+        return pair
+
+    def select_next_locations(self, pred_next_images):
+        b, c, w, h = pred_next_images.shape[0:4]
+        pred_next_images = F.softmax(pred_next_images.reshape(b, c, w, h), dim=1)[:,1]
+        rows, cols = column_major_argmax(pred_next_images) 
+        return torch.stack([rows, cols], dim=1), None
+
+    def get_batch_metric(self, pairs, pred_prev_images, pred_next_images): 
+        """
+        get_metric for a whole batch on the device of the predictions. Returns (b,) tensors of 
+        distance and block_acc, and (b, 2) tensors of pred_center and true_center 
+        """
+        device = pred_prev_images.device
+        pairs = [self.resize_pair(pair) for pair in pairs]
+        true_prev_images = torch.from_numpy(np.stack([pair.prev_state_image for pair in pairs])).to(device) 
+        bsz, w, h = true_prev_images.shape
+        true_block_centers = torch.from_numpy(np.stack([pair.next_location[0:2] for pair in pairs])).float().to(device) 
+        blocks_to_move = torch.tensor([self.color_to_idx[pair.source_code] for pair in pairs]).to(device) 
+
+        # get a block id to move 
+        prev_block_ids = self.select_prev_blocks(true_prev_images, pred_prev_images.detach().reshape(bsz, -1, w, h)) 
+        # might be no regions predicted 
+        prev_block_ids[prev_block_ids == 0] = 1
+        # get the center of the most likely next location, to move the block to 
+        pred_block_centers, __ = self.select_next_locations(pred_next_images.detach()) 
+
+        block_size = int(self.block_ratio * self.image_size)
+        # centers are (row, col), locations are (x, y) 
+        distance_pix = torch.norm(pred_block_centers.flip(1).float() - true_block_centers, dim=1) 
+        return {"distance": distance_pix / block_size,
+                "block_acc": (prev_block_ids == blocks_to_move).float(), 
+                "pred_center": pred_block_centers,
+                "true_center": true_block_centers} 
+
 class GoodRobotUNetTeleportationMetric(GoodRobotTransformerTeleportationMetric):
     def __init__(self, 
                  block_size: int = 4,
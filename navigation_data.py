@@ -10,6 +10,7 @@ from spacy.tokenizer import Tokenizer
 from spacy.lang.en import English
 import torch
 from torch.nn import functional as F
+from language_embedders import commands_to_ids
 
 nlp = English()
 
@@ -87,6 +88,8 @@ class NavigationDatasetReader:
         self.read_limit = read_limit 
         self.is_bert = is_bert 
         self.overfit = overfit
+        # embedder word ids, batches include command_ids once set, see set_token_to_id() 
+        self.token_to_id = None
         self.out_path = pathlib.Path(out_path)
         self.train_out_path = self.out_path.joinpath("train")
         self.dev_out_path = self.out_path.joinpath("dev")
@@ -228,7 +231,14 @@ class NavigationDatasetReader:
                 "image_paths": image_paths,
                 "path_state": path_state,
                 "start_position": start_position,
-                "length": length} 
+                "length": length,
+                "command_lengths": torch.tensor(length, dtype = torch.long)} 
+
+    def set_token_to_id(self, token_to_id):
+        """
+        set the embedder word ids (e.g. RandomEmbedder.token_to_id) so batches from read() include a command_ids tensor 
+        """
+        self.token_to_id = token_to_id
 
     def pad_command(self, commands, max_len):
         for i, c in enumerate(commands):
@@ -254,6 +264,11 @@ class NavigationDatasetReader:
             batch_data['input_image'] = torch.cat(image_data, dim=0) 
             if self.is_bert:
                 batch_data['command'] = self.pad_command(batch_data['command'], self.max_len)
+            # batches preprocessed before command_lengths existed only have the length list 
+            lengths = [min(l, len(c)) for l, c in zip(batch_data['length'], batch_data['command'])]
+            batch_data['command_lengths'] = torch.tensor(lengths, dtype = torch.long)
+            if self.token_to_id is not None:
+                batch_data['command_ids'] = commands_to_ids(batch_data['command'], self.token_to_id)
 
             yield batch_data 
 
@@ -288,6 +303,7 @@ def configure_parser():
     parser.add_argument("--embedder", type=str, default="random", choices = ["random", "glove", "bert-base-cased", "bert-base-uncased"])
     parser.add_argument("--embedding-file", type=str, help="path to pretrained glove embeddings")
     parser.add_argument("--embedding-dim", type=int, default=300) 
+    parser.add_argument("--bert-cache-dir", type=str, default=None, help="directory of cached frozen BERT command embeddings, shared with the robot, defaults to ~/.cache/bert_embeddings") 
     # transformer parameters 
     parser.add_argument("--encoder-type", type=str, default="TransformerEncoder", choices = ["TransformerEncoder", "ResidualTransformerEncoder"], help = "choice of dual-stream transformer encoder or one that bases next prediction on previous transformer representation")
     parser.add_argument("--pos-encoding-type", type = str, default="fixed-separate") 
@@ -315,7 +331,10 @@ def configure_parser():
     parser.add_argument("--score-type", type=str, default="acc", choices = ["acc", "block_acc", "tele_score"])
     parser.add_argument("--zero-weight", type=float, default = 0.05, help = "weight for loss weighting negative vs positive examples") 
     parser.add_argument("--init-scale", type=int, default = 4, help = "initalization scale for transformer weights")
+    parser.add_argument("--attention-impl", type=str, default="sdpa", choices = ["sdpa", "einsum"], help = "sdpa uses fused scaled_dot_product_attention (torch >= 2.1, otherwise einsum) when attention weights are not logged, einsum always builds the attention matrix")
     parser.add_argument("--checkpoint-every", type=int, default=64, help = "save a checkpoint every n training steps")
+    parser.add_argument("--precision", type=str, default="fp32", choices = ["fp32", "bf16", "fp16"], help = "autocast precision for training, fp16 uses loss scaling and falls back to bf16 on cpu")
+    parser.add_argument("--accumulation-steps", type=int, default=1, help = "accumulate gradients over n micro-batches before each optimizer step")
     parser.add_argument("--seed", type=int, default=12) 
     parser.add_argument("--debug-image-top-k", type=int, default=-1, help = "for generating debugging images, only show the top k regions")
     parser.add_argument("--debug-image-threshold", type=float, default=-1, help = "for generating debugging images, only predicted patches above a fixed threshold")
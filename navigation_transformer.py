@@ -6,7 +6,8 @@ import einops
 import numpy as np 
 from einops import rearrange, repeat 
 from allennlp.nn.util import get_range_vector, get_device_of, add_positional_features
-from transformer import add_positional_features_2d, image_to_tiles, upsample_tiles, tiles_to_image, _get_std_from_tensor, Transformer, TransformerEncoder
+from language_embedders import embed_batch
+from transformer import add_positional_features_2d, image_to_tiles, upsample_tiles, tiles_to_image, _get_std_from_tensor, Transformer, TransformerEncoder, cached_positional_features, assemble_input
 import pdb 
 
 torch.manual_seed(12) 
@@ -30,7 +31,8 @@ class NavigationTransformerEncoder(TransformerEncoder):
                  device: torch.device = "cpu",
                  locality_mask: bool = False, 
                  locality_neighborhood: int = 5, 
-                 log_weights: bool = False):
+                 log_weights: bool = False,
+                 attention_impl: str = "sdpa"):
         super(NavigationTransformerEncoder, self).__init__(image_size=image_size,
                                                            patch_size=patch_size,
                                                            language_embedder=language_embedder,
@@ -46,31 +48,14 @@ class NavigationTransformerEncoder(TransformerEncoder):
                                                            embed_dropout=embed_dropout,
                                                            output_type=output_type,
                                                            positional_encoding_type=positional_encoding_type,
-                                                           device=device)
+                                                           device=device,
+                                                           attention_impl=attention_impl,
+                                                           locality_mask=locality_mask,
+                                                           locality_neighborhood=locality_neighborhood)
 
         self.start_pos_projection = torch.nn.Linear(2, hidden_dim)
-        self.locality_mask = locality_mask
-        self.locality_neighborhood = locality_neighborhood
 
-    def get_neighbors(self, patch_idx, num_patches, neighborhood = 5): 
-        image_w = int(num_patches**(1/2))
-        patch_idxs = np.arange(num_patches).reshape(image_w, image_w)
-        patch_row = int(patch_idx / image_w) 
-        patch_col = patch_idx % image_w 
-
-        neighbor_idxs = patch_idxs[max(0,patch_row - neighborhood):patch_row + neighborhood, max(0,patch_col - neighborhood):patch_col + neighborhood]
-        neighbor_idxs = neighbor_idxs.reshape(-1)
-        return neighbor_idxs
-
-    def get_image_local_mask(self, num_patches, image_dim, neighborhood = 5): 
-        # make a mask so that each image patch can only attend to patches close to it 
-        mask = torch.zeros((num_patches, num_patches))
-        for i in range(num_patches):
-            neighbors = self.get_neighbors(i, num_patches, neighborhood)
-            mask[i,neighbors] = 1
-        return mask.bool().to(self.device)
-
-    def _prepare_input(self, image, language, start_pos, mask = None):
+    def _prepare_input(self, image, language, start_pos, mask = None, command_ids = None):
         # patchify 
         p = self.patch_size 
         image = image.permute(0,3,1,2).float() 
@@ -93,47 +78,31 @@ class NavigationTransformerEncoder(TransformerEncoder):
         # project and positionally encode image 
         model_input = self.patch_projection(image_input) 
         # project and positionally encode language 
-        language_input = torch.cat([self.language_embedder(x).unsqueeze(0) for x  in language], dim = 0) 
+        language_input = embed_batch(self.language_embedder, language, command_ids) 
         language_input = self.language_projection(language_input) 
         start_pos = self.start_pos_projection(start_pos).unsqueeze(1)
 
         if self.positional_encoding_type == "fixed-separate": 
             # add fixed pos encoding to language and image separately 
-            model_input = add_positional_features(model_input)
-            language_input = add_positional_features(language_input)
-            # repeat [SEP] across batch 
-            sep_tokens_1 = repeat(self.sep_token, '() n d -> b n d', b=batch_size)
-            sep_tokens_2 = repeat(self.sep_token, '() n d -> b n d', b=batch_size)
-            # tack on [SEP]
-            model_input = torch.cat([model_input, sep_tokens_1], dim = 1)
-            # tack on language after [SEP]
-            model_input = torch.cat([model_input, language_input], dim = 1)
-            # tack another [SEP]
-            model_input = torch.cat([model_input, sep_tokens_2], dim = 1)
-            # tack on start position 
-            model_input = torch.cat([model_input, start_pos], dim = 1)
+            hidden_dim = model_input.shape[-1]
+            model_input = model_input + cached_positional_features(num_patches, hidden_dim, model_input.device)
+            language_input = language_input + cached_positional_features(language_input.shape[1], hidden_dim, language_input.device)
+            # tack on [SEP], language, another [SEP] and the start position 
+            model_input = assemble_input([model_input, self.sep_token, language_input, self.sep_token, start_pos])
         else:
             raise AssertionError(f"invalid positional type {self.positional_encoding_type}")
 
-        if self.locality_mask: 
-            image_dim = int(num_patches**(1/2))
-            image_mask = self.get_image_local_mask(num_patches, image_dim, neighborhood = self.locality_neighborhood)
-            __, total_len, __ = model_input.shape
-            large_image_mask = torch.ones(total_len, total_len)
-            large_image_mask[0:image_mask.shape[0], 0:image_mask.shape[1]] = image_mask
-            large_image_mask = large_image_mask.bool().to(self.device)
-
-        return model_input, long_mask, large_image_mask, num_patches
+        return model_input, long_mask, num_patches
 
     def forward(self, batch_instance): 
         language = batch_instance['command']
         image = batch_instance['input_image']
         start_pos = batch_instance['start_position'].float() 
 
-        language_mask = self.get_lang_mask(language) 
-        tfmr_input, mask, attn_mask, n_patches = self._prepare_input(image, language, start_pos, mask = language_mask) 
+        language_mask = self.get_lang_mask(language, batch_instance.get('command_lengths')) 
+        tfmr_input, mask, n_patches = self._prepare_input(image, language, start_pos, mask = language_mask, command_ids = batch_instance.get('command_ids')) 
 
-        tfmr_output, __ = self.start_transformer(tfmr_input, mask = mask, attn_mask = attn_mask) 
+        tfmr_output, __ = self.start_transformer(tfmr_input, mask = mask, local_window = self.get_local_window(n_patches)) 
         # trim off language 
         next_just_image_output = tfmr_output[:, 0:n_patches, :]
         # run final MLP 
@@ -7,6 +7,7 @@ from matplotlib.ticker import PercentFormatter
 from glob import glob
 import utils
 import scipy
+from transition_log import load_transition_log
 
 
 def best_success_rate(success_rate, window, title):
@@ -87,7 +88,7 @@ def get_trial_success_rate(trials, trial_successes, window=200, hotfix_trial_suc
         trial_window_max = np.max(trial_window)
         if trials.shape[0] >= window and i < window:
             trial_window_max = max(trial_window_max, np.max(trials[:window]))
-        success_rate[i] = np.divide(success_window_max, trial_window_max, out=np.zeros(1), where=trial_window_max!=0.0)
+        success_rate[i] = np.divide(success_window_max, trial_window_max, out=np.zeros(1), where=trial_window_max!=0.0)[0]
 
     # TODO(ahundt) fix the discontinuities in the log from writing the success count at a slightly different time, remove median filter workaround
     if np.any(success_rate > 1.0):
@@ -292,18 +293,18 @@ def plot_it(log_dir, title, window=1000, colors=None,
         colors = ['tab:blue', 'tab:green', 'tab:orange', 'tab:purple']
     best_dict = {}
     current_dict = {}
-    stack_height_file = os.path.join(log_dir, 'transitions', 'stack-height.log.txt')
-    if os.path.isfile(stack_height_file):
-        heights = np.loadtxt(stack_height_file)
+    transitions_directory = os.path.join(log_dir, 'transitions')
+    heights = load_transition_log(transitions_directory, 'stack-height')
+    if heights is not None:
         rewards = None
         if place is None:
             place = True
     else:
-        rewards = np.loadtxt(os.path.join(log_dir, 'transitions', 'reward-value.log.txt'))
+        rewards = load_transition_log(transitions_directory, 'reward-value')
         if place is None:
             place = False
-    actions = np.loadtxt(os.path.join(log_dir, 'transitions', 'executed-action.log.txt'))
-    trial_complete_indices = np.loadtxt(os.path.join(log_dir, 'transitions', 'clearance.log.txt'))
+    actions = load_transition_log(transitions_directory, 'executed-action')
+    trial_complete_indices = load_transition_log(transitions_directory, 'clearance')
     print('trial_complete_indices: ' + str(trial_complete_indices))
     trials = np.array(utils.clearance_log_to_trial_count(trial_complete_indices)).astype(np.int)
     if window is None:
@@ -319,10 +320,8 @@ def plot_it(log_dir, title, window=1000, colors=None,
         actions = actions[:max_iter]
         trials = trials[:max_iter]
 
-    grasp_success_file = os.path.join(log_dir, 'transitions', 'grasp-success.log.txt')
-    if os.path.isfile(grasp_success_file):
-        grasp_rewards = np.loadtxt(grasp_success_file)
-    else:
+    grasp_rewards = load_transition_log(transitions_directory, 'grasp-success')
+    if grasp_rewards is None:
         # old versions of logged code don't have the grasp-success.log.txt file, data must be extracted from rewards.
         grasp_rewards = rewards
 
@@ -334,13 +333,12 @@ def plot_it(log_dir, title, window=1000, colors=None,
         # get the currently active figure
         fig = plt.gcf()
     # Plot the rate and variance of trial successes
-    trial_success_file = os.path.join(log_dir, 'transitions', 'trial-success.log.txt')
-    if os.path.isfile(trial_success_file):
-        trial_successes = np.loadtxt(trial_success_file)
+    trial_successes = load_transition_log(transitions_directory, 'trial-success')
+    if trial_successes is not None:
         if max_iter is not None:
             trial_successes = trial_successes[:max_iter]
         if apply_real_robot_speckle_noise_hotfix:
-            clearance = np.loadtxt(os.path.join(log_dir, 'transitions', 'clearance.log.txt'))
+            clearance = load_transition_log(transitions_directory, 'clearance')
             heights, trials, trial_successes, clearance = real_robot_speckle_noise_hotfix(heights, trials, trial_successes, clearance)
         if trial_successes.size > 0:
             trial_success_rate, trial_success_lower, trial_success_upper, best, current = get_trial_success_rate(trials, trial_successes, window=window)
@@ -388,7 +386,7 @@ def plot_it(log_dir, title, window=1000, colors=None,
                         #  mult*place_lower, mult*place_upper,
                         #  color=colors[1], alpha=alpha)
 
-    if 'trial_success' in categories and os.path.isfile(trial_success_file) and trial_successes.size > 0:
+    if 'trial_success' in categories and trial_successes is not None and trial_successes.size > 0:
         plt.plot(mult*trial_success_rate, color=colors[3], label=label or 'Trial Success Rate')
         # plt.fill_between(np.arange(1, trial_success_rate.shape[0]+1),
         #                  mult*trial_success_lower, mult*trial_success_upper,
@@ -415,7 +413,7 @@ def plot_it(log_dir, title, window=1000, colors=None,
             if not os.path.exists(dir_to_create):
                 utils.mkdir_p(dir_to_create)
 
-        if 'trial_success' in categories and os.path.isfile(trial_success_file) and trial_successes.size > 0:
+        if 'trial_success' in categories and trial_successes is not None and trial_successes.size > 0:
             trial_success_path = os.path.join(log_dir, 'transitions', 'trial-success-rate.log.csv')
             print('saving trial success rate: ' + str(trial_success_path))
             np.savetxt(trial_success_path, trial_success_rate, delimiter=', ', header='trial_success_rate')
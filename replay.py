@@ -0,0 +1,153 @@
+""" Prioritized experience replay structures, kept up to date incrementally by the Trainer.
+"""
+import numpy as np
+from sortedcontainers import SortedList
+
+
+class SumTree(object):
+    """ Binary tree over a growable array where every parent holds the sum of its children.
+
+    Setting a value and drawing an index with probability proportional to its value are both O(log N).
+    """
+    def __init__(self, capacity=1024):
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+        self.tree = np.zeros(2 * self.capacity)
+
+    def grow(self, min_capacity):
+        leaves = self.tree[self.capacity:]
+        while self.capacity < min_capacity:
+            self.capacity *= 2
+        self.tree = np.zeros(2 * self.capacity)
+        self.tree[self.capacity:self.capacity + len(leaves)] = leaves
+        # rebuild the parents one level at a time
+        start = self.capacity
+        while start > 1:
+            self.tree[start // 2:start] = self.tree[start:2 * start].reshape(-1, 2).sum(axis=1)
+            start //= 2
+
+    def __setitem__(self, index, value):
+        if index >= self.capacity:
+            self.grow(index + 1)
+        i = index + self.capacity
+        self.tree[i] = value
+        i //= 2
+        while i >= 1:
+            self.tree[i] = self.tree[2 * i] + self.tree[2 * i + 1]
+            i //= 2
+
+    def __getitem__(self, index):
+        if index >= self.capacity:
+            return 0.0
+        return self.tree[index + self.capacity]
+
+    def total(self):
+        return self.tree[1]
+
+    def find(self, mass):
+        """ Returns the first index where the cumulative sum of values exceeds mass.
+        """
+        # guard against floating point error pushing mass past the last nonzero value
+        mass = min(mass, np.nextafter(self.total(), 0))
+        i = 1
+        while i < self.capacity:
+            left = 2 * i
+            if mass < self.tree[left]:
+                i = left
+            else:
+                mass -= self.tree[left]
+                i = left + 1
+        return i - self.capacity
+
+
+class PrioritizedReplay(object):
+    """ Surprise values of past iterations, grouped by sample class, that can be sampled in O(log N).
+
+    Every iteration belongs to the class key given to add() and to the ALL class if include_in_all is set.
+    Two sampling modes are available:
+
+        'rank': the power law over the surprise rank that experience replay has always used,
+            the highest surprise is the most likely sample. Uses a sorted list per class.
+        'proportional': probability proportional to (surprise + epsilon) ** alpha. Uses a SumTree per class.
+    """
+    ALL = 'all'
+
+    def __init__(self, mode='rank', pow_law_exp=2, alpha=0.6, epsilon=1e-3):
+        if mode not in ['rank', 'proportional']:
+            raise ValueError('PrioritizedReplay mode must be rank or proportional, not: ' + str(mode))
+        self.mode = mode
+        self.pow_law_exp = pow_law_exp
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.reset()
+
+    def reset(self, target=None):
+        """ Remove every iteration, target is a tag of what the surprise values are computed against.
+        """
+        self.target = target
+        # iterations [0, size) have been added
+        self.size = 0
+        self.surprise = {}
+        self.classes = {}
+        self.ranked = {}
+        self.trees = {}
+        self.tree_sizes = {}
+
+    def __contains__(self, iteration):
+        return iteration in self.surprise
+
+    def class_size(self, key):
+        if self.mode == 'rank':
+            return len(self.ranked.get(key, []))
+        return self.tree_sizes.get(key, 0)
+
+    def insert(self, key, iteration, surprise):
+        if self.mode == 'rank':
+            self.ranked.setdefault(key, SortedList()).add((surprise, iteration))
+        else:
+            self.trees.setdefault(key, SumTree())[iteration] = (surprise + self.epsilon) ** self.alpha
+            self.tree_sizes[key] = self.tree_sizes.get(key, 0) + 1
+
+    def remove(self, key, iteration, surprise):
+        if self.mode == 'rank':
+            self.ranked[key].remove((surprise, iteration))
+        else:
+            self.trees[key][iteration] = 0.0
+            self.tree_sizes[key] -= 1
+
+    def add(self, iteration, key, surprise, include_in_all=True):
+        """ Add the next iteration, which must equal self.size, with its class key and surprise value.
+        """
+        assert iteration == self.size, 'PrioritizedReplay.add() iterations must be added in order'
+        keys = [key, self.ALL] if include_in_all else [key]
+        self.classes[iteration] = keys
+        self.surprise[iteration] = surprise
+        for k in keys:
+            self.insert(k, iteration, surprise)
+        self.size += 1
+
+    def update(self, iteration, surprise):
+        """ Change the surprise value of an iteration that was already added.
+        """
+        if iteration not in self.surprise:
+            return
+        for k in self.classes[iteration]:
+            self.remove(k, iteration, self.surprise[iteration])
+            self.insert(k, iteration, surprise)
+        self.surprise[iteration] = surprise
+
+    def sample(self, key):
+        """ Draw an iteration from class key, returns (iteration, surprise) or (None, None) if the class is empty.
+        """
+        size = self.class_size(key)
+        if size == 0:
+            return None, None
+        if self.mode == 'rank':
+            rank = int(np.round(np.random.power(self.pow_law_exp, 1)[0] * (size - 1)))
+            surprise, iteration = self.ranked[key][rank]
+        else:
+            tree = self.trees[key]
+            iteration = tree.find(np.random.uniform(0, tree.total()))
+            surprise = self.surprise[iteration]
+        return iteration, surprise
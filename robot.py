@@ -8,6 +8,9 @@ import itertools
 import utils
 import traceback
 import copy
+import functools
+import threading
+import collections
 from simulation import vrep
 from scipy import ndimage, misc
 from glob import glob
@@ -20,6 +23,90 @@ except ImportError:
           '    pip3 install --user --upgrade pymodbus\n')
     RobotiqCGripper = None
 
+
+def moves_objects(method):
+    """ Decorate Robot methods that can move the arm or objects.
+
+    Waits for any background camera capture first, and afterwards drops the cached object pose snapshot
+    and counts the motion, so camera frames captured before it are known to be stale.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.camera_capture.wait()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.invalidate_sim_state()
+            self.motion_count += 1
+    return wrapper
+
+
+# One get_camera_data() result, camera_data is the tuple get_camera_data() returns.
+# sequence numbers frames in capture order, timestamp is the time.time() the images were requested,
+# and motion_count is Robot.motion_count at that time, so frames from before the last motion can be rejected.
+CameraFrame = collections.namedtuple('CameraFrame', ['sequence', 'timestamp', 'motion_count', 'camera_data'])
+
+
+class CameraCapture(object):
+    """ Double buffered background capture of Robot.get_camera_data() frames.
+
+    request() starts a worker thread which returns the arm home, takes the RGB-D images and projects
+    the heightmaps into the back buffer, then swaps it to the front. take() hands out the front frame once,
+    and only if it was captured with the same arguments and no motion command has run since.
+    """
+    def __init__(self, robot):
+        self.robot = robot
+        self.lock = threading.Lock()
+        self.front_frame = None
+        self.front_args = None
+        self.thread = None
+        self.sequence = 0
+
+    def next_sequence(self):
+        with self.lock:
+            self.sequence += 1
+            return self.sequence
+
+    def request(self, capture_args):
+        """ Start capturing a frame with the Robot.get_camera_data() arguments in capture_args.
+        """
+        self.wait()
+        self.thread = threading.Thread(target=self.capture, args=(capture_args,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def capture(self, capture_args):
+        try:
+            back_frame = self.robot.capture_camera_frame(**capture_args)
+        except Exception:
+            # the synchronous capture in get_camera_data() will run and report the problem
+            traceback.print_exc()
+            return
+        with self.lock:
+            self.front_frame, self.front_args = back_frame, capture_args
+
+    def wait(self):
+        """ Block until the background capture finishes, unless called from the capture itself.
+        """
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def take(self, capture_args):
+        """ Returns the front frame and empties the front buffer, or None if there is no fresh frame for capture_args.
+        """
+        self.wait()
+        with self.lock:
+            frame, frame_args = self.front_frame, self.front_args
+            self.front_frame, self.front_args = None, None
+        if frame is None or frame.motion_count != self.robot.motion_count:
+            return None
+        if frame_args.keys() != capture_args.keys() or \
+                not all(np.array_equal(frame_args[k], capture_args[k]) for k in capture_args):
+            return None
+        return frame
+
+
 def gripper_control_pose_to_arm_control_pose(gripper_translation, gripper_orientation, gripper_to_arm_transform=None):
         # arm_trans = np.eye(4,4)
         # arm_trans[0:3,3] = np.asarray(gripper_translation)
@@ -141,7 +228,16 @@ class Robot(object):
         # self.gripper_ee_offset = 0.17
         # self.gripper_ee_offset = 0.15
         self.background_heightmap = None
+        # reused camera geometry for get_camera_data(), see get_heightmap_projector()
+        self.heightmap_projector = None
         self.tool_tip_to_gripper_center_transform = None
+        # object pose snapshot from get_sim_state(), None until fetched or after motion
+        self.sim_state = None
+        # number of motion commands run so far, see moves_objects()
+        self.motion_count = 0
+        # background capture for request_camera_data(), and the last frame returned by get_camera_data()
+        self.camera_capture = CameraCapture(self)
+        self.camera_frame = None
 
         # list of place position attempts
         self.place_pose_history = []
@@ -423,6 +519,7 @@ class Robot(object):
         return drop_x, drop_y, object_position, object_orientation
 
 
+    @moves_objects
     def reposition_object_randomly(self, object_handle):
         """ randomly set a specific object's position and orientation on
         """
@@ -438,6 +535,7 @@ class Robot(object):
         self.reposition_object_randomly(object_handle)
 
 
+    @moves_objects
     def reposition_object_at_list_index_to_location(self, obj_pos, obj_ori, index):
         """ Reposition the object to a specified position and orientation """
         object_handle = self.object_handles[index]
@@ -450,6 +548,7 @@ class Robot(object):
         vrep.simxSetObjectOrientation(self.sim_client, object_handle, plane_handle, obj_ori, vrep.simx_opmode_blocking)
 
 
+    @moves_objects
     def add_objects(self):
 
         # Add each object to robot workspace at x,y location and orientation (random or pre-loaded)
@@ -547,6 +646,7 @@ class Robot(object):
         if self.task_type == 'unstack':
             self.reposition_objects()
 
+    @moves_objects
     def restart_sim(self, connect=False):
         if connect:
             # Connect to simulator
@@ -659,9 +759,49 @@ class Robot(object):
             vrep.simxFinish(self.sim_client)
 
 
+    def invalidate_sim_state(self):
+        """ Drop the cached object pose snapshot, so the next get_sim_state() fetches it from the simulator.
+        """
+        self.sim_state = None
+
+    def get_sim_state(self):
+        """ Snapshot of all object positions and orientations, fetched in one remote API exchange.
+
+        The snapshot is cached until invalidate_sim_state(), which runs after every motion command and camera capture.
+
+        # Returns
+
+            obj_positions, obj_orientations: lists of [x, y, z] and euler angle lists in self.object_handles order.
+        """
+        if not self.is_sim:
+            raise NotImplementedError('get_sim_state() only supported in simulation')
+        if self.sim_state is None:
+            # data type 9 is the absolute position and euler orientation of every shape, 6 floats each
+            sim_ret, handles, _, float_data, _ = vrep.simxGetObjectGroupData(
+                self.sim_client, vrep.sim_object_shape_type, 9, vrep.simx_opmode_blocking)
+            poses = dict(zip(handles, np.reshape(float_data, (-1, 6)).tolist()))
+            if sim_ret == vrep.simx_return_ok and all(object_handle in poses for object_handle in self.object_handles):
+                obj_positions = [poses[object_handle][:3] for object_handle in self.object_handles]
+                obj_orientations = [poses[object_handle][3:] for object_handle in self.object_handles]
+            else:
+                # fall back to one round trip per object
+                obj_positions = []
+                obj_orientations = []
+                for object_handle in self.object_handles:
+                    sim_ret, object_position = vrep.simxGetObjectPosition(self.sim_client, object_handle, -1, vrep.simx_opmode_blocking)
+                    sim_ret, object_orientation = vrep.simxGetObjectOrientation(self.sim_client, object_handle, -1, vrep.simx_opmode_blocking)
+                    obj_positions.append(object_position)
+                    obj_orientations.append(object_orientation)
+            self.sim_state = (obj_positions, obj_orientations)
+        obj_positions, obj_orientations = self.sim_state
+        # copies, so callers can't modify the cache
+        return [list(p) for p in obj_positions], [list(o) for o in obj_orientations]
+
     def get_obj_positions(self, relative_to_handle=-1):
         if not self.is_sim:
             raise NotImplementedError('get_obj_positions() only supported in simulation, if you are training stacking try specifying --check_z_height')
+        if relative_to_handle == -1:
+            return self.get_sim_state()[0]
         obj_positions = []
         for object_handle in self.object_handles:
             sim_ret, object_position = vrep.simxGetObjectPosition(self.sim_client, object_handle, relative_to_handle, vrep.simx_opmode_blocking)
@@ -686,15 +826,7 @@ class Robot(object):
         if not self.is_sim:
             raise NotImplementedError('get_obj_positions_and_orientations() only supported in simulation')
 
-        obj_positions = []
-        obj_orientations = []
-        for object_handle in self.object_handles:
-            sim_ret, object_position = vrep.simxGetObjectPosition(self.sim_client, object_handle, -1, vrep.simx_opmode_blocking)
-            sim_ret, object_orientation = vrep.simxGetObjectOrientation(self.sim_client, object_handle, -1, vrep.simx_opmode_blocking)
-            obj_positions.append(object_position)
-            obj_orientations.append(object_orientation)
-
-        return obj_positions, obj_orientations
+        return self.get_sim_state()
 
     def action_heightmap_coordinate_to_3d_robot_pose(self, x_pixel, y_pixel, action_name, valid_depth_heightmap, robot_push_vertical_offset=0.026):
         # Adjust start position of all actions, and make sure z value is safe and not too low
@@ -737,6 +869,7 @@ class Robot(object):
         primitive_position = [x_pixel * self.heightmap_resolution + self.workspace_limits[0][0], y_pixel * self.heightmap_resolution + self.workspace_limits[1][0], safe_z_position]
         return primitive_position, push_may_contact_something
 
+    @moves_objects
     def reposition_objects(self, unstack_drop_height=0.05, action_log=None, logger=None,
             goal_condition=None, workspace_limits=None):
         # grasp blocks from previously placed positions and place them in a random position.
@@ -856,12 +989,46 @@ class Robot(object):
 
                 return True
 
+    def get_heightmap_projector(self, workspace_limits, heightmap_resolution):
+        """ Returns the utils.HeightmapProjector for the current camera, only rebuilt when the camera or workspace changes.
+        """
+        if self.heightmap_projector is None or not self.heightmap_projector.matches(self.cam_intrinsics, self.cam_pose, workspace_limits, heightmap_resolution):
+            self.heightmap_projector = utils.HeightmapProjector(self.cam_intrinsics, self.cam_pose, workspace_limits, heightmap_resolution)
+        return self.heightmap_projector
+
+    def request_camera_data(self, workspace_limits=None, heightmap_resolution=None, return_heightmaps=False, go_home=True, z_height_retake_threshold=0.3, median_filter_size=5, color_median_filter_size=5):
+        """ Start capturing the next get_camera_data() frame in the background, with the same arguments.
+
+        Call it as soon as an action finishes, so the return home, image capture and heightmap projection
+        overlap with other work such as a training step. The frame is only used if nothing moves before get_camera_data().
+        """
+        self.camera_capture.request(dict(workspace_limits=workspace_limits, heightmap_resolution=heightmap_resolution,
+                                         return_heightmaps=return_heightmaps, go_home=go_home,
+                                         z_height_retake_threshold=z_height_retake_threshold, median_filter_size=median_filter_size,
+                                         color_median_filter_size=color_median_filter_size))
+
     def get_camera_data(self, workspace_limits=None, heightmap_resolution=None, return_heightmaps=False, go_home=True, z_height_retake_threshold=0.3, median_filter_size=5, color_median_filter_size=5):
         """
+        Uses the frame from request_camera_data() if it is still fresh, otherwise captures one now.
+        The frame's sequence number and timestamp are in self.camera_frame afterwards.
+
         # Returns
 
         [valid_depth_heightmap, color_heightmap, depth_heightmap, max_z_height, color_img, depth_img] if return_heightmaps is True, otherwise [color_img, depth_img]
 
+        """
+        capture_args = dict(workspace_limits=workspace_limits, heightmap_resolution=heightmap_resolution,
+                            return_heightmaps=return_heightmaps, go_home=go_home,
+                            z_height_retake_threshold=z_height_retake_threshold, median_filter_size=median_filter_size,
+                            color_median_filter_size=color_median_filter_size)
+        frame = self.camera_capture.take(capture_args)
+        if frame is None:
+            frame = self.capture_camera_frame(**capture_args)
+        self.camera_frame = frame
+        return frame.camera_data
+
+    def capture_camera_frame(self, workspace_limits=None, heightmap_resolution=None, return_heightmaps=False, go_home=True, z_height_retake_threshold=0.3, median_filter_size=5, color_median_filter_size=5):
+        """ Capture a CameraFrame now, see get_camera_data() for the arguments.
         """
         if workspace_limits is None:
             workspace_limits = self.workspace_limits
@@ -872,6 +1039,10 @@ class Robot(object):
         max_z_height = np.inf
         if go_home:
             self.go_home(block_until_home=True)
+        sequence = self.camera_capture.next_sequence()
+        motion_count = self.motion_count
+        # a new observation, so refresh the object poses too
+        self.invalidate_sim_state()
 
         def get_color_depth():
             """ Get the raw color and depth images
@@ -909,6 +1080,7 @@ class Robot(object):
                 # color_img = self.camera.color_data.copy()
                 # depth_img = self.camera.depth_data.copy()
             return color_img, depth_img
+        timestamp = time.time()
         color_img, depth_img  = get_color_depth() # unit: mm -> meter
 
         if return_heightmaps:
@@ -917,9 +1089,9 @@ class Robot(object):
 
             while max_z_height > z_height_retake_threshold:
                 scaled_depth_img = depth_img * self.cam_depth_scale  # Apply depth scale from calibration
-                color_heightmap, depth_heightmap = utils.get_heightmap(color_img, scaled_depth_img, self.cam_intrinsics, self.cam_pose,
-                                                                    workspace_limits, heightmap_resolution, background_heightmap=self.background_heightmap,
-                                                                    median_filter_pixels=median_filter_size, color_median_filter_pixels=color_median_filter_size)
+                projector = self.get_heightmap_projector(workspace_limits, heightmap_resolution)
+                color_heightmap, depth_heightmap = projector.project(color_img, scaled_depth_img, background_heightmap=self.background_heightmap,
+                                                                     median_filter_pixels=median_filter_size, color_median_filter_pixels=color_median_filter_size)
                 # TODO(ahundt) switch to masked array, then only have a regular heightmap
                 valid_depth_heightmap = depth_heightmap.copy()
                 valid_depth_heightmap[np.isnan(valid_depth_heightmap)] = 0
@@ -937,15 +1109,17 @@ class Robot(object):
                               'max_z_height: ', max_z_height)
 
                     # Get color and depth image from ROS service
+                    timestamp = time.time()
                     color_img, depth_img = get_color_depth()
                     print_error += 1
                     time.sleep(0.1)
 
 
-            return valid_depth_heightmap, color_heightmap, depth_heightmap, max_z_height, color_img, depth_img
+            camera_data = valid_depth_heightmap, color_heightmap, depth_heightmap, max_z_height, color_img, depth_img
+            return CameraFrame(sequence, timestamp, motion_count, camera_data)
 
         # if not return_depthmaps, return just raw images
-        return color_img, depth_img
+        return CameraFrame(sequence, timestamp, motion_count, (color_img, depth_img))
 
 
     def parse_tcp_state_data(self, state_data, subpackage):
@@ -1012,6 +1186,7 @@ class Robot(object):
         return TCP_forces
 
 
+    @moves_objects
     def close_gripper(self, nonblocking=False):
         """
         # Arguments
@@ -1069,6 +1244,7 @@ class Robot(object):
         return gripper_fully_closed
 
 
+    @moves_objects
     def open_gripper(self, nonblocking=False, timeout_seconds=5):
         """
         # Returns
@@ -1121,6 +1297,7 @@ class Robot(object):
         return state_data
 
 
+    @moves_objects
     def move_to(self, tool_position, tool_orientation=None, timeout_seconds=10, heightmap_rotation_angle=None, legacy_mode=True, sim_move_step=0.01):
         """
         legacy_mode: bool, Legacy mode manually increments the gripper position, rather than using simulator motion commands.
@@ -1298,6 +1475,7 @@ class Robot(object):
             # Block until robot reaches target tool position
             return self.block_until_cartesian_position(tool_position_tcp, timeout_seconds=timeout_seconds)
 
+    @moves_objects
     def guarded_move_to(self, tool_position, tool_orientation):
         if self.is_sim:
             raise NotImplementedError
@@ -1365,6 +1543,7 @@ class Robot(object):
         return execute_success
 
 
+    @moves_objects
     def move_joints(self, joint_configuration, timeout_seconds=7):
         if self.is_sim:
             if not self.sim_joint_handles:
@@ -1400,6 +1579,7 @@ class Robot(object):
             return True
 
 
+    @moves_objects
     def go_home(self, block_until_home=False, timeout_seconds=7):
         if self.is_sim:
             success = self.move_to(self.sim_home_position, None)
@@ -1483,6 +1663,7 @@ class Robot(object):
         return grasped_object_ind, grasped_object_handle
 
 
+    @moves_objects
     def reposition_objects_near_gripper(self, distance_threshold=0.1, put_inside_workspace=True):
         """ Simulation only function to detect objects near the gripper.
 
@@ -1512,6 +1693,7 @@ class Robot(object):
 
     # Primitives ----------------------------------------------------------
 
+    @moves_objects
     def grasp(self, position, heightmap_rotation_angle, object_color=None, workspace_limits=None, go_home=True):
         """
         object_color: The index in the list self.color_names expected for the object to be grasped. If object_color is None the color does not matter.
@@ -1666,6 +1848,7 @@ class Robot(object):
         midpos = (np.array(actual_tool_pose[:3]) + pos) / 2.0
         return midpos
 
+    @moves_objects
     def push(self, position, heightmap_rotation_angle, workspace_limits=None, go_home=True):
         if workspace_limits is None:
             workspace_limits = self.workspace_limits
@@ -1835,6 +2018,7 @@ class Robot(object):
                 return True
             time.sleep(0.1)
 
+    @moves_objects
     def place(self, position, heightmap_rotation_angle, workspace_limits=None, distance_threshold=0.06, go_home=True, save_history=True, over_block=True, intended_position=None):
         """ Place an object, currently only tested for blocks.
 
@@ -1994,13 +2178,14 @@ class Robot(object):
                 return move_to_result
 
     def check_row(self, object_color_sequence,
-                  num_obj=4,
+                  num_obj=None,
                   distance_threshold=0.02,
                   separation_threshold=0.1,
                   num_directions=64,
                   check_z_height=False,
                   valid_depth_heightmap=None,
-                  prev_z_height=None):
+                  prev_z_height=None,
+                  return_inds=False):
         """Check for a complete row in the correct order, along any of the `num_directions` directions.
 
         Input: vector length of 1, 2, or 3
@@ -2009,10 +2194,11 @@ class Robot(object):
         # Arguments
 
         object_color_sequence: vector indicating the index order of self.object_handles we expect to grasp.
-        num_obj: number of blocks in the workspace (needed to get all subsets)
+        num_obj: number of blocks in the workspace (needed to get all subsets), all detected blocks if None.
         separation_threshold: The max distance cutoff between blocks in meters for the stack to be considered complete.
         distance_threshold: maximum distance for blocks to be off-row
         num_directions: number of rotations that are checked for rows.
+        return_inds: also return the indices of the blocks in the row, [] if there is none.
 
 
         # Returns
@@ -2031,67 +2217,38 @@ class Robot(object):
             valid_depth_heightmap, _, _, _, _, _ = self.get_camera_data(return_heightmaps=True)
 
             success, row_size = utils.check_row_success(valid_depth_heightmap, prev_z_height=prev_z_height)
+            if return_inds:
+                return success, row_size, []
             return success, row_size
 
         else:
             if len(object_color_sequence) < 1:
                 print('check_row() object_color_sequence length is 0 or 1, so there is nothing to check and it passes automatically')
+                if return_inds:
+                    return True, 1, []
                 return True, 1
 
             pos = np.asarray(self.get_obj_positions())
+            # TODO(ahundt) FIX HACK switch axis to yx order, to workaround the problem where it cannot check vertical lines for rows
             posyx = copy.deepcopy(pos)
             posyx[:, [0,1]] = posyx[:, [1,0]]
-            success = False
-            row_size = 1
             row_length = len(object_color_sequence)
             # Color order of blocks doesn't matter, just the length of the sequence.
-            # Therefore, check every row_length-size subset of blocks to see if
-            # they are in a row and, if so, whether they are close enough
-            # together.
-
-            # lists all the possible subsets of blocks to check, for each possible length of row (except 1).
-            # So for 3 objects, this would be:
-            # [[[0,1], [0,2], [1,2]], [[0,1,2]]]
-            #all_block_indices = [map(list, itertools.permutations(np.arange(num_obj), length))
-            #                        for length in range(1, num_obj+1)]
-
-            # only check row size rows 
-            all_block_indices = [map(list, itertools.permutations(np.arange(num_obj), row_length))]
-
-            successful_block_indices = []
-            for block_indices_of_length in all_block_indices:
-                do_break = False
-                for block_indices in block_indices_of_length:
-                    # check each rotation angle for a possible row
-                    #print('checking {}'.format(block_indices))
-                    #print('checking {}'.format(np.array(self.color_names)[block_indices]))
-                    specific_success, specific_row_size, specific_successful_block_indices = self.check_specific_blocks_for_row(pos, block_indices, distance_threshold, separation_threshold, object_color_sequence, row_size, success)
-                    #print(f"horizontal SUCCESS: {specific_success}")
-                    if specific_row_size > row_size:
-                        success = specific_success
-                        row_size = max(row_size, specific_row_size)
-                        successful_block_indices = specific_successful_block_indices
-                    else:
-                        # TODO(ahundt) FIX HACK switch axis to yx order, to workaround the problem where it cannot check vertical lines for rows
-                        specific_success, specific_row_size, specific_successful_block_indices = self.check_specific_blocks_for_row(posyx, block_indices, distance_threshold, separation_threshold, object_color_sequence, row_size, success)
-                        #print(f"vertical SUCCESS: {specific_success}")
-                        if specific_row_size > row_size:
-                            success = specific_success
-                            row_size = max(row_size, specific_row_size)
-                            successful_block_indices = specific_successful_block_indices
-
-                    if specific_success:
-                        success = specific_success
-                        successful_block_indices = specific_successful_block_indices
-                        row_size = len(successful_block_indices)
-                        do_break = True
-                        break
-
-                if do_break:
-                    break
-            print(successful_block_indices)
+            # Therefore, check every row_length-size permutation of blocks to see if
+            # they are in a row and, if so, whether they are close enough together.
+            # All permutations are scored at once by utils.find_row(), which returns the first
+            # row in itertools.permutations order.
+            color_names = None
+            if self.grasp_color_task or self.language:
+                color_names = self.color_names
+            # if using language, don't sort them, just take them as is, should work since we're using permutations not combinations
+            success, row_size, successful_block_indices = utils.find_row(
+                posyx, row_length, distance_threshold, separation_threshold, num_obj=num_obj,
+                color_names=color_names, object_color_sequence=object_color_sequence, sort_by_x=not self.language)
             print('check_row: {} | row_size: {} | blocks: {}'.format(
                 success, row_size, np.array(self.color_names)[successful_block_indices]))
+            if return_inds:
+                return success, row_size, successful_block_indices
             return success, row_size
 
     def check_specific_blocks_for_row(self, pos, block_indices, distance_threshold, separation_threshold, object_color_sequence, row_size, success):
@@ -2269,39 +2426,13 @@ class Robot(object):
         else:
             sequences = [object_color_sequence]
 
-        # print('bottom: ' + str(object_color_sequence[:-1]))
-        # print('top: ' + str(object_color_sequence[1:]))
-        idx = 0
-        working_seq_found = True
-        max_height = 0
-        # The outside for loop is to check all possible stacks that fit the color order.
+        # The candidate stacks that fit the color order are all checked at once.
         # It is mainly used for grasp_color_task (color stacking)
-        for sequence in sequences:
-            working_seq_found = True
-            for idx in range(checks):
-                bottom_pos = pos[sequence[idx]]
-                top_pos = pos[sequence[idx+1]]
-                # Check that Z is higher by at least half the distance threshold
-                # print('bottom_pos:', bottom_pos)
-                # print('top_pos:', top_pos)
-                # print('distance_threshold: ', distance_threshold)
-                if top_pos[2] < (bottom_pos[2] + vert_distance_threshold / 2.0):
-                    if not self.grasp_color_task:
-                        print('check_stack(): not high enough for idx: ' + str(idx))
-                    working_seq_found=False
-                    max_height=max(max_height, idx + 1)
-
-                # Check that the blocks are near each other
-                dist = np.linalg.norm(np.array(bottom_pos) - np.array(top_pos))
-                # print('distance: ', dist)
-                if dist > vert_distance_threshold:
-                    if not self.grasp_color_task:
-                        print('check_stack(): too far apart')
-                    working_seq_found=False
-                    max_height=max(max_height, idx + 1)
-
-            if working_seq_found:
-                break
+        working_seq_found, max_height = utils.check_stack_sequences(pos, sequences, checks, vert_distance_threshold)
+        if not working_seq_found and not self.grasp_color_task:
+            print('check_stack(): blocks not stacked, stack height: ' + str(max_height))
+        # index of the last check, as left by a loop over range(checks)
+        idx = max(checks - 1, 0)
 
         pred = detected_object_color_sequence[0:goal_num_obj]
         goal = object_color_sequence[0:goal_num_obj]
@@ -2330,18 +2461,15 @@ class Robot(object):
 
 
     def generate_possible_color_stack_sequences(self, object_color_sequence, index, used_indicies, output):
-        # Recursive function to help check the stack
-        if index == len(object_color_sequence):
-            output.append(used_indicies)
-            return
-
-        bottom_color_index = object_color_sequence[index] % self.color_space.shape[0]
-        bottom_index_options = [i for i in range(bottom_color_index, self.num_obj, self.color_space.shape[0]) if i not in used_indicies]
-
-        for ib in bottom_index_options:
-            new_used_indicies = used_indicies.copy()
-            new_used_indicies.append(ib)
-            self.generate_possible_color_stack_sequences(object_color_sequence, index+1, new_used_indicies, output)
+        # Fill output with every way to pick distinct blocks of the colors in object_color_sequence[index:],
+        # in the same order as a depth first search over the blocks of each color
+        num_colors = self.color_space.shape[0]
+        index_options = [range(color_index % num_colors, self.num_obj, num_colors)
+                         for color_index in object_color_sequence[index:]]
+        for sequence in itertools.product(*index_options):
+            sequence = list(used_indicies) + list(sequence)
+            if len(set(sequence)) == len(sequence):
+                output.append(sequence)
 
         return
 
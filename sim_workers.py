@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+""" Run simulated demos on several simulator connections at once and merge them into one logging session.
+
+    SimWorkerPool starts one worker process per simulator, each with its own Robot connected to the remote API
+    port base_port + worker index. Tasks are handed out through a queue, so faster workers take more of them. Each task is logged into its own directory with iterations counted from 0,
+    then merge_task_logs() moves them into one session in task order with global iteration and trial numbers,
+    so the merged session does not depend on which worker ran which task.
+
+    Use the fake simulator to try the orchestration without CoppeliaSim:
+
+        python generate_sim_stacking_demo.py --num_workers 4 --num_stacks 20 --fake_sim
+        python benchmark.py sim_workers --trials 400
+
+    Starting a worker takes a few seconds, so it only pays off with several tasks per worker.
+    generate_sim_stacking_demo.py is the only user, with one task per stack. main.py, including its
+    --is_testing rollouts, and generate_logoblocks_images.py still run on a single simulator.
+
+    Start the simulators too, one per port:
+
+        python generate_sim_stacking_demo.py --num_workers 4 --base_port 19997 \
+            --sim_command "coppeliaSim.sh -h -gREMOTEAPISERVERSERVICE_{port}_FALSE_TRUE simulation/simulation.ttt"
+"""
+import os
+import re
+import time
+import queue
+import shlex
+import shutil
+import subprocess
+import traceback
+import multiprocessing
+import numpy as np
+from logger import Logger
+from transition_log import TransitionLog, transition_log_directory
+
+# data directories holding files named by iteration, '%06d.<mode>...' as written by Logger
+ITERATION_FILE_DIRECTORIES = [os.path.join('data', 'color-images'), os.path.join('data', 'depth-images'),
+                              os.path.join('data', 'color-heightmaps'), os.path.join('data', 'depth-heightmaps'),
+                              'visualizations', os.path.join('transitions', 'data')]
+ITERATION_FILE = re.compile(r'^(\d+)(\..*)$')
+# main.py dump_sim_object_state_to_json() and process_actions variable files in data/variables
+VARIABLES_FILE = re.compile(r'^(.*?_)(\d+)((?:_.*)?\.json)$')
+
+
+def make_sim_robot(port, **robot_kwargs):
+    """ Create a simulation Robot connected to the remote API server on port, for SimWorkerPool(make_robot=...).
+
+    Use functools.partial(make_sim_robot, **robot_kwargs) so the worker processes can receive it.
+    """
+    from robot import Robot
+    return Robot(is_sim=True, tcp_port=port, **robot_kwargs)
+
+
+class FakeSimRobot(object):
+    """ Stand-in for a simulation Robot that needs no simulator, for testing SimWorkerPool orchestration.
+
+    Blocks teleport instead of following physics, every grasp and place succeeds, and each motion
+    sleeps for motion_seconds like a simulated arm motion would take.
+    """
+    def __init__(self, port, num_obj=4, motion_seconds=0.05, heightmap_resolution=0.002, workspace_limits=None):
+        self.port = port
+        self.is_sim = True
+        self.num_obj = num_obj
+        self.motion_seconds = motion_seconds
+        self.heightmap_resolution = heightmap_resolution
+        if workspace_limits is None:
+            workspace_limits = np.asarray([[-0.724, -0.276], [-0.224, 0.224], [-0.0001, 0.5]])
+        self.workspace_limits = workspace_limits
+        self.color_names = ['red', 'blue', 'green', 'yellow', 'brown', 'orange', 'gray', 'purple', 'cyan', 'pink'][:num_obj]
+        self.cam_intrinsics = np.asarray([[618.62, 0, 320], [0, 618.62, 240], [0, 0, 1]])
+        self.cam_pose = np.eye(4)
+        self.cam_depth_scale = 1
+        self.held_object = None
+        self.add_objects()
+
+    def restart_sim(self, connect=False):
+        self.held_object = None
+
+    def add_objects(self):
+        xy = np.random.uniform(self.workspace_limits[:2, 0] + 0.05, self.workspace_limits[:2, 1] - 0.05, size=(self.num_obj, 2))
+        self.positions = np.concatenate([xy, np.full((self.num_obj, 1), 0.025)], axis=1)
+        self.orientations = np.zeros((self.num_obj, 3))
+        self.orientations[:, 2] = np.random.uniform(0, 2 * np.pi, size=self.num_obj)
+
+    def get_obj_positions(self):
+        return self.positions.tolist()
+
+    def get_obj_positions_and_orientations(self):
+        return self.positions.tolist(), self.orientations.tolist()
+
+    def grasp(self, position, heightmap_rotation_angle, object_color=None, workspace_limits=None, go_home=True):
+        time.sleep(self.motion_seconds)
+        distances = np.linalg.norm(self.positions[:, :2] - np.asarray(position)[:2], axis=1)
+        if object_color is None:
+            object_color = int(np.argmin(distances))
+        self.held_object = object_color if distances[object_color] < 0.05 else None
+        grasp_success = self.held_object is not None
+        return grasp_success, grasp_success
+
+    def place(self, position, heightmap_rotation_angle, workspace_limits=None, distance_threshold=0.06, go_home=True, save_history=True, over_block=True, intended_position=None):
+        time.sleep(self.motion_seconds)
+        if self.held_object is None:
+            return False
+        self.positions[self.held_object] = [position[0], position[1], position[2] + 0.05]
+        self.orientations[self.held_object, 2] = heightmap_rotation_angle
+        self.held_object = None
+        return True
+
+    def check_row(self, object_color_sequence, **kwargs):
+        return True, len(object_color_sequence)
+
+    def check_stack(self, object_color_sequence, **kwargs):
+        return True, len(object_color_sequence)
+
+    def get_camera_data(self, return_heightmaps=False, **kwargs):
+        """ Flat gray images with each block drawn as a square at its height, in the get_camera_data() layout.
+        """
+        color_img = np.full((480, 640, 3), 128, dtype=np.uint8)
+        depth_img = np.full((480, 640), 0.5)
+        if not return_heightmaps:
+            return color_img, depth_img
+        size = np.round((self.workspace_limits[:2, 1] - self.workspace_limits[:2, 0]) / self.heightmap_resolution).astype(int)
+        depth_heightmap = np.zeros((size[1], size[0]))
+        color_heightmap = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+        half_width = int(0.025 / self.heightmap_resolution)
+        for i, (x, y, z) in enumerate(self.positions):
+            px = int((x - self.workspace_limits[0][0]) / self.heightmap_resolution)
+            py = int((y - self.workspace_limits[1][0]) / self.heightmap_resolution)
+            depth_heightmap[max(py - half_width, 0):py + half_width, max(px - half_width, 0):px + half_width] = z + 0.025
+            color_heightmap[max(py - half_width, 0):py + half_width, max(px - half_width, 0):px + half_width] = (40 * i) % 256
+        return depth_heightmap.copy(), color_heightmap, depth_heightmap, depth_heightmap.max(), color_img, depth_img
+
+
+def task_directory(base_directory, task_index):
+    return os.path.join(base_directory, 'workers', 'task-%06d' % task_index)
+
+
+def worker_main(worker_index, port, make_robot, run_task, task_queue, result_queue, base_directory):
+    """ Worker process loop, runs (task_index, task) pairs from task_queue until it gets None.
+
+    run_task(robot, task, logger) logs one task with iterations counted from 0 and returns its number of iterations.
+    """
+    try:
+        robot = make_robot(port)
+    except Exception:
+        result_queue.put((None, worker_index, 0, 0.0, traceback.format_exc()))
+        return
+    while True:
+        item = task_queue.get()
+        if item is None:
+            return
+        task_index, task = item
+        start = time.time()
+        try:
+            directory = task_directory(base_directory, task_index)
+            logger = Logger(False, os.path.dirname(directory), dir_name=os.path.basename(directory))
+            num_iterations = run_task(robot, task, logger)
+            logger.flush_images()
+            result_queue.put((task_index, worker_index, num_iterations, time.time() - start, None))
+        except Exception:
+            result_queue.put((task_index, worker_index, 0, time.time() - start, traceback.format_exc()))
+
+
+class SimWorkerPool(object):
+    """ Runs tasks on num_workers simulator connections in parallel and merges their logs, see the module docstring.
+
+    # Arguments
+
+        make_robot: make_robot(port) creates the robot for one worker, e.g. functools.partial(make_sim_robot, ...)
+            or functools.partial(FakeSimRobot, ...). It is sent to the worker processes, so it must be picklable.
+        base_port: worker i uses port base_port + i.
+        sim_command: optional command which starts one simulator, with {port} replaced by each worker's port.
+        sim_startup_seconds: time to wait for the simulators to start before the workers connect.
+    """
+    def __init__(self, num_workers, make_robot, base_port=19997, sim_command=None, sim_startup_seconds=10.0):
+        self.num_workers = num_workers
+        self.make_robot = make_robot
+        self.ports = [base_port + i for i in range(num_workers)]
+        self.sim_command = sim_command
+        self.sim_startup_seconds = sim_startup_seconds
+
+    def start_simulators(self):
+        if self.sim_command is None:
+            return []
+        processes = [subprocess.Popen(shlex.split(self.sim_command.format(port=port))) for port in self.ports]
+        print('SimWorkerPool: started %d simulators on ports %s, waiting %.0f seconds' % (len(processes), self.ports, self.sim_startup_seconds))
+        time.sleep(self.sim_startup_seconds)
+        return processes
+
+    def run(self, tasks, run_task, logging_directory, dir_name='', args=None, keep_task_directories=False):
+        """ Run run_task(robot, task, logger) for every task and merge the results into one logging session.
+
+        run_task must be a picklable top level function which logs one task with iterations counted from 0
+        and returns its number of iterations.
+
+        # Returns
+
+            logger: the Logger of the merged session.
+            results: list of (worker_index, num_iterations, seconds) for each task, in task order.
+        """
+        logger = Logger(False, logging_directory, args=args, dir_name=dir_name)
+        # spawn so the workers start clean, without copies of the parent's simulator connections or threads
+        context = multiprocessing.get_context('spawn')
+        task_queue = context.Queue()
+        result_queue = context.Queue()
+        for task_index, task in enumerate(tasks):
+            task_queue.put((task_index, task))
+        for _ in range(self.num_workers):
+            task_queue.put(None)
+
+        simulators = self.start_simulators()
+        workers = [context.Process(target=worker_main, args=(i, port, self.make_robot, run_task, task_queue, result_queue, logger.base_directory))
+                   for i, port in enumerate(self.ports)]
+        results = [None] * len(tasks)
+        errors = []
+        try:
+            for worker in workers:
+                worker.daemon = True
+                worker.start()
+            finished = 0
+            while finished < len(tasks):
+                try:
+                    task_index, worker_index, num_iterations, seconds, error = result_queue.get(timeout=1.0)
+                except queue.Empty:
+                    if not any(worker.is_alive() for worker in workers):
+                        errors.append('all workers exited with %d of %d tasks finished' % (finished, len(tasks)))
+                        break
+                    continue
+                if error is not None:
+                    print('SimWorkerPool: worker %d failed on task %s:\n%s' % (worker_index, task_index, error))
+                    errors.append(error)
+                if task_index is None:
+                    continue
+                results[task_index] = (worker_index, num_iterations, seconds)
+                finished += 1
+                print('SimWorkerPool: task %d of %d finished on worker %d, %d iterations in %.1f seconds'
+                      % (finished, len(tasks), worker_index, num_iterations, seconds))
+            for worker in workers:
+                worker.join(timeout=10.0)
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            for simulator in simulators:
+                simulator.terminate()
+        if errors:
+            raise RuntimeError('SimWorkerPool: %d tasks failed, the first error was:\n%s' % (len(errors), errors[0]))
+
+        task_directories = [task_directory(logger.base_directory, i) for i in range(len(tasks))]
+        merge_task_logs(logger, task_directories, [num_iterations for _, num_iterations, _ in results],
+                        worker_indices=[worker_index for worker_index, _, _ in results])
+        if not keep_task_directories:
+            shutil.rmtree(os.path.join(logger.base_directory, 'workers'))
+        return logger, results
+
+
+def renumber_files(source_directory, destination_directory, pattern, group, offset):
+    """ Move the files in source_directory whose names match pattern into destination_directory,
+    adding offset to the iteration number in the given regex group. Returns the number of files moved.
+    """
+    if not os.path.exists(source_directory):
+        return 0
+    if not os.path.exists(destination_directory):
+        os.makedirs(destination_directory)
+    moved = 0
+    for name in sorted(os.listdir(source_directory)):
+        match = pattern.match(name)
+        if match is None:
+            continue
+        number = match.group(group)
+        parts = list(match.groups())
+        # keep the zero padding width of the original name
+        parts[group - 1] = '%0*d' % (len(number), int(number) + offset)
+        os.replace(os.path.join(source_directory, name), os.path.join(destination_directory, ''.join(parts)))
+        moved += 1
+    return moved
+
+
+def merge_task_logs(logger, task_directories, task_iterations, worker_indices=None, trial_log_name='trial'):
+    """ Merge the logging sessions in task_directories, in order, into logger's session.
+
+    The transition logs of each task are appended after those of the previous tasks, and images and
+    state files are moved with iteration task_iterations[0] + ... + task_iterations[i - 1] added to their
+    iteration numbers. trial_log_name values count from 0 in each task, and are offset by the number of
+    trials in the previous tasks.
+    A 'worker-task' log records the task index and worker index of every iteration.
+    """
+    merged = {}
+    worker_task_log = []
+    iteration_offset = 0
+    trial_offset = 0
+    for task_index, (directory, num_iterations) in enumerate(zip(task_directories, task_iterations)):
+        logs = TransitionLog(transition_log_directory(os.path.join(directory, 'transitions'))).read_all()
+        if trial_log_name in logs and len(logs[trial_log_name]):
+            logs[trial_log_name] = logs[trial_log_name] + trial_offset
+            trial_offset = int(np.nanmax(logs[trial_log_name])) + 1
+        for name, log in logs.items():
+            merged.setdefault(name, []).append(log)
+        worker_index = worker_indices[task_index] if worker_indices is not None else -1
+        worker_task_log += [[task_index, worker_index]] * num_iterations
+
+        for subdirectory in ITERATION_FILE_DIRECTORIES:
+            renumber_files(os.path.join(directory, subdirectory), os.path.join(logger.base_directory, subdirectory),
+                           ITERATION_FILE, 1, iteration_offset)
+        renumber_files(os.path.join(directory, 'data', 'variables'), os.path.join(logger.base_directory, 'data', 'variables'),
+                       VARIABLES_FILE, 2, iteration_offset)
+        iteration_offset += num_iterations
+
+    for name, logs in merged.items():
+        # tasks may have logged a different number of columns, pad with nan like a missing value
+        num_cols = max(log.shape[1] for log in logs)
+        logs = [np.pad(log, ((0, 0), (0, num_cols - log.shape[1])), constant_values=np.nan) for log in logs]
+        logger.write_to_log(name, np.concatenate(logs))
+    logger.write_to_log('worker-task', worker_task_log)
+    print('merge_task_logs(): merged %d tasks with %d iterations and %d logs into %s'
+          % (len(task_directories), iteration_offset, len(merged), logger.base_directory))
+    return iteration_offset
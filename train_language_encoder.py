@@ -29,6 +29,7 @@ from encoders import LSTMEncoder
 from language_embedders import RandomEmbedder
 from mlp import MLP 
 from data import DatasetReader
+from metrics import sync_scores
 
 np.random.seed(12) 
 torch.manual_seed(12) 
@@ -482,6 +483,7 @@ class FlatLanguageTrainer(LanguageTrainer):
                     bin_dict[k] += v
             except KeyError:
                 continue
+        all_res_dicts = sync_scores(all_res_dicts) 
 
         with open(self.checkpoint_dir.joinpath("bin_dict.json"), "w") as f1: 
             json.dump(bin_dict, f1) 
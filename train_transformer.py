@@ -8,6 +8,9 @@ import pathlib
 import pdb 
 import subprocess 
 import copy 
+import time 
+import resource 
+import contextlib 
 from io import StringIO
 from collections import defaultdict
 
@@ -29,13 +32,15 @@ from allennlp.training.learning_rate_schedulers import NoamLR
 import pandas as pd 
 
 from transformer import TransformerEncoder, ResidualTransformerEncoder, image_to_tiles, tiles_to_image
-from metrics import TransformerTeleportationMetric, MSEMetric, AccuracyMetric, F1Metric
+from metrics import TransformerTeleportationMetric, MSEMetric, AccuracyMetric, F1Metric, sync_scores
 from language_embedders import RandomEmbedder, GloveEmbedder, BERTEmbedder
 from data import DatasetReader
 from train_language_encoder import get_free_gpu, load_data, get_vocab, LanguageTrainer, FlatLanguageTrainer
 
 logger = logging.getLogger(__name__)
 
+PRECISIONS = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
 class TransformerTrainer(FlatLanguageTrainer): 
     def __init__(self,
                  train_data: List,
@@ -63,7 +68,9 @@ class TransformerTrainer(FlatLanguageTrainer):
                  do_regression: bool = False,
                  do_reconstruction: bool = False,
                  n_epochs_pre_valid: int = 0,
-                 save_all_eval: bool = False):
+                 save_all_eval: bool = False,
+                 precision: str = "fp32",
+                 accumulation_steps: int = 1):
         super(TransformerTrainer, self).__init__(train_data=train_data,
                                                  val_data=val_data,
                                                  encoder=encoder,
@@ -110,8 +117,92 @@ class TransformerTrainer(FlatLanguageTrainer):
         if self.do_reconstruction:
             self.reconstruction_metric = AccuracyMetric() 
 
+        self.set_precision(precision) 
+        self.accumulation_steps = max(1, accumulation_steps) 
+        self.pending_steps = 0
+
         self.set_all_seeds(seed) 
 
+    def set_precision(self, precision):
+        """
+        pick the autocast dtype, falling back to whichever low precision the device supports 
+        """
+        if precision not in PRECISIONS:
+            raise AssertionError(f"precision must be in {list(PRECISIONS.keys())}, got {precision}")
+        self.amp_device_type = "cuda" if torch.device(self.device).type == "cuda" else "cpu"
+        if precision == "fp16" and self.amp_device_type == "cpu":
+            print(f"fp16 autocast is not supported on cpu, using bf16") 
+            precision = "bf16"
+        if precision == "bf16" and self.amp_device_type == "cuda" and not torch.cuda.is_bf16_supported():
+            print(f"bf16 is not supported on this gpu, using fp16") 
+            precision = "fp16"
+        self.precision = precision
+        # loss scaling is only needed for fp16, bf16 has the fp32 exponent range 
+        self.scaler = torch.cuda.amp.GradScaler(enabled = precision == "fp16") 
+
+    def autocast(self):
+        if self.precision == "fp32":
+            return contextlib.nullcontext()
+        return torch.autocast(device_type = self.amp_device_type, dtype = PRECISIONS[self.precision]) 
+
+    def compute_loss(self, batch_instance, outputs, it):
+        if self.output_type == "per-pixel": 
+            return self.compute_weighted_loss(batch_instance, outputs, it) 
+        elif self.output_type == "per-patch": 
+            return self.compute_patch_loss(batch_instance, outputs, self.next_to_prev_weight) 
+        elif self.output_type == "patch-softmax":
+            return self.compute_xent_loss(batch_instance, outputs) 
+        else:
+            raise AssertionError("must have output in ['per-pixel', 'per-patch', 'patch-softmax']") 
+
+    def train_step(self, batch_instance, epoch, b):
+        """
+        forward and backward one micro-batch, stepping the optimizer every accumulation_steps micro-batches. 
+        returns False if the example was skipped 
+        """
+        with self.autocast():
+            outputs = self.encoder(batch_instance) 
+            # skip bad examples 
+            if outputs is None:
+                return False
+            loss = self.compute_loss(batch_instance, outputs, (epoch + 1) * (b+1)) 
+        self.scaler.scale(loss / self.accumulation_steps).backward() 
+        self.pending_steps += 1
+        if self.pending_steps == self.accumulation_steps:
+            self.optimizer_step(epoch, b) 
+        return True
+
+    def optimizer_step(self, epoch, b):
+        self.scaler.step(self.optimizer) 
+        self.scaler.update() 
+        self.optimizer.zero_grad() 
+        self.pending_steps = 0
+        # schedule over optimizer steps, same as before when accumulation_steps is 1 
+        it = (epoch + 1) * (b // self.accumulation_steps + 1) 
+        self.scheduler.step_batch(it) 
+
+    def start_train_epoch(self):
+        self.encoder.train() 
+        self.optimizer.zero_grad() 
+        self.pending_steps = 0
+        if self.amp_device_type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device) 
+        self.epoch_start_time = time.time() 
+
+    def finish_train_epoch(self, epoch, b, num_batches):
+        # flush a partial accumulation at the end of the epoch 
+        if self.pending_steps > 0:
+            self.optimizer_step(epoch, b) 
+        elapsed = time.time() - self.epoch_start_time
+        if self.amp_device_type == "cuda":
+            peak_mb = torch.cuda.max_memory_allocated(self.device) / 2**20
+            peak_name = "peak gpu memory"
+        else:
+            # ru_maxrss is in KB on linux and is a process-wide high-water mark 
+            peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+            peak_name = "peak rss"
+        print(f"Epoch {epoch} trained {num_batches} batches in {elapsed:.1f}s ({elapsed / max(num_batches, 1):.3f}s/batch), {peak_name} {peak_mb:.0f} MB, precision {self.precision}, accumulation steps {self.accumulation_steps}") 
+
     def set_all_seeds(self, seed):
         np.random.seed(seed) 
         torch.manual_seed(seed) 
@@ -119,30 +210,14 @@ class TransformerTrainer(FlatLanguageTrainer):
 
     def train_and_validate_one_epoch(self, epoch): 
         print(f"Training epoch {epoch}...") 
-        self.encoder.train() 
+        self.start_train_epoch() 
         skipped = 0
+        b = 0
         for b, batch_instance in tqdm(enumerate(self.train_data)): 
-
-            self.optimizer.zero_grad() 
-            outputs = self.encoder(batch_instance) 
-            #next_outputs, prev_outputs = self.encoder(batch_instance) 
-            # skip bad examples 
-            if outputs is None:
+            if not self.train_step(batch_instance, epoch, b): 
                 skipped += 1
-                continue
-            if self.output_type == "per-pixel": 
-                loss = self.compute_weighted_loss(batch_instance, outputs, (epoch + 1) * (b+1)) 
-            elif self.output_type == "per-patch": 
-                loss = self.compute_patch_loss(batch_instance, outputs, self.next_to_prev_weight) 
-            elif self.output_type == "patch-softmax":
-                loss = self.compute_xent_loss(batch_instance, outputs) 
-            else:
-                raise AssertionError("must have output in ['per-pixel', 'per-patch', 'patch-softmax']") 
-            loss.backward() 
-            self.optimizer.step() 
-            it = (epoch + 1) * (b+1) 
-            self.scheduler.step_batch(it) 
 
+        self.finish_train_epoch(epoch, b, len(self.train_data)) 
         print(f"skipped {skipped} examples") 
         print(f"Validating epoch {epoch}...") 
 
@@ -150,9 +225,12 @@ class TransformerTrainer(FlatLanguageTrainer):
         total = 0
         if epoch >= self.n_epochs_pre_valid:
             self.encoder.eval() 
+            score_dicts = []
             for b, dev_batch_instance in tqdm(enumerate(self.val_data)): 
                 #prev_pixel_acc, block_acc = self.validate(dev_batch_instance, epoch, b, 0) 
-                score_dict = self.validate(dev_batch_instance, epoch, b, 0) 
+                score_dicts.append(self.validate(dev_batch_instance, epoch, b, 0))
+            # scores stay on device until here 
+            for score_dict in sync_scores(score_dicts): 
                 for k,v in score_dict.items():
                     if type(v) in [float, int, np.float64, np.int]: 
                         total_dict[k] += score_dict[k]
@@ -320,6 +398,7 @@ class TransformerTrainer(FlatLanguageTrainer):
 
         return total_loss
 
+    @torch.no_grad()
     def validate(self, batch_instance, epoch_num, batch_num, instance_num): 
         self.encoder.eval() 
         outputs = self.encoder(batch_instance) 
@@ -341,42 +420,22 @@ class TransformerTrainer(FlatLanguageTrainer):
         else:
             pass
 
-        prev_p, prev_r, prev_f1 = self.f1_metric.compute_f1(batch_instance["prev_pos_for_pred"], prev_position) 
-        next_p, next_r, next_f1 = self.f1_metric.compute_f1(batch_instance["next_pos_for_pred"], next_position) 
-        masked_prev_p, masked_prev_r, masked_prev_f1 = self.masked_f1_metric.compute_f1(batch_instance["prev_pos_for_pred"], prev_position) 
-        masked_next_p, masked_next_r, masked_next_f1 = self.masked_f1_metric.compute_f1(batch_instance["next_pos_for_pred"], next_position) 
-
-        all_tele_scores = []
-        all_oracle_tele_scores = []
-        all_tele_dicts = []
-        block_accs = []
-        pred_centers, true_centers = [], []
-        bsz = prev_position.shape[0]
-        for batch_idx in range(bsz): 
-            if self.do_regression:
-                # NOT AS ACCURATE 
-                # next_xyz = outputs['next_pos_xyz'].reshape(bsz, 3)[batch_idx]
-                #pdb.set_trace() 
-                next_xyz_batch = None
-            else:
-                next_xyz_batch = None
-
-            tele_dict = self.teleportation_metric.get_metric(batch_instance["next_pos_for_acc"][batch_idx].clone(),
-                                                             batch_instance["prev_pos_for_acc"][batch_idx].clone(),
-                                                             prev_position[batch_idx].clone(),
-                                                             outputs["next_position"][batch_idx].clone(),
-                                                             batch_instance["block_to_move"][batch_idx].clone(),
-                                                             next_xyz = next_xyz_batch) 
-            all_tele_dicts.append(tele_dict)
-            all_tele_scores.append(tele_dict['distance']) 
-            all_oracle_tele_scores.append(tele_dict['oracle_distance']) 
-            block_accs.append(tele_dict['block_acc']) 
-            pred_centers.append(tele_dict['pred_center'])
-            true_centers.append(tele_dict['true_center']) 
-
-        total_tele_score = np.mean(all_tele_scores) 
-        total_oracle_tele_score = np.mean(all_oracle_tele_scores) 
-        block_accuracy = np.mean(block_accs) 
+        # metrics are 0-d tensors on device, synced once per epoch by sync_scores 
+        prev_p, prev_r, prev_f1 = self.f1_metric.compute_f1_tensors(batch_instance["prev_pos_for_pred"], prev_position) 
+        next_p, next_r, next_f1 = self.f1_metric.compute_f1_tensors(batch_instance["next_pos_for_pred"], next_position) 
+        masked_prev_p, masked_prev_r, masked_prev_f1 = self.masked_f1_metric.compute_f1_tensors(batch_instance["prev_pos_for_pred"], prev_position) 
+        masked_next_p, masked_next_r, masked_next_f1 = self.masked_f1_metric.compute_f1_tensors(batch_instance["next_pos_for_pred"], next_position) 
+
+        # NOT AS ACCURATE to use the regressed next_pos_xyz, so the teleportation metric always uses the predicted patches 
+        tele_dict = self.teleportation_metric.get_batch_metric(batch_instance["next_pos_for_acc"],
+                                                               batch_instance["prev_pos_for_acc"],
+                                                               prev_position,
+                                                               outputs["next_position"],
+                                                               batch_instance["block_to_move"]) 
+
+        total_tele_score = tele_dict['distance'].mean() 
+        total_oracle_tele_score = tele_dict['oracle_distance'].mean() 
+        block_accuracy = tele_dict['block_acc'].mean() 
 
         bin_dict = defaultdict(list) 
 
@@ -403,6 +462,9 @@ class TransformerTrainer(FlatLanguageTrainer):
 
 
         if epoch_num > self.generate_after_n: 
+            pred_centers = tele_dict['pred_center'].tolist() 
+            true_centers = tele_dict['true_center'].tolist() 
+            distances = tele_dict['distance'].tolist() 
             for i in range(outputs["next_position"].shape[0]):
                 output_path = self.checkpoint_dir.joinpath(f"batch_{batch_num}").joinpath(f"instance_{i}")
                 output_path.mkdir(parents = True, exist_ok=True)
@@ -434,7 +496,7 @@ class TransformerTrainer(FlatLanguageTrainer):
                                               prev_position[i], 
                                               output_path.joinpath("prev"),
                                               caption = command) 
-                bin_distance = int(all_tele_dicts[i]["distance"])
+                bin_distance = int(distances[i])
                 bin_dict[bin_distance].append(str(output_path) )
 
 
@@ -670,9 +732,12 @@ def main(args):
     elif args.embedder == "glove":
         embedder = GloveEmbedder(tokenizer, train_vocab, args.embedding_file, args.embedding_dim, trainable=True) 
     elif args.embedder.startswith("bert"): 
-        embedder = BERTEmbedder(model_name = args.embedder,  max_seq_len = args.max_seq_length) 
+        embedder = BERTEmbedder(model_name = args.embedder,  max_seq_len = args.max_seq_length, cache_dir = args.bert_cache_dir) 
     else:
         raise NotImplementedError(f"No embedder {args.embedder}") 
+    if hasattr(embedder, "token_to_id"):
+        # batches then carry integer command ids, embedded with one lookup per batch 
+        dataset_reader.set_token_to_id(embedder.token_to_id)
 
     if args.top_only:
         depth = 1
@@ -699,7 +764,10 @@ def main(args):
                           init_scale = args.init_scale, 
                           do_regression = False,
                           do_reconstruction = args.do_reconstruction,
-                          pretrained_weights = args.pretrained_weights) 
+                          pretrained_weights = args.pretrained_weights,
+                          attention_impl = args.attention_impl,
+                          locality_mask = args.locality_mask,
+                          locality_neighborhood = args.locality_neighborhood) 
     if args.encoder_type == "ResidualTransformerEncoder":
         encoder_kwargs["do_residual"] = args.do_residual 
     # Initialize encoder 
@@ -774,7 +842,9 @@ def main(args):
                               prev_weight = args.prev_weight,
                               do_regression = args.do_regression,
                               do_reconstruction = args.do_reconstruction,
-                              n_epochs_pre_valid = args.n_epochs_pre_valid)
+                              n_epochs_pre_valid = args.n_epochs_pre_valid,
+                              precision = args.precision,
+                              accumulation_steps = args.accumulation_steps)
         trainer.train() 
 
     else:
@@ -860,6 +930,7 @@ if __name__ == "__main__":
     parser.add_argument("--embedder", type=str, default="random", choices = ["random", "glove", "bert-base-cased", "bert-base-uncased"])
     parser.add_argument("--embedding-file", type=str, help="path to pretrained glove embeddings")
     parser.add_argument("--embedding-dim", type=int, default=300) 
+    parser.add_argument("--bert-cache-dir", type=str, default=None, help="directory of cached frozen BERT command embeddings, shared with the robot, defaults to ~/.cache/bert_embeddings") 
     # transformer parameters 
     parser.add_argument("--encoder-type", type=str, default="TransformerEncoder", choices = ["TransformerEncoder", "ResidualTransformerEncoder"], help = "choice of dual-stream transformer encoder or one that bases next prediction on previous transformer representation")
     parser.add_argument("--pos-encoding-type", type = str, default="learned") 
@@ -889,6 +960,11 @@ if __name__ == "__main__":
     parser.add_argument("--score-type", type=str, default="acc", choices = ["acc", "block_acc", "tele_score"])
     parser.add_argument("--zero-weight", type=float, default = 0.05, help = "weight for loss weighting negative vs positive examples") 
     parser.add_argument("--init-scale", type=int, default = 4, help = "initalization scale for transformer weights")
+    parser.add_argument("--attention-impl", type=str, default="sdpa", choices = ["sdpa", "einsum"], help = "sdpa uses fused scaled_dot_product_attention (torch >= 2.1, otherwise einsum) when attention weights are not logged, einsum always builds the attention matrix")
+    parser.add_argument("--locality-mask", action="store_true", help="image patches only attend to nearby patches and the language, with compute linear in the number of patches")
+    parser.add_argument("--locality-neighborhood", type=int, default = 5, help="size of the region to attend to in locality masking, extends in each direction from the center point")
+    parser.add_argument("--precision", type=str, default="fp32", choices = ["fp32", "bf16", "fp16"], help = "autocast precision for training, fp16 uses loss scaling and falls back to bf16 on cpu")
+    parser.add_argument("--accumulation-steps", type=int, default=1, help = "accumulate gradients over n micro-batches before each optimizer step")
     parser.add_argument("--seed", type=int, default=12) 
     parser.add_argument("--do-regression", action="store_true", help="add a regression task to learning") 
     parser.add_argument("--do-reconstruction", action="store_true", help="add a reconstruction task to learning") 
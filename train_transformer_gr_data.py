@@ -30,7 +30,7 @@ from allennlp.training.learning_rate_schedulers import NoamLR
 import pandas as pd 
 
 from transformer import TransformerEncoder, ResidualTransformerEncoder, image_to_tiles, tiles_to_image
-from metrics import  MSEMetric, AccuracyMetric, GoodRobotTransformerTeleportationMetric, F1Metric
+from metrics import  MSEMetric, AccuracyMetric, GoodRobotTransformerTeleportationMetric, F1Metric, sync_scores
 from language_embedders import RandomEmbedder, GloveEmbedder, BERTEmbedder
 from data import DatasetReader, GoodRobotDatasetReader
 from train_language_encoder import get_free_gpu, load_data, get_vocab, LanguageTrainer, FlatLanguageTrainer
@@ -64,7 +64,9 @@ class GoodRobotTransformerTrainer(TransformerTrainer):
                  prev_weight: float = 1.0,
                  do_regression: bool = False,
                  do_reconstruction: bool = False,
-                 long_command: bool = False): 
+                 long_command: bool = False,
+                 precision: str = "fp32",
+                 accumulation_steps: int = 1): 
         super(GoodRobotTransformerTrainer, self).__init__(train_data=train_data,
                                                  val_data=val_data,
                                                  encoder=encoder,
@@ -88,7 +90,9 @@ class GoodRobotTransformerTrainer(TransformerTrainer):
                                                  next_weight=next_weight,
                                                  prev_weight=prev_weight,
                                                  do_reconstruction=do_reconstruction,
-                                                 do_regression=do_regression)
+                                                 do_regression=do_regression,
+                                                 precision=precision,
+                                                 accumulation_steps=accumulation_steps)
 
         self.teleportation_metric = GoodRobotTransformerTeleportationMetric(block_size=block_size,
                                                                             image_size = resolution,
@@ -100,29 +104,14 @@ class GoodRobotTransformerTrainer(TransformerTrainer):
 
     def train_and_validate_one_epoch(self, epoch): 
         print(f"Training epoch {epoch}...") 
-        self.encoder.train() 
+        self.start_train_epoch() 
         skipped = 0
+        b = 0
         for b, batch_instance in tqdm(enumerate(self.train_data)): 
-            self.optimizer.zero_grad() 
-            outputs = self.encoder(batch_instance) 
-            #next_outputs, prev_outputs = self.encoder(batch_instance) 
-            # skip bad examples 
-            if outputs is None:
+            if not self.train_step(batch_instance, epoch, b): 
                 skipped += 1
-                continue
-            if self.output_type == "per-pixel": 
-                loss = self.compute_weighted_loss(batch_instance, outputs, (epoch + 1) * (b+1)) 
-            elif self.output_type == "per-patch": 
-                loss = self.compute_patch_loss(batch_instance, outputs, self.next_to_prev_weight) 
-            elif self.output_type == "patch-softmax":
-                loss = self.compute_xent_loss(batch_instance, outputs) 
-            else:
-                raise AssertionError("must have output in ['per-pixel', 'per-patch', 'patch-softmax']") 
-            loss.backward() 
-            self.optimizer.step() 
-            it = (epoch + 1) * (b+1) 
-            self.scheduler.step_batch(it) 
 
+        self.finish_train_epoch(epoch, b, len(self.train_data)) 
         print(f"skipped {skipped} examples") 
         print(f"Validating epoch {epoch}...") 
         total_prev_acc, total_next_acc = 0.0, 0.0
@@ -133,9 +122,12 @@ class GoodRobotTransformerTrainer(TransformerTrainer):
         total_prev_recon, total_next_recon = 0.0, 0.0
 
         self.encoder.eval() 
+        score_dicts = []
         for b, dev_batch_instance in tqdm(enumerate(self.val_data)): 
             #prev_pixel_acc, block_acc = self.validate(dev_batch_instance, epoch, b, 0) 
-            score_dict = self.validate(dev_batch_instance, epoch, b, 0) 
+            score_dicts.append(self.validate(dev_batch_instance, epoch, b, 0))
+        # scores stay on device until here 
+        for score_dict in sync_scores(score_dicts): 
             total_prev_acc += score_dict['prev_f1']
             total_next_acc += score_dict['next_f1']
             total_block_acc += score_dict['block_acc']
@@ -373,6 +365,7 @@ class GoodRobotTransformerTrainer(TransformerTrainer):
         plt.savefig(file_path) 
         plt.close() 
 
+    @torch.no_grad()
     def validate(self, batch_instance, epoch_num, batch_num, instance_num): 
         self.encoder.eval() 
         outputs = self.encoder(batch_instance) 
@@ -381,24 +374,18 @@ class GoodRobotTransformerTrainer(TransformerTrainer):
 
         prev_position = tiles_to_image(prev_position, self.patch_size, output_type="per-patch", upsample=True) 
         next_position = tiles_to_image(next_position, self.patch_size, output_type="per-patch", upsample=True) 
-        # f1 metric 
-        prev_p, prev_r, prev_f1 = self.f1_metric.compute_f1(batch_instance["prev_pos_for_pred"].squeeze(-1), prev_position) 
-        next_p, next_r, next_f1 = self.f1_metric.compute_f1(batch_instance["next_pos_for_pred"].squeeze(-1), next_position) 
+        # f1 metric, kept on device until the end of the epoch 
+        prev_p, prev_r, prev_f1 = self.f1_metric.compute_f1_tensors(batch_instance["prev_pos_for_pred"].squeeze(-1), prev_position) 
+        next_p, next_r, next_f1 = self.f1_metric.compute_f1_tensors(batch_instance["next_pos_for_pred"].squeeze(-1), next_position) 
         # block accuracy metric 
         # looks like there's some shuffling going on here 
-        tele_metric_data = {"distance": [], "block_acc": [], "pred_center": [], "true_center": []}
-        
-        for i in range(outputs['next_position'].shape[0]):
-            single_tele_dict = self.compute_teleportation_metric(batch_instance["pairs"][i], prev_position[i].detach().clone(), next_position[i].detach().clone())
-            tele_metric_data['distance'].append(single_tele_dict['distance'])
-            tele_metric_data['block_acc'].append(single_tele_dict['block_acc'])
-            tele_metric_data['pred_center'].append(single_tele_dict['pred_center'])
-            tele_metric_data['true_center'].append(single_tele_dict['true_center'])
+        tele_metric_data = self.compute_teleportation_metric(batch_instance["pairs"], prev_position, next_position) 
 
-        block_acc = np.mean(tele_metric_data['block_acc'])
-        tele_dist = np.mean(tele_metric_data['distance'])
+        block_acc = tele_metric_data['block_acc'].mean() 
+        tele_dist = tele_metric_data['distance'].mean() 
 
         if epoch_num > self.generate_after_n: 
+            tele_metric_data = {k: v.tolist() for k, v in tele_metric_data.items()}
             for i in range(outputs["next_position"].shape[0]):
                 output_path = self.checkpoint_dir.joinpath(f"batch_{batch_num}").joinpath(f"instance_{i}")
                 output_path.mkdir(parents = True, exist_ok=True)
@@ -458,7 +445,7 @@ class GoodRobotTransformerTrainer(TransformerTrainer):
         return precision, recall, f1
 
     def compute_teleportation_metric(self, pairs,  pred_pos, next_pos):
-        res = self.teleportation_metric.get_metric(pairs, pred_pos, next_pos)
+        res = self.teleportation_metric.get_batch_metric(pairs, pred_pos, next_pos)
         return res
 
 def main(args):
@@ -500,7 +487,9 @@ def main(args):
                                             is_bert = "bert" in args.embedder,
                                             data_subset = args.data_subset, 
                                             overfit=args.overfit,
-                                            prep_code=args.prep_code) 
+                                            prep_code=args.prep_code,
+                                            num_workers = args.num_workers,
+                                            pin_memory = args.cuda is not None) 
 
     checkpoint_dir = pathlib.Path(args.checkpoint_dir)
     if not args.test:
@@ -523,9 +512,12 @@ def main(args):
     elif args.embedder == "glove":
         embedder = GloveEmbedder(tokenizer, train_vocab, args.embedding_file, args.embedding_dim, trainable=True) 
     elif args.embedder.startswith("bert"): 
-        embedder = BERTEmbedder(model_name = args.embedder,  max_seq_len = args.max_seq_length) 
+        embedder = BERTEmbedder(model_name = args.embedder,  max_seq_len = args.max_seq_length, cache_dir = args.bert_cache_dir) 
     else:
         raise NotImplementedError(f"No embedder {args.embedder}") 
+    if hasattr(embedder, "token_to_id"):
+        # batches then carry integer command ids, embedded with one lookup per batch 
+        dataset_reader.set_token_to_id(embedder.token_to_id)
 
     depth = 1
     encoder_cls = ResidualTransformerEncoder if args.encoder_type == "ResidualTransformerEncoder" else TransformerEncoder
@@ -548,7 +540,10 @@ def main(args):
                           init_scale = args.init_scale, 
                           do_regression = False,
                           do_reconstruction = args.do_reconstruction,
-                          pretrained_weights = args.pretrained_weights) 
+                          pretrained_weights = args.pretrained_weights,
+                          attention_impl = args.attention_impl,
+                          locality_mask = args.locality_mask,
+                          locality_neighborhood = args.locality_neighborhood) 
     if args.encoder_type == "ResidualTransformerEncoder":
         encoder_kwargs["do_residual"] = args.do_residual 
     # Initialize encoder 
@@ -623,7 +618,9 @@ def main(args):
                               next_weight = args.next_weight,
                               prev_weight = args.prev_weight,
                               do_regression = False,
-                              do_reconstruction = args.do_reconstruction) 
+                              do_reconstruction = args.do_reconstruction,
+                              precision = args.precision,
+                              accumulation_steps = args.accumulation_steps) 
         trainer.train() 
 
     else:
@@ -682,6 +679,7 @@ if __name__ == "__main__":
     # data 
     parser.add_argument("--path", type=str, default = "blocks_data/trainset_v2.json", help="path to train data")
     parser.add_argument("--batch-size", type=int, default = 32) 
+    parser.add_argument("--num-workers", type=int, default = 4, help = "worker processes that build batches in the background, 0 builds them on the main thread")
     parser.add_argument("--max-seq-length", type=int, default = 65) 
     parser.add_argument("--resolution", type=int, help="resolution to discretize input state", default=64) 
     parser.add_argument("--next-weight", type=float, default=1)
@@ -707,6 +705,7 @@ if __name__ == "__main__":
     parser.add_argument("--embedder", type=str, default="random", choices = ["random", "glove", "bert-base-cased", "bert-base-uncased"])
     parser.add_argument("--embedding-file", type=str, help="path to pretrained glove embeddings")
     parser.add_argument("--embedding-dim", type=int, default=300) 
+    parser.add_argument("--bert-cache-dir", type=str, default=None, help="directory of cached frozen BERT command embeddings, shared with the robot, defaults to ~/.cache/bert_embeddings") 
     # transformer parameters 
     parser.add_argument("--encoder-type", type=str, default="TransformerEncoder", choices = ["TransformerEncoder", "ResidualTransformerEncoder"], help = "choice of dual-stream transformer encoder or one that bases next prediction on previous transformer representation")
     parser.add_argument("--pos-encoding-type", type = str, default="learned") 
@@ -736,6 +735,11 @@ if __name__ == "__main__":
     parser.add_argument("--zero-weight", type=float, default = 0.05, help = "weight for loss weighting negative vs positive examples") 
     parser.add_argument("--do-reconstruction", type=bool, default=False, action="store_true")
     parser.add_argument("--init-scale", type=int, default = 4, help = "initalization scale for transformer weights")
+    parser.add_argument("--attention-impl", type=str, default="sdpa", choices = ["sdpa", "einsum"], help = "sdpa uses fused scaled_dot_product_attention (torch >= 2.1, otherwise einsum) when attention weights are not logged, einsum always builds the attention matrix")
+    parser.add_argument("--locality-mask", action="store_true", help="image patches only attend to nearby patches and the language, with compute linear in the number of patches")
+    parser.add_argument("--locality-neighborhood", type=int, default = 5, help="size of the region to attend to in locality masking, extends in each direction from the center point")
+    parser.add_argument("--precision", type=str, default="fp32", choices = ["fp32", "bf16", "fp16"], help = "autocast precision for training, fp16 uses loss scaling and falls back to bf16 on cpu")
+    parser.add_argument("--accumulation-steps", type=int, default=1, help = "accumulate gradients over n micro-batches before each optimizer step")
     parser.add_argument("--seed", type=int, default=12) 
 
     args = parser.parse_args() 
@@ -64,7 +64,9 @@ class NavigationTransformerTrainer(TransformerTrainer):
                  seed: int = 12, 
                  zero_weight: float = 0.05,
                  debug_image_top_k: int = None,
-                 debug_image_threshold: float = None):
+                 debug_image_threshold: float = None,
+                 precision: str = "fp32",
+                 accumulation_steps: int = 1):
         super(NavigationTransformerTrainer, self).__init__(train_data=[],
                                                  val_data=[],
                                                  encoder=encoder,
@@ -84,7 +86,9 @@ class NavigationTransformerTrainer(TransformerTrainer):
                                                  depth=depth, 
                                                  best_epoch=best_epoch,
                                                  seed=seed,
-                                                 zero_weight=zero_weight) 
+                                                 zero_weight=zero_weight,
+                                                 precision=precision,
+                                                 accumulation_steps=accumulation_steps) 
         self.f1_metric = F1Metric() 
         self.dataset_reader = dataset_reader
         self.batch_size = batch_size 
@@ -140,25 +144,17 @@ class NavigationTransformerTrainer(TransformerTrainer):
 
     def train_and_validate_one_epoch(self, epoch): 
         print(f"Training epoch {epoch}...") 
-        self.encoder.train() 
+        self.start_train_epoch() 
         skipped = 0
         step = 0
         for b, batch_instance in enumerate(self.dataset_reader.read("train")): 
             actual_batches = self.split_large_batch(batch_instance)
             for sb, small_batch in enumerate(actual_batches):
                 is_best = False
-                self.optimizer.zero_grad() 
-                outputs = self.encoder(small_batch) 
-                # skip bad examples 
-                if outputs is None:
+                if not self.train_step(small_batch, epoch, step): 
                     skipped += 1
                     continue
 
-                loss = self.compute_patch_loss(small_batch, outputs, self.next_to_prev_weight) 
-                loss.backward() 
-                self.optimizer.step() 
-                it = (epoch + 1) * (step+1) 
-                self.scheduler.step_batch(it) 
                 #print(f"step: {step+1} checkpoint_every: {self.checkpoint_every}  {(step +1) % self.checkpoint_every}")
                 if (step+1) % self.checkpoint_every == 0:
                     step_acc = self.validate_one_epoch(epoch, step, self.validation_limit)
@@ -170,6 +166,7 @@ class NavigationTransformerTrainer(TransformerTrainer):
                     self.save_model(f"{epoch}_{step}", is_best) 
 
                 step += 1
+        self.finish_train_epoch(epoch, max(step - 1, 0), step) 
         print(f"skipped {skipped} examples") 
         epoch_acc = self.validate_one_epoch(epoch, step, 10 * self.validation_limit) 
         print(f"Epoch {epoch} has next pixel F1 {epoch_acc * 100:.2f}") 
@@ -178,6 +175,9 @@ class NavigationTransformerTrainer(TransformerTrainer):
         else:
             raise AssertionError(f"invalid score type {self.score_type}")
 
+    def compute_loss(self, batch_instance, outputs, it):
+        return self.compute_patch_loss(batch_instance, outputs, self.next_to_prev_weight) 
+
     def compute_patch_loss(self, inputs, outputs, next_to_prev_weight = [1.0, 1.0]):
         """
         compute per-patch for each patch 
@@ -369,9 +369,12 @@ def main(args):
     elif args.embedder == "glove":
         embedder = GloveEmbedder(tokenizer, train_vocab, args.embedding_file, args.embedding_dim, trainable=True) 
     elif args.embedder.startswith("bert"): 
-        embedder = BERTEmbedder(model_name = args.embedder,  max_seq_len = args.max_len) 
+        embedder = BERTEmbedder(model_name = args.embedder,  max_seq_len = args.max_len, cache_dir = args.bert_cache_dir) 
     else:
         raise NotImplementedError(f"No embedder {args.embedder}") 
+    if hasattr(embedder, "token_to_id"):
+        # batches then carry integer command ids, embedded with one lookup per batch 
+        dataset_reader.set_token_to_id(embedder.token_to_id)
 
     depth = 1
     encoder_cls = NavigationTransformerEncoder
@@ -392,7 +395,8 @@ def main(args):
                           log_weights = args.test,
                           locality_mask = args.locality_mask,
                           locality_neighborhood = args.locality_neighborhood,
-                          init_scale = args.init_scale) 
+                          init_scale = args.init_scale,
+                          attention_impl = args.attention_impl) 
 
     # Initialize encoder 
     encoder = encoder_cls(**encoder_kwargs)
@@ -475,7 +479,9 @@ def main(args):
                             seed = args.seed,
                             zero_weight = args.zero_weight,
                             debug_image_top_k = args.debug_image_top_k,
-                            debug_image_threshold = args.debug_image_threshold) 
+                            debug_image_threshold = args.debug_image_threshold,
+                            precision = args.precision,
+                            accumulation_steps = args.accumulation_steps) 
 
     if not args.test:
         trainer.train() 
@@ -26,7 +26,7 @@ from encoders import LSTMEncoder
 from language_embedders import RandomEmbedder, GloveEmbedder, BERTEmbedder
 from unet_module import BaseUNet, UNetWithLanguage, UNetWithBlocks
 from unet_shared import SharedUNet
-from metrics import UNetTeleportationMetric, F1Metric
+from metrics import UNetTeleportationMetric, F1Metric, sync_scores
 from mlp import MLP 
 from losses import ScheduledWeightedCrossEntropyLoss
 
@@ -114,8 +114,11 @@ class UNetLanguageTrainer(FlatLanguageTrainer):
         total_next_recon_score = 0.0 
 
         self.encoder.eval() 
+        score_dicts = []
         for b, dev_batch_instance in tqdm(enumerate(self.val_data)): 
-            score_dict = self.validate(dev_batch_instance, epoch, b, 0) 
+            score_dicts.append(self.validate(dev_batch_instance, epoch, b, 0))
+        # scores stay on device until here 
+        for score_dict in sync_scores(score_dicts): 
             total_prev_acc += score_dict['prev_f1']
             total_next_acc += score_dict['next_f1']
             total_block_acc += score_dict['block_acc']
@@ -228,44 +231,31 @@ class UNetLanguageTrainer(FlatLanguageTrainer):
         return prev_pixel_loss + next_pixel_loss
 
 
+    @torch.no_grad()
     def validate(self, batch_instance, epoch_num, batch_num, instance_num): 
         self.encoder.eval() 
         next_outputs, prev_outputs = self.encoder(batch_instance) 
 
-        prev_p, prev_r, prev_f1 = self.f1_metric.compute_f1(batch_instance["prev_pos_for_pred"], prev_outputs["next_position"])
-        next_p, next_r, next_f1 = self.f1_metric.compute_f1(batch_instance["next_pos_for_pred"], next_outputs["next_position"]) 
-        if self.compute_block_dist:
-            block_accuracy = self.compute_block_accuracy(batch_instance, next_outputs) 
-        else:
-            block_accuracy = -1.0
+        # metrics are 0-d tensors on device, synced once per epoch by sync_scores 
+        prev_p, prev_r, prev_f1 = self.f1_metric.compute_f1_tensors(batch_instance["prev_pos_for_pred"], prev_outputs["next_position"])
+        next_p, next_r, next_f1 = self.f1_metric.compute_f1_tensors(batch_instance["next_pos_for_pred"], next_outputs["next_position"]) 
 
-        all_tele_dicts = []    
-        all_tele_scores = []
-        all_oracle_tele_scores = []
-        block_accs = []
-        pred_centers, true_centers = [], [] 
         prev_position = prev_outputs['next_position']
         next_position = next_outputs['next_position']
 
-        for batch_idx in range(prev_position.shape[0]):
-            tele_dict = self.teleportation_metric.get_metric(batch_instance["next_pos_for_acc"][batch_idx].clone(),
-                                                             batch_instance["prev_pos_for_acc"][batch_idx].clone(),
-                                                             prev_position[batch_idx].clone(),
-                                                             next_outputs["next_position"][batch_idx].clone(),
-                                                             batch_instance["block_to_move"][batch_idx].clone())
-            all_tele_dicts.append(tele_dict)
-            all_tele_scores.append(tele_dict['distance']) 
-            all_oracle_tele_scores.append(tele_dict['oracle_distance']) 
-            block_accs.append(tele_dict['block_acc']) 
-            pred_centers.append(tele_dict['pred_center'])
-            true_centers.append(tele_dict['true_center']) 
-
-        total_tele_score = np.mean(all_tele_scores) 
-        total_oracle_tele_score = np.mean(all_oracle_tele_scores) 
-        block_accuracy = np.mean(block_accs) 
+        tele_dict = self.teleportation_metric.get_batch_metric(batch_instance["next_pos_for_acc"],
+                                                               batch_instance["prev_pos_for_acc"],
+                                                               prev_position,
+                                                               next_position,
+                                                               batch_instance["block_to_move"])
+
+        total_tele_score = tele_dict['distance'].mean() 
+        total_oracle_tele_score = tele_dict['oracle_distance'].mean() 
+        block_accuracy = tele_dict['block_acc'].mean() 
 
         bin_dict = defaultdict(list) 
         if epoch_num > self.generate_after_n: 
+            distances = tele_dict['distance'].tolist() 
             for i in range(next_outputs["next_position"].shape[0]):
                 output_path = self.checkpoint_dir.joinpath(f"batch_{batch_num}").joinpath(f"instance_{i}")
                 output_path.mkdir(parents = True, exist_ok=True)
@@ -286,7 +276,7 @@ class UNetLanguageTrainer(FlatLanguageTrainer):
                                               output_path.joinpath("prev"),
                                               caption = command) 
 
-                bin_distance = int(all_tele_dicts[i]["distance"])
+                bin_distance = int(distances[i])
                 bin_dict[bin_distance].append(str(output_path) )
 
 
@@ -438,9 +428,12 @@ def main(args):
     elif args.embedder == "glove":
         embedder = GloveEmbedder(tokenizer, train_vocab, args.embedding_file, args.embedding_dim, trainable=True) 
     elif args.embedder.startswith("bert"): 
-        embedder = BERTEmbedder(model_name = args.embedder,  max_seq_len = args.max_seq_length) 
+        embedder = BERTEmbedder(model_name = args.embedder,  max_seq_len = args.max_seq_length, cache_dir = args.bert_cache_dir) 
     else:
         raise NotImplementedError(f"No embedder {args.embedder}") 
+    if hasattr(embedder, "token_to_id"):
+        # batches then carry integer command ids, embedded with one lookup per batch 
+        dataset_reader.set_token_to_id(embedder.token_to_id)
     # get the encoder from args  
     if args.encoder == "lstm":
         encoder = LSTMEncoder(input_dim = args.embedding_dim,
@@ -600,6 +593,7 @@ if __name__ == "__main__":
     parser.add_argument("--embedder", type=str, default="random", choices = ["random", "glove", "bert-base-cased", "bert-base-uncased"])
     parser.add_argument("--embedding-file", type=str, help="path to pretrained glove embeddings")
     parser.add_argument("--embedding-dim", type=int, default=300) 
+    parser.add_argument("--bert-cache-dir", type=str, default=None, help="directory of cached frozen BERT command embeddings, shared with the robot, defaults to ~/.cache/bert_embeddings") 
     # language encoder
     parser.add_argument("--encoder", type=str, default="lstm", choices = ["lstm", "transformer"])
     parser.add_argument("--encoder-hidden-dim", type=int, default=128) 
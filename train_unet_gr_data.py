@@ -26,7 +26,7 @@ from encoders import LSTMEncoder
 from language_embedders import RandomEmbedder, GloveEmbedder, BERTEmbedder
 from unet_module import BaseUNet, UNetWithLanguage, UNetWithBlocks
 from unet_shared import SharedUNet
-from metrics import GoodRobotUNetTeleportationMetric, F1Metric
+from metrics import GoodRobotUNetTeleportationMetric, F1Metric, sync_scores
 from mlp import MLP 
 from losses import ScheduledWeightedCrossEntropyLoss
 
@@ -105,8 +105,11 @@ class GoodRobotUNetLanguageTrainer(UNetLanguageTrainer):
         total_recon_score = 0.0 
 
         self.encoder.eval() 
+        score_dicts = []
         for b, dev_batch_instance in tqdm(enumerate(self.val_data)): 
-            score_dict = self.validate(dev_batch_instance, epoch, b, 0) 
+            score_dicts.append(self.validate(dev_batch_instance, epoch, b, 0))
+        # scores stay on device until here 
+        for score_dict in sync_scores(score_dicts): 
             total_prev_acc += score_dict['prev_f1']
             total_next_acc += score_dict['next_f1']
             total_block_acc += score_dict['block_acc']
@@ -169,35 +172,29 @@ class GoodRobotUNetLanguageTrainer(UNetLanguageTrainer):
         return total_loss
         
     def compute_teleportation_metric(self, pairs,  pred_pos, next_pos):
-        res = self.teleportation_metric.get_metric(pairs, pred_pos, next_pos)
+        res = self.teleportation_metric.get_batch_metric(pairs, pred_pos, next_pos)
         return res
 
+    @torch.no_grad()
     def validate(self, batch_instance, epoch_num, batch_num, instance_num): 
         self.encoder.eval() 
-        outputs = self.encoder(batch_instance) 
         next_outputs, prev_outputs = self.encoder(batch_instance) 
         next_position = next_outputs['next_position']
         prev_position = prev_outputs['next_position']
 
-        # f1 metric 
-        prev_p, prev_r, prev_f1 = self.f1_metric.compute_f1(batch_instance["prev_pos_for_pred"].squeeze(-1), prev_position) 
-        next_p, next_r, next_f1 = self.f1_metric.compute_f1(batch_instance["next_pos_for_pred"].squeeze(-1), next_position) 
+        # f1 metric, kept on device until the end of the epoch 
+        prev_p, prev_r, prev_f1 = self.f1_metric.compute_f1_tensors(batch_instance["prev_pos_for_pred"].squeeze(-1), prev_position) 
+        next_p, next_r, next_f1 = self.f1_metric.compute_f1_tensors(batch_instance["next_pos_for_pred"].squeeze(-1), next_position) 
         # block accuracy metric 
         # looks like there's some shuffling going on here 
-        tele_metric_data = {"distance": [], "block_acc": [], "pred_center": [], "true_center": []}
-        
-        for i in range(next_position.shape[0]):
-            single_tele_dict = self.compute_teleportation_metric(batch_instance["pairs"][i], prev_position[i].detach().clone(), next_position[i].detach().clone())
-            tele_metric_data['distance'].append(single_tele_dict['distance'])
-            tele_metric_data['block_acc'].append(single_tele_dict['block_acc'])
-            tele_metric_data['pred_center'].append(single_tele_dict['pred_center'])
-            tele_metric_data['true_center'].append(single_tele_dict['true_center'])
+        tele_metric_data = self.compute_teleportation_metric(batch_instance["pairs"], prev_position, next_position) 
 
-        block_acc = np.mean(tele_metric_data['block_acc'])
-        tele_dist = np.mean(tele_metric_data['distance'])
+        block_acc = tele_metric_data['block_acc'].mean() 
+        tele_dist = tele_metric_data['distance'].mean() 
 
         if epoch_num > self.generate_after_n: 
-            for i in range(outputs["next_position"].shape[0]):
+            tele_metric_data = {k: v.tolist() for k, v in tele_metric_data.items()}
+            for i in range(next_position.shape[0]):
                 output_path = self.checkpoint_dir.joinpath(f"batch_{batch_num}").joinpath(f"instance_{i}")
                 output_path.mkdir(parents = True, exist_ok=True)
                 command = batch_instance["command"][i]
@@ -218,17 +215,6 @@ class GoodRobotUNetLanguageTrainer(UNetLanguageTrainer):
                                               prev_position[i], 
                                               output_path.joinpath("prev"),
                                               caption = command) 
-                try:
-                    with open(output_path.joinpath("attn_weights"), "w") as f1:
-                        # for now, just take the last layer 
-                        to_dump = {"command": batch_instance['command'][i],
-                                   "prev_weight": outputs['prev_attn_weights'][-1][i],
-                                   "next_weight": outputs['next_attn_weights'][-1][i]}
-                        json.dump(to_dump, f1) 
-
-                except IndexError:
-                    # train-time, pass 
-                    pass
 
         prev_recon_acc = 0.0
         if self.do_reconstruction:
@@ -302,7 +288,9 @@ def main(args):
                                             max_seq_length=args.max_seq_length,
                                             resolution = args.resolution,
                                             is_bert = "bert" in args.embedder,
-                                            overfit=args.overfit) 
+                                            overfit=args.overfit,
+                                            num_workers = args.num_workers,
+                                            pin_memory = args.cuda is not None) 
 
     checkpoint_dir = pathlib.Path(args.checkpoint_dir)
 
@@ -326,9 +314,12 @@ def main(args):
     elif args.embedder == "glove":
         embedder = GloveEmbedder(tokenizer, train_vocab, args.embedding_file, args.embedding_dim, trainable=True) 
     elif args.embedder.startswith("bert"): 
-        embedder = BERTEmbedder(model_name = args.embedder,  max_seq_len = args.max_seq_length) 
+        embedder = BERTEmbedder(model_name = args.embedder,  max_seq_len = args.max_seq_length, cache_dir = args.bert_cache_dir) 
     else:
         raise NotImplementedError(f"No embedder {args.embedder}") 
+    if hasattr(embedder, "token_to_id"):
+        # batches then carry integer command ids, embedded with one lookup per batch 
+        dataset_reader.set_token_to_id(embedder.token_to_id)
     # get the encoder from args  
     if args.encoder == "lstm":
         encoder = LSTMEncoder(input_dim = args.embedding_dim,
@@ -463,6 +454,7 @@ if __name__ == "__main__":
     # data 
     parser.add_argument("--path", type=str, default = "blocks_data/trainset_v2.json", help="path to train data")
     parser.add_argument("--batch-size", type=int, default = 32) 
+    parser.add_argument("--num-workers", type=int, default = 4, help = "worker processes that build batches in the background, 0 builds them on the main thread")
     parser.add_argument("--max-seq-length", type=int, default = 65) 
     parser.add_argument("--resolution", type=int, help="resolution to discretize input state", default=64) 
     parser.add_argument("--next-weight", type=float, default=1)
@@ -485,6 +477,7 @@ if __name__ == "__main__":
     parser.add_argument("--embedder", type=str, default="random", choices = ["random", "glove", "bert-base-cased", "bert-base-uncased"])
     parser.add_argument("--embedding-file", type=str, help="path to pretrained glove embeddings")
     parser.add_argument("--embedding-dim", type=int, default=300) 
+    parser.add_argument("--bert-cache-dir", type=str, default=None, help="directory of cached frozen BERT command embeddings, shared with the robot, defaults to ~/.cache/bert_embeddings") 
     # language encoder
     parser.add_argument("--encoder", type=str, default="lstm", choices = ["lstm", "transformer"])
     parser.add_argument("--encoder-hidden-dim", type=int, default=128) 
@@ -1,5 +1,6 @@
 import os
 import time
+import zlib
 from collections import OrderedDict
 import numpy as np
 import cv2
@@ -17,6 +18,8 @@ import utils
 from utils import ACTION_TO_ID
 from utils import ID_TO_ACTION
 from utils_torch import action_space_argmax, demo_space_argmax
+from transition_log import TransitionLog, transition_log_directory
+from replay import PrioritizedReplay
 import pdb 
 
 try:
@@ -29,12 +32,48 @@ except ImportError:
     ptflops = None
 
 
+class FeatureCache(object):
+    """ Bounded least recently used cache of Trainer.forward() results.
+
+    Entries are keyed by iteration and model version, see Trainer.forward(cache_iteration=...) and Trainer.model_updated().
+    """
+    def __init__(self, max_size=2):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            # drop the least recently used entry
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
 class Trainer(object):
     def __init__(self, method, push_rewards, future_reward_discount,
                  is_testing, snapshot_file, force_cpu, goal_condition_len=0, place=False, pretrained=False,
                  flops=False, network='efficientnet', common_sense=False, show_heightmap=False, place_dilation=0.03,
                  common_sense_backprop=True, trial_reward='spot', num_dilation=0, place_common_sense=True, static_language_mask=False, check_row = False,
-                 baseline_language_mask = False):
+                 baseline_language_mask = False, feature_cache_size=2,
+                 replay_sampling='rank'):
 
         self.heightmap_pixels = 224
         self.buffered_heightmap_pixels = 320
@@ -86,6 +125,17 @@ class Trainer(object):
         else:
             print("CUDA is *NOT* detected. Running with only CPU.")
             self.use_cuda = False
+        self.device = torch.device('cuda' if self.use_cuda else 'cpu')
+
+        # heightmap normalization constants for (color, depth) x (channel), see preprocess_heightmaps()
+        self.heightmap_scale = torch.tensor([255.0, 1.0], device=self.device).reshape(2, 1, 1, 1)
+        self.heightmap_mean = torch.tensor([[0.485, 0.456, 0.406], [0.01, 0.01, 0.01]], device=self.device).reshape(2, 3, 1, 1)
+        self.heightmap_std = torch.tensor([[0.229, 0.224, 0.225], [0.03, 0.03, 0.03]], device=self.device).reshape(2, 3, 1, 1)
+        # nearest neighbor 2x upsampling indices, keyed by heightmap (height, width)
+        self.upsample_index = {}
+        # forward() results for recent iterations, only valid until the weights change, see model_updated()
+        self.model_version = 0
+        self.feature_cache = FeatureCache(feature_cache_size)
 
         # Fully convolutional classification network for supervised learning
         if self.method == 'reactive':
@@ -178,6 +228,8 @@ class Trainer(object):
             self.stack_height_log = []
             self.partial_stack_success_log = []
             self.place_success_log = []
+        # experience replay priorities, kept in sync with the logs above by sync_replay()
+        self.replay = PrioritizedReplay(replay_sampling)
 
         # logging imitation actions, imitation action embeddings, executed action embeddings
         self.im_action_log = []
@@ -202,91 +254,113 @@ class Trainer(object):
         print('Pre-trained model snapshot loaded from: %s' % (snapshot_file))
         if self.use_cuda:
             self.model = self.model.cuda()
+        self.model_updated()
         self.load_snapshot_file_iteration_log.append([self.iteration])
         return len(self.load_snapshot_file_iteration_log)
 
+    def model_updated(self):
+        """ Must be called every time the model weights change, so cached forward() results are not reused.
+        """
+        self.model_version += 1
+        self.feature_cache.clear()
+
     # Pre-load execution info and RL variables
     def preload(self, transitions_directory):
         kwargs = {'delimiter': ' ', 'ndmin': 2}
-        self.iteration = int(np.loadtxt(os.path.join(transitions_directory, 'iteration.log.txt'), **kwargs)[0, 0])
-        self.executed_action_log = np.loadtxt(os.path.join(transitions_directory, 'executed-action.log.txt'), **kwargs)
+        logs = {}
+        if TransitionLog.exists(transition_log_directory(transitions_directory)):
+            # memory map the binary transition log and read every log in one pass
+            logs = TransitionLog(transition_log_directory(transitions_directory)).read_all()
+
+        def load_log(name, **kwargs):
+            if name in logs:
+                return logs[name]
+            return np.loadtxt(os.path.join(transitions_directory, '%s.log.txt' % name), **kwargs)
+
+        def log_exists(name):
+            return name in logs or os.path.exists(os.path.join(transitions_directory, '%s.log.txt' % name))
+
+        self.iteration = int(load_log('iteration', **kwargs)[0, 0])
+        self.executed_action_log = load_log('executed-action', **kwargs)
         self.executed_action_log = self.executed_action_log[0:self.iteration, :]
         self.executed_action_log = self.executed_action_log.tolist()
-        self.label_value_log = np.loadtxt(os.path.join(transitions_directory, 'label-value.log.txt'), **kwargs)
+        self.label_value_log = load_log('label-value', **kwargs)
         self.label_value_log = self.label_value_log[0:self.iteration]
         self.label_value_log = self.label_value_log.tolist()
-        # self.trial_label_value_log = np.loadtxt(os.path.join(transitions_directory, 'trial-label-value.log.txt'), **kwargs)
+        # self.trial_label_value_log = load_log('trial-label-value', **kwargs)
         # self.trial_label_value_log = self.trial_label_value_log[0:self.iteration]
         # self.trial_label_value_log = self.trial_label_value_log.tolist()
-        self.predicted_value_log = np.loadtxt(os.path.join(transitions_directory, 'predicted-value.log.txt'), **kwargs)
+        self.predicted_value_log = load_log('predicted-value', **kwargs)
         self.predicted_value_log = self.predicted_value_log[0:self.iteration]
         self.predicted_value_log = self.predicted_value_log.tolist()
-        self.reward_value_log = np.loadtxt(os.path.join(transitions_directory, 'reward-value.log.txt'), **kwargs)
+        self.reward_value_log = load_log('reward-value', **kwargs)
         self.reward_value_log = self.reward_value_log[0:self.iteration]
         self.reward_value_log = self.reward_value_log.tolist()
-        if os.path.exists(os.path.join(transitions_directory, 'trial-reward-value.log.txt')):
-            self.trial_reward_value_log = np.loadtxt(os.path.join(transitions_directory, 'trial-reward-value.log.txt'), **kwargs)
+        if log_exists('trial-reward-value'):
+            self.trial_reward_value_log = load_log('trial-reward-value', **kwargs)
             self.trial_reward_value_log = self.trial_reward_value_log[0:self.iteration]
             self.trial_reward_value_log = self.trial_reward_value_log.tolist()
-        if os.path.exists(os.path.join(transitions_directory, 'trial-predicted-value.log.txt')):
-            self.trial_predicted_value_log = np.loadtxt(os.path.join(transitions_directory, 'trial-predicted-value.log.txt'), **kwargs)
+        if log_exists('trial-predicted-value'):
+            self.trial_predicted_value_log = load_log('trial-predicted-value', **kwargs)
             self.trial_predicted_value_log = self.trial_predicted_value_log[0:self.iteration]
             self.trial_predicted_value_log = self.trial_predicted_value_log.tolist()
-        if os.path.exists(os.path.join(transitions_directory, 'goal-condition.log.txt')):
-            self.goal_condition_log = np.loadtxt(os.path.join(transitions_directory, 'goal-condition.log.txt'), **kwargs)
+        if log_exists('goal-condition'):
+            self.goal_condition_log = load_log('goal-condition', **kwargs)
             self.goal_condition_log = self.goal_condition_log[0:self.iteration]
             self.goal_condition_log = self.goal_condition_log.tolist()
-        self.use_heuristic_log = np.loadtxt(os.path.join(transitions_directory, 'use-heuristic.log.txt'), **kwargs)
+        self.use_heuristic_log = load_log('use-heuristic', **kwargs)
         self.use_heuristic_log = self.use_heuristic_log[0:self.iteration]
         self.use_heuristic_log = self.use_heuristic_log.tolist()
-        self.is_exploit_log = np.loadtxt(os.path.join(transitions_directory, 'is-exploit.log.txt'), **kwargs)
+        self.is_exploit_log = load_log('is-exploit', **kwargs)
         self.is_exploit_log = self.is_exploit_log[0:self.iteration]
         self.is_exploit_log = self.is_exploit_log.tolist()
-        if os.path.exists(os.path.join(transitions_directory, 'clearance.log.txt')):
-            self.clearance_log = np.loadtxt(os.path.join(transitions_directory, 'clearance.log.txt'), **kwargs).astype(np.int64)
+        if log_exists('clearance'):
+            self.clearance_log = load_log('clearance', **kwargs).astype(np.int64)
             self.clearance_log = self.clearance_log.tolist()
-        if os.path.exists(os.path.join(transitions_directory, 'load_snapshot_file_iteration.log.txt')):
-            self.load_snapshot_file_iteration_log = np.loadtxt(os.path.join(transitions_directory, 'load_snapshot_file_iteration.log.txt'), **kwargs).astype(np.int64)
+        if log_exists('load_snapshot_file_iteration'):
+            self.load_snapshot_file_iteration_log = load_log('load_snapshot_file_iteration', **kwargs).astype(np.int64)
             self.load_snapshot_file_iteration_log = self.load_snapshot_file_iteration_log.tolist()
-        self.trial_log = np.loadtxt(os.path.join(transitions_directory, 'trial.log.txt'), **kwargs)
+        self.trial_log = load_log('trial', **kwargs)
         self.trial_log = self.trial_log[0:self.iteration]
         self.trial_log = self.trial_log.tolist()
-        self.trial_success_log = np.loadtxt(os.path.join(transitions_directory, 'trial-success.log.txt'), **kwargs)
+        self.trial_success_log = load_log('trial-success', **kwargs)
         self.trial_success_log = self.trial_success_log[0:self.iteration]
         self.trial_success_log = self.trial_success_log.tolist()
-        self.grasp_success_log = np.loadtxt(os.path.join(transitions_directory, 'grasp-success.log.txt'), **kwargs)
+        self.grasp_success_log = load_log('grasp-success', **kwargs)
         self.grasp_success_log = self.grasp_success_log[0:self.iteration]
         self.grasp_success_log = self.grasp_success_log.tolist()
-        if os.path.exists(os.path.join(transitions_directory, 'color-success.log.txt')):
-            self.color_success_log = np.loadtxt(os.path.join(transitions_directory, 'color-success.log.txt'), **kwargs)
+        if log_exists('color-success'):
+            self.color_success_log = load_log('color-success', **kwargs)
             self.color_success_log = self.color_success_log[0:self.iteration]
             self.color_success_log = self.color_success_log.tolist()
 
-        if os.path.exists(os.path.join(transitions_directory, 'grasp-color-success.log.txt')):
-            self.grasp_color_success_log = np.loadtxt(os.path.join(transitions_directory, 'grasp-color-success.log.txt'), **kwargs)
+        if log_exists('grasp-color-success'):
+            self.grasp_color_success_log = load_log('grasp-color-success', **kwargs)
             self.grasp_color_success_log = self.grasp_color_success_log[0:self.iteration]
             self.grasp_color_success_log = self.grasp_color_success_log.tolist()
 
-        self.change_detected_log = np.loadtxt(os.path.join(transitions_directory, 'change-detected.log.txt'), **kwargs)
+        self.change_detected_log = load_log('change-detected', **kwargs)
         self.change_detected_log = self.change_detected_log[0:self.iteration]
         self.change_detected_log = self.change_detected_log.tolist()
         if self.place:
-            self.stack_height_log = np.loadtxt(os.path.join(transitions_directory, 'stack-height.log.txt'), **kwargs)
+            self.stack_height_log = load_log('stack-height', **kwargs)
             self.stack_height_log = self.stack_height_log[0:self.iteration]
             self.stack_height_log = self.stack_height_log.tolist()
-            self.partial_stack_success_log = np.loadtxt(os.path.join(transitions_directory, 'partial-stack-success.log.txt'), **kwargs)
+            self.partial_stack_success_log = load_log('partial-stack-success', **kwargs)
             self.partial_stack_success_log = self.partial_stack_success_log[0:self.iteration]
             self.partial_stack_success_log = self.partial_stack_success_log.tolist()
-            self.place_success_log = np.loadtxt(os.path.join(transitions_directory, 'place-success.log.txt'), **kwargs)
+            self.place_success_log = load_log('place-success', **kwargs)
             self.place_success_log = self.place_success_log[0:self.iteration]
             self.place_success_log = self.place_success_log.tolist()
-        if os.path.exists(os.path.join(transitions_directory, 'trial-reward-value.log.txt')):
-            self.trial_reward_value_log = np.loadtxt(os.path.join(transitions_directory, 'trial-reward-value.log.txt'), delimiter=' ')
+        if log_exists('trial-reward-value'):
+            self.trial_reward_value_log = load_log('trial-reward-value', delimiter=' ')
             self.trial_reward_value_log = self.trial_reward_value_log[0:self.iteration]
             self.trial_reward_value_log.shape = (self.trial_reward_value_log.shape[0], 1)
             self.trial_reward_value_log = self.trial_reward_value_log.tolist()
             if len(self.trial_reward_value_log) < self.iteration:
                 self.trial_reward_value_log_update()
+        # the logs were replaced, rebuild the replay priorities on the next sync_replay()
+        self.replay.reset()
 
     def trial_reward_value_log_update(self, reward=None):
         """
@@ -363,6 +437,47 @@ class Trainer(object):
                   str(end) + ' clearance length: ' + str(clearance_length) +
                   ' reward value log length: ' + str(len(self.reward_value_log)))
 
+    def replay_key(self, action_id, success):
+        """ The PrioritizedReplay class of an iteration followed by action_id with the given success value.
+        """
+        return (int(action_id), None if success is None else int(success))
+
+    def replay_surprise(self, iteration):
+        target_log = self.trial_reward_value_log if self.replay.target == 'trial-reward-value' else self.label_value_log
+        return abs(self.predicted_value_log[iteration][0] - target_log[iteration][0])
+
+    def sync_replay(self, trial_reward, log_len):
+        """ Add the iterations that became available for experience replay since the last call.
+
+        Iteration j can be sampled once log_len > j + 1, it belongs to the class of the next action and its success
+        (change detected for push, grasp success for grasp, partial stack success for place), and to the whole
+        history class if j >= 1. The surprise value is |predicted value - target value|, where the target is the
+        trial reward value log if trial_reward is True, otherwise the label value log.
+        """
+        target = 'trial-reward-value' if trial_reward else 'label-value'
+        if self.replay.target != target or self.replay.size > max(log_len - 1, 0):
+            self.replay.reset(target)
+        target_log = self.trial_reward_value_log if trial_reward else self.label_value_log
+        success_logs = [self.change_detected_log, self.grasp_success_log]
+        if self.place:
+            success_logs.append(self.partial_stack_success_log)
+        end = min(log_len - 1, len(self.predicted_value_log), len(target_log), len(self.executed_action_log) - 1)
+        for j in range(self.replay.size, end):
+            action_id = int(self.executed_action_log[j + 1][0])
+            success = None
+            if action_id < len(success_logs):
+                if j + 1 >= len(success_logs[action_id]):
+                    # the success of this action has not been logged yet
+                    break
+                success = success_logs[action_id][j + 1][0]
+            self.replay.add(j, self.replay_key(action_id, success), self.replay_surprise(j), include_in_all=j >= 1)
+
+    def update_replay_priority(self, iteration):
+        """ Call after the predicted or target value of an iteration changes to update its surprise value.
+        """
+        if iteration in self.replay:
+            self.replay.update(iteration, self.replay_surprise(iteration))
+
     def generate_hist_heightmap(self, valid_depth_heightmap, iteration, logger, history_len=3):
         clearance_inds = np.array(self.clearance_log).flatten()
 
@@ -382,6 +497,8 @@ class Trainer(object):
 
             # load img at iter_num
             h_i_path = os.path.join(logger.depth_heightmaps_directory, '%06d.0.depth.png' % iter_num)
+            # a recent heightmap may still be queued in the background image writer
+            logger.flush_images([h_i_path])
             h_i = cv2.imread(h_i_path, -1)
             if h_i is None:
                 # There was an error loading the image
@@ -397,6 +514,12 @@ class Trainer(object):
         """
         sample_primitive_action_id = self.executed_action_log[sample_iteration][0]
 
+        # wait for the background image writer if this sample or the next one was only just saved
+        heightmap_paths = [os.path.join(directory, '%06d.0.%s.png' % (i, image_type))
+                           for i in [sample_iteration, sample_iteration + 1]
+                           for directory, image_type in [(logger.color_heightmaps_directory, 'color'), (logger.depth_heightmaps_directory, 'depth')]]
+        logger.flush_images(heightmap_paths)
+
         # Load sample RGB-D heightmap
         sample_color_heightmap = cv2.imread(os.path.join(logger.color_heightmaps_directory, '%06d.0.color.png' % (sample_iteration)))
         sample_color_heightmap = cv2.cvtColor(sample_color_heightmap, cv2.COLOR_BGR2RGB)
@@ -429,7 +552,7 @@ class Trainer(object):
             next_stack_height = 1
 
         sample_push_predictions, sample_grasp_predictions, sample_place_predictions, sample_state_feat, output_prob = self.forward(
-            sample_color_heightmap, sample_depth_heightmap, is_volatile=True, goal_condition=exp_goal_condition)
+            sample_color_heightmap, sample_depth_heightmap, is_volatile=True, goal_condition=exp_goal_condition, cache_iteration=sample_iteration)
 
         # TODO(adit98) check if changing suffix rather than changing iteration num for getting future heightmap causes issues
         # Load next sample RGB-D heightmap
@@ -453,55 +576,22 @@ class Trainer(object):
 
     # Compute forward pass through model to compute affordances/Q
     # TODO(zhe) Input values needed to run Elias's model (sentence, color_heightmap). Ask Elias to be sure.
-    def forward(self, color_heightmap, depth_heightmap, is_volatile=False, specific_rotation=-1, goal_condition=None, keep_action_feat=False, use_demo=False, demo_mask=False, language_output=None):
-
-        # Apply 2x scale to input heightmaps
-        color_heightmap_2x = ndimage.zoom(color_heightmap, zoom=[2,2,1], order=0)
-        depth_heightmap_2x = ndimage.zoom(depth_heightmap, zoom=[2,2,1], order=0)
-        assert color_heightmap_2x.shape == depth_heightmap_2x.shape, print(color_heightmap_2x.shape, depth_heightmap_2x.shape)
-
-        # Add extra padding (to handle rotations inside network)
-        diag_length = float(color_heightmap_2x.shape[0]) * np.sqrt(2)
-        diag_length = np.ceil(diag_length/32)*32
-        padding_width = int((diag_length - color_heightmap_2x.shape[0])/2)
-
-        # separate each dim of color heightmap and pad, reconcatenate after
-        color_heightmap_2x_r =  np.pad(color_heightmap_2x[:,:,0], padding_width, 'constant', constant_values=0)
-        color_heightmap_2x_r.shape = (color_heightmap_2x_r.shape[0], color_heightmap_2x_r.shape[1], 1)
-        color_heightmap_2x_g =  np.pad(color_heightmap_2x[:,:,1], padding_width, 'constant', constant_values=0)
-        color_heightmap_2x_g.shape = (color_heightmap_2x_g.shape[0], color_heightmap_2x_g.shape[1], 1)
-        color_heightmap_2x_b =  np.pad(color_heightmap_2x[:,:,2], padding_width, 'constant', constant_values=0)
-        color_heightmap_2x_b.shape = (color_heightmap_2x_b.shape[0], color_heightmap_2x_b.shape[1], 1)
-        color_heightmap_2x = np.concatenate((color_heightmap_2x_r, color_heightmap_2x_g, color_heightmap_2x_b), axis=2)
-
-        # separate each dim of depth heightmap and pad, reconcatenate after
-        depth_heightmap_2x_r =  np.pad(depth_heightmap_2x[:,:,0], padding_width, 'constant', constant_values=0)
-        depth_heightmap_2x_r.shape = (depth_heightmap_2x_r.shape[0], depth_heightmap_2x_r.shape[1], 1)
-        depth_heightmap_2x_g =  np.pad(depth_heightmap_2x[:,:,1], padding_width, 'constant', constant_values=0)
-        depth_heightmap_2x_g.shape = (depth_heightmap_2x_g.shape[0], depth_heightmap_2x_g.shape[1], 1)
-        depth_heightmap_2x_b =  np.pad(depth_heightmap_2x[:,:,2], padding_width, 'constant', constant_values=0)
-        depth_heightmap_2x_b.shape = (depth_heightmap_2x_b.shape[0], depth_heightmap_2x_b.shape[1], 1)
-        depth_heightmap_2x = np.concatenate((depth_heightmap_2x_r, depth_heightmap_2x_g, depth_heightmap_2x_b), axis=2)
-
-        # Pre-process color image (scale and normalize)
-        image_mean = [0.485, 0.456, 0.406]
-        image_std = [0.229, 0.224, 0.225]
-        input_color_image = color_heightmap_2x.astype(float)/255
-        for c in range(3):
-            input_color_image[:,:,c] = (input_color_image[:,:,c] - image_mean[c])/image_std[c]
-
-        # Pre-process depth image (normalize)
-        image_mean = [0.01, 0.01, 0.01]
-        image_std = [0.03, 0.03, 0.03]
-        input_depth_image = depth_heightmap_2x.astype(float)
-        for c in range(3):
-            input_depth_image[:,:,c] = (input_depth_image[:,:,c] - image_mean[c])/image_std[c]
-
-        # Construct minibatch of size 1 (b,c,h,w)
-        input_color_image.shape = (input_color_image.shape[0], input_color_image.shape[1], input_color_image.shape[2], 1)
-        input_depth_image.shape = (input_depth_image.shape[0], input_depth_image.shape[1], input_depth_image.shape[2], 1)
-        input_color_data = torch.from_numpy(input_color_image.astype(np.float32)).permute(3,2,0,1)
-        input_depth_data = torch.from_numpy(input_depth_image.astype(np.float32)).permute(3,2,0,1)
+    def forward(self, color_heightmap, depth_heightmap, is_volatile=False, specific_rotation=-1, goal_condition=None, keep_action_feat=False, use_demo=False, demo_mask=False, language_output=None, cache_iteration=None):
+
+        # only the plain all rotation forward pass is cached, the key does not cover the other options
+        if (cache_iteration is not None and is_volatile and specific_rotation == -1 and not keep_action_feat and not use_demo
+                and not demo_mask and language_output is None):
+            # reuse the results for this iteration's heightmaps if the weights have not changed since they were computed
+            cache_key = (cache_iteration, self.model_version, str(goal_condition),
+                         zlib.crc32(np.ascontiguousarray(color_heightmap)), zlib.crc32(np.ascontiguousarray(depth_heightmap)))
+            result = self.feature_cache.get(cache_key)
+            if result is None:
+                result = self.forward(color_heightmap, depth_heightmap, is_volatile, specific_rotation, goal_condition=goal_condition)
+                self.feature_cache.put(cache_key, result)
+            # copy the masked predictions so callers can modify them without changing the cache
+            return tuple(x.copy() if isinstance(x, np.ndarray) else x for x in result)
+
+        input_color_data, input_depth_data, padding_width = self.preprocess_heightmaps(color_heightmap, depth_heightmap)
         if self.flops:
             # sorry for the super random code here, but this is where we will check the
             # floating point operations (flops) counts and parameters counts for now...
@@ -521,76 +611,36 @@ class Trainer(object):
         # TODO(adit98) remove this part and deprecate use_demo option
         # if we are keeping action feat, no softmax
         if keep_action_feat and use_demo:
-            softmax = nn.Identity()
+            softmax = None
             channel_ind = Ellipsis
         else:
             softmax = F.softmax
             channel_ind = 0
 
+        # remove extra padding, the network output is half the padded input size
+        crop = slice(int(padding_width/2), int(input_color_data.shape[2]/2 - padding_width/2))
+
         # TODO(adit98) if method is reactive, this will not work, see reinforcement method for correct implementation
         # NOTE(zhe) Question: What is reactive learning?
         if self.method == 'reactive':
             # Return affordances (and remove extra padding)
-            for rotate_idx in range(len(output_prob)):
-                if rotate_idx == 0:
-                    if keep_action_feat and not use_demo:
-                        push_feat = output_prob_feat[rotate_idx][0].cpu().data.numpy()[:,:,int(padding_width/2):(color_heightmap_2x.shape[0]/2 - padding_width/2),
-                                int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]
-                        grasp_feat = output_prob_feat[rotate_idx][1].cpu().data.numpy()[:,:,int(padding_width/2):(color_heightmap_2x.shape[0]/2 - padding_width/2),
-                                int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]
-                        if self.place:
-                            place_feat = output_prob_feat[rotate_idx][2].cpu().data.numpy()[:,:,int(padding_width/2):(color_heightmap_2x.shape[0]/2 - padding_width/2),
-                                    int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]
-
-                    push_predictions = softmax(output_prob[rotate_idx][0], dim=1).cpu().data.numpy()[:,channel_ind,(padding_width/2):(color_heightmap_2x.shape[0]/2 - padding_width/2),(padding_width/2):(color_heightmap_2x.shape[0]/2 - padding_width/2)]
-                    grasp_predictions = softmax(output_prob[rotate_idx][1], dim=1).cpu().data.numpy()[:,channel_ind,(padding_width/2):(color_heightmap_2x.shape[0]/2 - padding_width/2),(padding_width/2):(color_heightmap_2x.shape[0]/2 - padding_width/2)]
-                    if self.place:
-                        place_predictions = softmax(output_prob[rotate_idx][2], dim=1).cpu().data.numpy()[:,channel_ind,(padding_width/2):(color_heightmap_2x.shape[0]/2 - padding_width/2),(padding_width/2):(color_heightmap_2x.shape[0]/2 - padding_width/2)]
-                else:
-                    if keep_action_feat and not use_demo:
-                        push_feat = np.concatenate((push_feat, output_prob_feat[rotate_idx][0].cpu().data.numpy()[:,:,int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2),
-                                int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]), axis=0)
-                        grasp_feat = np.concatenate((grasp_feat, output_prob_feat[rotate_idx][1].cpu().data.numpy()[:,:,int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2),
-                                int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]), axis=0)
-                        if self.place:
-                            place_feat = np.concatenate((place_feat, output_prob_feat[rotate_idx][2].cpu().data.numpy()[:,:,int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2),
-                                    int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]), axis=0)
-
-                    push_predictions = np.concatenate((push_predictions, softmax(output_prob[rotate_idx][0], dim=1).cpu().data.numpy()[:,channel_ind,(padding_width/2):(color_heightmap_2x.shape[0]/2 - padding_width/2),(padding_width/2):(color_heightmap_2x.shape[0]/2 - padding_width/2)]), axis=0)
-                    grasp_predictions = np.concatenate((grasp_predictions, softmax(output_prob[rotate_idx][1], dim=1).cpu().data.numpy()[:,channel_ind,(padding_width/2):(color_heightmap_2x.shape[0]/2 - padding_width/2),(padding_width/2):(color_heightmap_2x.shape[0]/2 - padding_width/2)]), axis=0)
-                    if self.place:
-                        place_predictions = np.concatenate((place_predictions, softmax(output_prob[rotate_idx][2], dim=1).cpu().data.numpy()[:,channel_ind,(padding_width/2):(color_heightmap_2x.shape[0]/2 - padding_width/2),(padding_width/2):(color_heightmap_2x.shape[0]/2 - padding_width/2)]), axis=0)
+            if keep_action_feat and not use_demo:
+                action_feats = self.crop_predictions(output_prob_feat, crop)
+            action_predictions = self.crop_predictions(output_prob, crop, channel_ind, softmax)
 
         elif self.method == 'reinforcement':
             # Return Q values (and remove extra padding)
-            for rotate_idx in range(len(output_prob)):
-                if rotate_idx == 0:
-                    if keep_action_feat and not use_demo:
-                        push_feat = output_prob_feat[rotate_idx][0].cpu().data.numpy()[:,:,int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2),int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]
-                        grasp_feat = output_prob_feat[rotate_idx][1].cpu().data.numpy()[:,:,int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2),
-                                int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]
-                        if self.place:
-                            place_feat = output_prob_feat[rotate_idx][2].cpu().data.numpy()[:,:,int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2),
-                                    int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]
-
-                    push_predictions = output_prob[rotate_idx][0].cpu().data.numpy()[:,channel_ind,int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2),int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]
-                    grasp_predictions = output_prob[rotate_idx][1].cpu().data.numpy()[:,channel_ind,int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2),int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]
-                    if self.place:
-                        place_predictions = output_prob[rotate_idx][2].cpu().data.numpy()[:,channel_ind,int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2),int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]
-                else:
-                    if keep_action_feat and not use_demo:
-                        push_feat = np.concatenate((push_feat, output_prob_feat[rotate_idx][0].cpu().data.numpy()[:,:,int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2),
-                                int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]), axis=0)
-                        grasp_feat = np.concatenate((grasp_feat, output_prob_feat[rotate_idx][1].cpu().data.numpy()[:,:,int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2),
-                                int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]), axis=0)
-                        if self.place:
-                            place_feat = np.concatenate((place_feat, output_prob_feat[rotate_idx][2].cpu().data.numpy()[:,:,int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2),
-                                    int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]), axis=0)
-
-                    push_predictions = np.concatenate((push_predictions, output_prob[rotate_idx][0].cpu().data.numpy()[:,channel_ind,int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2),int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]), axis=0)
-                    grasp_predictions = np.concatenate((grasp_predictions, output_prob[rotate_idx][1].cpu().data.numpy()[:,channel_ind,int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2),int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]), axis=0)
-                    if self.place:
-                        place_predictions = np.concatenate((place_predictions, output_prob[rotate_idx][2].cpu().data.numpy()[:,channel_ind,int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2),int(padding_width/2):int(color_heightmap_2x.shape[0]/2 - padding_width/2)]), axis=0)
+            if keep_action_feat and not use_demo:
+                action_feats = self.crop_predictions(output_prob_feat, crop)
+            action_predictions = self.crop_predictions(output_prob, crop, channel_ind)
+
+        if keep_action_feat and not use_demo:
+            push_feat, grasp_feat = action_feats[:2]
+            if self.place:
+                place_feat = action_feats[2]
+        push_predictions, grasp_predictions = action_predictions[:2]
+        if self.place:
+            place_predictions = action_predictions[2]
 
         if not self.place:
             place_predictions = None
@@ -688,6 +738,50 @@ class Trainer(object):
         else:
             return push_predictions, grasp_predictions, place_predictions, state_feat, output_prob
 
+    def preprocess_heightmaps(self, color_heightmap, depth_heightmap):
+        """ Upsample the heightmaps 2x, pad them so they can be rotated inside the network and normalize them.
+
+        Returns the (1, 3, h, w) float tensors input_color_data and input_depth_data on the model's device,
+        plus the padding_width that was added to each side.
+        """
+        assert color_heightmap.shape == depth_heightmap.shape, print(color_heightmap.shape, depth_heightmap.shape)
+        height, width = color_heightmap.shape[:2]
+        if (height, width) not in self.upsample_index:
+            # same indices as ndimage.zoom(heightmap, zoom=[2,2,1], order=0)
+            self.upsample_index[(height, width)] = [torch.from_numpy(ndimage.zoom(np.arange(n, dtype=np.float64), zoom=2, order=0).astype(np.int64)).to(self.device)
+                                                    for n in (height, width)]
+        row_index, col_index = self.upsample_index[(height, width)]
+
+        # Add extra padding (to handle rotations inside network)
+        diag_length = float(row_index.shape[0]) * np.sqrt(2)
+        diag_length = np.ceil(diag_length/32)*32
+        padding_width = int((diag_length - row_index.shape[0])/2)
+
+        # (color/depth, channel, h, w), normalize before upsampling so there are fewer pixels to process
+        heightmaps = torch.from_numpy(np.stack([color_heightmap, depth_heightmap]).astype(np.float32)).to(self.device)
+        heightmaps = (heightmaps.permute(0, 3, 1, 2) / self.heightmap_scale - self.heightmap_mean) / self.heightmap_std
+        # the padding is zeros before normalization
+        padded = (-self.heightmap_mean / self.heightmap_std).repeat(1, 1, row_index.shape[0] + 2*padding_width, col_index.shape[0] + 2*padding_width)
+        padded[:, :, padding_width:padding_width + row_index.shape[0], padding_width:padding_width + col_index.shape[0]] = \
+                heightmaps.index_select(2, row_index).index_select(3, col_index)
+        return padded[0:1], padded[1:2], padding_width
+
+    def crop_predictions(self, output, crop, channel_ind=slice(None), softmax=None):
+        """ Remove the extra padding from every rotation of every action at once and copy the result to the cpu in a single transfer.
+
+        output: list over rotations of [push, grasp(, place)] tensors, as returned by the model forward().
+        crop: slice of rows and columns to keep.
+        Returns a list with one numpy array per action, rotations stacked along axis 0.
+        """
+        # crop before stacking so only the kept pixels are copied, softmax is per pixel so it can run on the crop,
+        # but it needs every channel, so select channel_ind after it
+        index = (slice(None), slice(None) if softmax is not None else channel_ind, crop, crop)
+        # (action, rotation * batch, [channel,] h, w)
+        stacked = torch.stack([torch.cat([rotation_output[action_idx][index] for rotation_output in output]) for action_idx in range(len(output[0]))])
+        if softmax is not None:
+            stacked = softmax(stacked, dim=2)[:, :, channel_ind]
+        return list(stacked.detach().cpu().numpy())
+
     def end_trial(self):
         self.clearance_log.append([self.iteration])
         return len(self.clearance_log)
@@ -698,7 +792,7 @@ class Trainer(object):
     def get_label_value(
             self, primitive_action, push_success, grasp_success, change_detected, prev_push_predictions, prev_grasp_predictions,
             next_color_heightmap, next_depth_heightmap, color_success=None, goal_condition=None, place_success=None,
-            prev_place_predictions=None, reward_multiplier=1):
+            prev_place_predictions=None, reward_multiplier=1, next_iteration=None):
 
         if self.method == 'reactive':
 
@@ -759,7 +853,7 @@ class Trainer(object):
             elif not self.place and not change_detected and not grasp_success:
                 future_reward = 0
             else:
-                next_push_predictions, next_grasp_predictions, next_place_predictions, next_state_feat, output_prob = self.forward(next_color_heightmap, next_depth_heightmap, is_volatile=True, goal_condition=goal_condition)
+                next_push_predictions, next_grasp_predictions, next_place_predictions, next_state_feat, output_prob = self.forward(next_color_heightmap, next_depth_heightmap, is_volatile=True, goal_condition=goal_condition, cache_iteration=next_iteration)
                 future_reward = max(np.max(next_push_predictions), np.max(next_grasp_predictions))
                 if self.place:
                     future_reward = max(future_reward, np.max(next_place_predictions))
@@ -895,6 +989,7 @@ class Trainer(object):
 
             print('Training loss: %f' % (loss_value))
             self.optimizer.step()
+            self.model_updated()
 
         elif self.method == 'reinforcement':
             # TODO(adit98) figure out backprop for use_demo
@@ -993,6 +1088,7 @@ class Trainer(object):
 
             print('Training loss: %f' % (loss_value))
             self.optimizer.step()
+            self.model_updated()
 
     def get_prediction_vis(self, predictions, color_heightmap, best_pix_ind, scale_factor=8):
         # TODO(ahundt) once the reward function is back in the 0 to 1 range, make the scale factor 1 again
@@ -1056,17 +1152,20 @@ class Trainer(object):
             backprop_enabled['push'] = True
         elif not backprop_enabled['grasp'] and time_to_reset:
                 init_trunk_weights(self.model, 'push-')
+                self.model_updated()
 
         if (np.sum(np.asarray(self.grasp_success_log)[min_iteration:max_iteration, 0]) >= min_success):
             backprop_enabled['grasp'] = True
         elif not backprop_enabled['grasp'] and time_to_reset:
                 init_trunk_weights(self.model, 'grasp-')
+                self.model_updated()
 
         if self.place:
             if np.sum(np.asarray(self.partial_stack_success_log)[min_iteration:max_iteration, 0]) >= min_success:
                 backprop_enabled['place'] = True
             elif not backprop_enabled['place'] and time_to_reset:
                 init_trunk_weights(self.model, 'place-')
+                self.model_updated()
         return backprop_enabled
 
     def push_heuristic(self, depth_heightmap):
@@ -5,6 +5,7 @@ from torch.nn import functional as F
 import einops 
 from einops import rearrange, repeat 
 from allennlp.nn.util import get_range_vector, get_device_of, add_positional_features
+from language_embedders import embed_batch
 
 import pdb 
 
@@ -51,6 +52,36 @@ def add_positional_features_2d(
 
     return tensor
 
+# sinusoids added by add_positional_features() keyed by (timesteps, hidden_dim, device) 
+POSITIONAL_FEATURES_CACHE = {}
+
+def cached_positional_features(timesteps, hidden_dim, device):
+    """
+    The (1, timesteps, hidden_dim) sinusoids add_positional_features() adds to its input, computed once per 
+    shape and device. x + cached_positional_features(...) is exactly add_positional_features(x). 
+    """
+    key = (timesteps, hidden_dim, str(device))
+    if key not in POSITIONAL_FEATURES_CACHE:
+        POSITIONAL_FEATURES_CACHE[key] = add_positional_features(torch.zeros((1, timesteps, hidden_dim), device = device))
+    return POSITIONAL_FEATURES_CACHE[key]
+
+def assemble_input(parts):
+    """
+    Concatenate (batch or 1, n_i, hidden_dim) parts along the sequence into one preallocated buffer. 
+    Parts with batch size 1, like the [SEP] token parameter, are broadcast across the batch. 
+    """
+    batch_size = max(part.shape[0] for part in parts)
+    total_len = sum(part.shape[1] for part in parts)
+    dtype = parts[0].dtype
+    for part in parts[1:]:
+        dtype = torch.promote_types(dtype, part.dtype)
+    model_input = torch.empty((batch_size, total_len, parts[0].shape[-1]), dtype = dtype, device = parts[0].device)
+    start = 0
+    for part in parts:
+        model_input[:, start:start + part.shape[1]] = part
+        start += part.shape[1]
+    return model_input
+
 def image_to_tiles(image, tile_size):
     tiler = torch.nn.Unfold(kernel_size = tile_size, stride = tile_size)
     output = tiler(image)
@@ -200,12 +231,112 @@ class FeedForward(nn.Module):
     def forward(self, x):
         return self.net(x)
 
+ATTENTION_IMPLS = ["sdpa", "einsum"]
+# local_window_attention() saves more activations than the dense masked attention on image grids smaller than 
+# this many patches per side, whatever the neighborhood, see benchmark.py local_attention 
+LOCAL_WINDOW_MIN_GRID = 44
+
+def sdpa_available(): 
+    """
+    True if F.scaled_dot_product_attention exists and takes the scale argument (torch >= 2.1), 
+    otherwise "sdpa" attention falls back to the einsum implementation. 
+    """
+    if not hasattr(F, "scaled_dot_product_attention"):
+        return False 
+    try:
+        x = torch.zeros(1, 1, 1, 1)
+        F.scaled_dot_product_attention(x, x, x, scale = 1.0)
+    except TypeError:
+        return False 
+    return True 
+
+SDPA_AVAILABLE = sdpa_available() 
+
+def local_attention_mask(num_patches, total_len, neighborhood, device = "cpu"):
+    """
+    Dense (total_len, total_len) bool mask of local_window_attention(). The first num_patches tokens are a row 
+    major grid of image patches, each attends to the patches less than neighborhood rows and columns before it 
+    or up to neighborhood - 1 after it, and to every token after the image. Those tokens attend to everything. 
+    """
+    grid = int(math.sqrt(num_patches))
+    patch_idxs = torch.arange(num_patches, device = device)
+    row_offsets = (patch_idxs // grid)[None, :] - (patch_idxs // grid)[:, None]
+    col_offsets = (patch_idxs % grid)[None, :] - (patch_idxs % grid)[:, None]
+    mask = torch.ones((total_len, total_len), dtype = torch.bool, device = device)
+    mask[:num_patches, :num_patches] = (row_offsets >= -neighborhood) & (row_offsets < neighborhood) & \
+                                       (col_offsets >= -neighborhood) & (col_offsets < neighborhood)
+    return mask
+
+def local_window_attention(q, k, v, num_patches, neighborhood, key_mask = None, scale = 1.0):
+    """
+    Attention with the same result as dense attention masked by local_attention_mask(), computed with memory 
+    and compute linear in num_patches. The image grid is split into square tiles of queries, each tile scores 
+    only the patches its windows can reach and the tokens after the image. 
+
+    q, k, v: [b, h, n, d] with the image patches first, key_mask: [b, n] bool of keys that may be attended to
+    """
+    assert neighborhood >= 1, f"the locality neighborhood must be at least 1, not {neighborhood}"
+    b, h, n, d = q.shape
+    grid = int(math.sqrt(num_patches))
+    w = 2 * neighborhood 
+    # the tile size with the fewest scored pairs, small tiles score few keys outside the windows 
+    tile = min(range(max(2, neighborhood - 1), w + 1), key = lambda t: (math.ceil(grid / t) * t * (t + w - 1)) ** 2)
+    num_tiles = math.ceil(grid / tile)
+    # the keys a tile of queries can reach 
+    region = tile + w - 1
+    mask_value = -torch.finfo(q.dtype).max
+    if key_mask is None:
+        key_mask = torch.ones((b, n), dtype = torch.bool, device = q.device)
+
+    # pad the image grid to whole tiles and so every window is in bounds, padded keys are never valid 
+    extra = num_tiles * tile - grid 
+    q_tiles = F.pad(q[:, :, :num_patches].reshape(b, h, grid, grid, d), (0, 0, 0, extra, 0, extra))
+    q_tiles = rearrange(q_tiles, 'b h (x p1) (y p2) d -> b h x y (p1 p2) d', p1 = tile, p2 = tile)
+    padding = (neighborhood, neighborhood - 1 + extra, neighborhood, neighborhood - 1 + extra)
+    def tile_regions(t):
+        t = F.pad(t[:, :, :num_patches].reshape(b, h, grid, grid, d), (0, 0) + padding)
+        # [b, h, x, y, d, region, region] -> [b, h, x, y, region^2, d]
+        return rearrange(t.unfold(2, region, tile).unfold(3, region, tile), 'b h x y d r1 r2 -> b h x y (r1 r2) d')
+    k_regions, v_regions = tile_regions(k), tile_regions(v)
+
+    # a query at (row, col) of its tile reaches region rows row to row + w - 1, and the same for columns 
+    offsets = torch.arange(region, device = q.device)[None, :] - torch.arange(tile, device = q.device)[:, None]
+    reach = (offsets >= 0) & (offsets < w)
+    reach = rearrange(reach[:, None, :, None] & reach[None, :, None, :], 'p1 p2 r1 r2 -> (p1 p2) (r1 r2)')
+    valid_regions = F.pad(key_mask[:, :num_patches].reshape(b, grid, grid), padding, value = False)
+    valid_regions = rearrange(valid_regions.unfold(1, region, tile).unfold(2, region, tile), 'b x y r1 r2 -> b () x y () (r1 r2)')
+    local_valid = (valid_regions & reach).expand(b, 1, num_tiles, num_tiles, tile * tile, region * region)
+    # image patches also attend to every token after the image 
+    global_valid = key_mask[:, None, None, None, None, num_patches:].expand(b, 1, num_tiles, num_tiles, tile * tile, n - num_patches)
+
+    k_global, v_global = k[:, :, None, None, num_patches:], v[:, :, None, None, num_patches:]
+    scores = torch.cat([q_tiles @ k_regions.transpose(-1, -2), q_tiles @ k_global.transpose(-1, -2)], dim = -1) * scale
+    attn = scores.masked_fill(~torch.cat([local_valid, global_valid], dim = -1), mask_value).softmax(dim = -1)
+    image_out = attn[..., :region * region] @ v_regions + attn[..., region * region:] @ v_global
+    image_out = rearrange(image_out, 'b h x y (p1 p2) d -> b h (x p1) (y p2) d', p1 = tile, p2 = tile)
+    image_out = image_out[:, :, :grid, :grid].reshape(b, h, num_patches, d)
+
+    # the tokens after the image attend to everything 
+    dots = torch.einsum('bhid,bhjd->bhij', q[:, :, num_patches:], k) * scale
+    dots = dots.masked_fill(~key_mask[:, None, None, :], mask_value)
+    other_out = torch.einsum('bhij,bhjd->bhid', dots.softmax(dim = -1), v)
+    return torch.cat([image_out, other_out], dim = 2)
+
 class Attention(nn.Module):
-    def __init__(self, dim, heads = 8, dropout = 0., init_scale=4):
+    def __init__(self, dim, heads = 8, dropout = 0., init_scale=4, attention_impl = "sdpa"):
         super().__init__()
+        assert attention_impl in ATTENTION_IMPLS, f"invalid attention implementation {attention_impl}"
         self.heads = heads
         self.scale = dim ** -0.5
         self.init_scale = init_scale 
+        # "sdpa" uses the fused F.scaled_dot_product_attention unless the attention weights are requested 
+        if attention_impl == "sdpa" and not SDPA_AVAILABLE:
+            print(f"WARNING: F.scaled_dot_product_attention with a scale argument needs torch >= 2.1, "
+                  f"torch {torch.__version__} will use einsum attention")
+            attention_impl = "einsum" 
+        self.attention_impl = attention_impl 
+        # smaller image grids use the dense local mask instead of local_window_attention() 
+        self.local_window_min_grid = LOCAL_WINDOW_MIN_GRID
 
         self.to_qkv = nn.Linear(dim, dim * 3, bias = False)
         self.to_out = nn.Sequential(
@@ -221,51 +352,72 @@ class Attention(nn.Module):
         torch.nn.init.normal_(self.to_out[0].weight, mean = 0, std = _get_std_from_tensor(self.init_scale, self.to_out[0].weight))
         torch.nn.init.constant_(self.to_out[0].bias, 0) 
 
-    def forward(self, x, mask = None, attn_mask = None):
-        b, n, _, h = *x.shape, self.heads
-        qkv = self.to_qkv(x).chunk(3, dim = -1)
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = h), qkv)
-
-        dots = torch.einsum('bhid,bhjd->bhij', q, k) * self.scale
-        mask_value = -torch.finfo(dots.dtype).max
+    def get_allowed(self, mask, attn_mask, n): 
+        # bool of the query, key pairs that may attend, broadcastable to [b, h, n, n], or None if all can 
+        allowed = None 
         if mask is not None:
-            #mask = F.pad(mask.flatten(1), (1, 0), value = True)
-            mask = mask.unsqueeze(1) 
-            assert mask.shape[-1] == dots.shape[-1], 'mask has incorrect dimensions'
-            mask = mask[:, None, :] * mask[:, :, None]
-            dots.masked_fill_(~mask, mask_value)
-            del mask
-
+            # mask hides keys, e.g. <PAD> tokens, from every query 
+            assert mask.shape[-1] == n, 'mask has incorrect dimensions'
+            allowed = mask[:, None, None, :]
         if attn_mask is not None: 
-            bsz, __, n, n = dots.shape
             attn_mask = attn_mask.reshape(1,1,n,n)
-            assert(attn_mask.shape[2:] == dots.shape[2:])
-            dots.masked_fill(~attn_mask, mask_value) 
+            allowed = attn_mask if allowed is None else allowed & attn_mask
+        return allowed 
 
-        attn = dots.softmax(dim=-1)
-        self.attn_weight = attn 
+    def forward(self, x, mask = None, attn_mask = None, need_weights = False, local_window = None):
+        """
+        local_window: (num_patches, neighborhood) to only let image patches attend locally, see local_window_attention()
+        """
+        b, n, _, h = *x.shape, self.heads
+        qkv = self.to_qkv(x).chunk(3, dim = -1)
+        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = h), qkv)
+        if local_window is not None and (need_weights or int(math.sqrt(local_window[0])) < self.local_window_min_grid):
+            # the dense equivalent, to log the attention weights or when it needs less memory 
+            local_mask = local_attention_mask(local_window[0], n, local_window[1], x.device)
+            attn_mask = local_mask if attn_mask is None else attn_mask & local_mask
+            local_window = None
+        allowed = self.get_allowed(mask, attn_mask, n) 
+
+        if local_window is not None:
+            assert attn_mask is None, "local window attention does not take an attn_mask"
+            out = local_window_attention(q, k, v, local_window[0], local_window[1], key_mask = mask, scale = self.scale)
+            self.attn_weight = None
+        elif self.attention_impl == "sdpa" and not need_weights: 
+            # never builds the [b, h, n, n] attention matrix, disallowed pairs get the same -max logit as below 
+            bias = None 
+            if allowed is not None:
+                bias = torch.zeros(allowed.shape, dtype = q.dtype, device = q.device).masked_fill_(~allowed, -torch.finfo(q.dtype).max)
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask = bias, scale = self.scale)
+            self.attn_weight = None
+        else:
+            dots = torch.einsum('bhid,bhjd->bhij', q, k) * self.scale
+            if allowed is not None:
+                dots.masked_fill_(~allowed, -torch.finfo(dots.dtype).max)
+
+            attn = dots.softmax(dim=-1)
+            self.attn_weight = attn if need_weights else None 
+            out = torch.einsum('bhij,bhjd->bhid', attn, v)
 
-        out = torch.einsum('bhij,bhjd->bhid', attn, v)
         out = rearrange(out, 'b h n d -> b n (h d)')
         out =  self.to_out(out)
         return out
 
 class Transformer(nn.Module):
-    def __init__(self, dim, depth, heads, mlp_dim, dropout, init_scale, log_weights = False):
+    def __init__(self, dim, depth, heads, mlp_dim, dropout, init_scale, log_weights = False, attention_impl = "sdpa"):
         super().__init__()
         self.layers = nn.ModuleList([])
         for _ in range(depth):
             self.layers.append(nn.ModuleList([
-                Residual(PreNorm(dim, Attention(dim, heads = heads, dropout = dropout, init_scale = init_scale))),
+                Residual(PreNorm(dim, Attention(dim, heads = heads, dropout = dropout, init_scale = init_scale, attention_impl = attention_impl))),
                 Residual(PreNorm(dim, FeedForward(dim, mlp_dim, dropout = dropout, init_scale = init_scale)))
             ]))
 
         self.log_weights = log_weights
 
-    def forward(self, x, mask = None, attn_mask = None):
+    def forward(self, x, mask = None, attn_mask = None, local_window = None):
         attn_values = []
         for attn, ff in self.layers:
-            x = attn(x, mask = mask, attn_mask = attn_mask)
+            x = attn(x, mask = mask, attn_mask = attn_mask, need_weights = self.log_weights, local_window = local_window)
             x = ff(x)
             if self.log_weights:
                 attn_values.append(attn._modules["fn"]._modules["fn"].attn_weight.detach().cpu().numpy().tolist())
@@ -293,7 +445,10 @@ class TransformerEncoder(torch.nn.Module):
                  do_regression: bool = False,
                  do_reconstruction: bool = False,
                  long_command: bool = False,
-                 pretrained_weights: str = None):
+                 pretrained_weights: str = None,
+                 attention_impl: str = "sdpa",
+                 locality_mask: bool = False,
+                 locality_neighborhood: int = 5):
         super(TransformerEncoder, self).__init__() 
 
         self.compute_block_dist = False 
@@ -302,6 +457,10 @@ class TransformerEncoder(torch.nn.Module):
         self.positional_encoding_type = positional_encoding_type
         self.do_regression = do_regression
         self.do_reconstruction = do_reconstruction
+        # image patches only attend to patches within locality_neighborhood and to the tokens after the image 
+        self.locality_mask = locality_mask
+        self.locality_neighborhood = locality_neighborhood
+        assert not locality_mask or locality_neighborhood >= 1, f"locality_neighborhood must be at least 1, not {locality_neighborhood}"
 
         num_patches = (image_size // patch_size) ** 2
         patch_dim = channels * patch_size ** 2
@@ -322,9 +481,9 @@ class TransformerEncoder(torch.nn.Module):
         self.sep_token = torch.nn.Parameter(torch.randn(1, 1, hidden_dim))
 
         # first half of stack is dedicated to joint modeling, 2nd half splits previous and next 
-        self.start_transformer = Transformer(hidden_dim, n_layers_shared, n_heads, ff_dim, dropout, init_scale, log_weights) 
-        self.prev_transformer = Transformer(hidden_dim, n_layers_split, n_heads, ff_dim, dropout, init_scale, log_weights) 
-        self.next_transformer = Transformer(hidden_dim, n_layers_split, n_heads, ff_dim, dropout, init_scale, log_weights) 
+        self.start_transformer = Transformer(hidden_dim, n_layers_shared, n_heads, ff_dim, dropout, init_scale, log_weights, attention_impl) 
+        self.prev_transformer = Transformer(hidden_dim, n_layers_split, n_heads, ff_dim, dropout, init_scale, log_weights, attention_impl) 
+        self.next_transformer = Transformer(hidden_dim, n_layers_split, n_heads, ff_dim, dropout, init_scale, log_weights, attention_impl) 
 
         self.dropout = torch.nn.Dropout(embed_dropout) 
         
@@ -380,37 +539,20 @@ class TransformerEncoder(torch.nn.Module):
                                                                     "pos_embedding" not in k and "patch_projection.weight" not in k} 
                 self.load_state_dict(new_state_dict, strict=False)
 
-    def get_lang_mask(self, lang): 
-        bsz = len(lang)
+    def get_lang_mask(self, lang, lengths = None): 
+        # False at <PAD>, computed from the command_lengths tensor of the batch when the dataset reader provides it 
         seq_len = len(lang[0])
-        mask = torch.ones((bsz, seq_len))
-        for i, seq in enumerate(lang):
-            for j, word in enumerate(seq):
-                if word == "<PAD>": 
-                    mask[i,j] = 0
-
-        return mask.bool().to(self.device) 
-
-    def get_neighbors(self, patch_idx, num_patches, neighborhood = 5): 
-        image_w = int(num_patches**(1/2))
-        patch_idxs = np.arange(num_patches).reshape(image_w, image_w)
-        patch_row = int(patch_idx / image_w) 
-        patch_col = patch_idx % image_w 
-
-        neighbor_idxs = patch_idxs[patch_row - neighborhood:patch_row + neighborhood, patch_col - neighborhood:patch_col + neighborhood]
-        neighbor_idxs = neighbor_idxs.reshape(-1)
-        return neighbor_idxs
-
-
-    def get_image_local_mask(self, num_patches, image_dim, neighborhood = 5): 
-        # make a mask so that each image patch can only attend to patches close to it 
-        mask = torch.zeros((bsz, num_patches, num_patches))
-        for i in range(num_patches):
-            neighbors = self.get_neighbors(i, num_patches, neighborhood)
-            mask[:,i,neighbors] = 1
-        return mask.bool().to(self.device)
-
-    def _prepare_input(self, image, language, mask = None):
+        if lengths is not None:
+            return torch.arange(seq_len, device = self.device).unsqueeze(0) < lengths.to(self.device).unsqueeze(1) 
+        mask = torch.tensor([[word != "<PAD>" for word in seq] for seq in lang], dtype = torch.bool)
+        return mask.to(self.device) 
+
+    def get_local_window(self, num_patches): 
+        if not self.locality_mask:
+            return None 
+        return (num_patches, self.locality_neighborhood) 
+
+    def _prepare_input(self, image, language, mask = None, command_ids = None):
         # patchify 
         p = self.patch_size 
         image_input = image_to_tiles(image, p).to(self.device) 
@@ -429,40 +571,30 @@ class TransformerEncoder(torch.nn.Module):
         model_input = self.patch_projection(image_input) 
 
         # project and positionally encode language 
-        language_input = torch.cat([self.language_embedder(x).unsqueeze(0) for x  in language], dim = 0) 
+        language_input = embed_batch(self.language_embedder, language, command_ids) 
         language_input = self.language_projection(language_input) 
 
         if self.long_command:
             self.cls_position = num_patches
+        num_tokens = language_input.shape[1]
+        hidden_dim = model_input.shape[-1]
         if self.positional_encoding_type == "learned":
             # add positional features to image patches 
             model_input += self.pos_embedding[:, :num_patches]
-            language_input = add_positional_features(language_input) 
-            # repeat [SEP] across batch 
-            sep_tokens = repeat(self.sep_token, '() n d -> b n d', b=batch_size)
-            # tack on [SEP]
-            model_input = torch.cat([model_input, sep_tokens], dim = 1)
-            # tack on language after [SEP]
-            model_input = torch.cat([model_input, language_input], dim = 1)
+            language_input = language_input + cached_positional_features(num_tokens, hidden_dim, language_input.device) 
+            # tack on [SEP] and language after it 
+            model_input = assemble_input([model_input, self.sep_token, language_input])
         elif self.positional_encoding_type == "fixed": 
-            # repeat [SEP] across batch 
-            sep_tokens = repeat(self.sep_token, '() n d -> b n d', b=batch_size)
-            # tack on [SEP]
-            model_input = torch.cat([model_input, sep_tokens], dim = 1)
-            # tack on language after [SEP]
-            model_input = torch.cat([model_input, language_input], dim = 1)
+            # tack on [SEP] and language after it 
+            model_input = assemble_input([model_input, self.sep_token, language_input])
             # add 1d positional to everying 
-            model_input = add_positional_features(model_input) 
+            model_input = model_input + cached_positional_features(model_input.shape[1], hidden_dim, model_input.device) 
         elif self.positional_encoding_type == "fixed-separate": 
             # add fixed pos encoding to language and image separately 
-            model_input = add_positional_features(model_input)
-            language_input = add_positional_features(language_input)
-            # repeat [SEP] across batch 
-            sep_tokens = repeat(self.sep_token, '() n d -> b n d', b=batch_size)
-            # tack on [SEP]
-            model_input = torch.cat([model_input, sep_tokens], dim = 1)
-            # tack on language after [SEP]
-            model_input = torch.cat([model_input, language_input], dim = 1)
+            model_input = model_input + cached_positional_features(num_patches, hidden_dim, model_input.device)
+            language_input = language_input + cached_positional_features(num_tokens, hidden_dim, language_input.device)
+            # tack on [SEP] and language after it 
+            model_input = assemble_input([model_input, self.sep_token, language_input])
         elif self.positional_encoding_type == "fixed-2d-separate":
              # add fixed pos encoding to language and image separately 
             pdb.set_trace() 
@@ -476,13 +608,9 @@ class TransformerEncoder(torch.nn.Module):
 
         elif self.positional_encoding_type == "fixed-img-only": 
             # add fixed pos encoding to image only since language has already from BERT 
-            model_input = add_positional_features(model_input)
-            # repeat [SEP] across batch 
-            sep_tokens = repeat(self.sep_token, '() n d -> b n d', b=batch_size)
-            # tack on [SEP]
-            model_input = torch.cat([model_input, sep_tokens], dim = 1)
-            # tack on language after [SEP]
-            model_input = torch.cat([model_input, language_input], dim = 1)
+            model_input = model_input + cached_positional_features(num_patches, hidden_dim, model_input.device)
+            # tack on [SEP] and language after it 
+            model_input = assemble_input([model_input, self.sep_token, language_input])
         else:
             raise AssertionError(f"invalid positional type {self.positional_encoding_type}")
 
@@ -492,12 +620,13 @@ class TransformerEncoder(torch.nn.Module):
         language = batch_instance['command']
         image = batch_instance['prev_pos_input']
       
-        language_mask = self.get_lang_mask(language) 
-        tfmr_input, mask, n_patches = self._prepare_input(image, language, language_mask) 
+        language_mask = self.get_lang_mask(language, batch_instance.get('command_lengths')) 
+        tfmr_input, mask, n_patches = self._prepare_input(image, language, language_mask, batch_instance.get('command_ids')) 
 
-        tfmr_output, __ = self.start_transformer(tfmr_input, mask) 
-        prev_output, prev_attn_out = self.prev_transformer(tfmr_output, mask) 
-        next_output, next_attn_out = self.next_transformer(tfmr_output, mask) 
+        local_window = self.get_local_window(n_patches) 
+        tfmr_output, __ = self.start_transformer(tfmr_input, mask, local_window = local_window) 
+        prev_output, prev_attn_out = self.prev_transformer(tfmr_output, mask, local_window = local_window) 
+        next_output, next_attn_out = self.next_transformer(tfmr_output, mask, local_window = local_window) 
 
         # trim off language 
         prev_just_image_output = prev_output[:, 0:n_patches, :]
@@ -559,7 +688,10 @@ class ResidualTransformerEncoder(TransformerEncoder):
                  log_weights: bool = False,
                  do_regression: bool = False,
                  do_reconstruction: bool = False,
-                 do_residual: bool = False):
+                 do_residual: bool = False,
+                 attention_impl: str = "sdpa",
+                 locality_mask: bool = False,
+                 locality_neighborhood: int = 5):
         super(ResidualTransformerEncoder, self).__init__(image_size = image_size,
                                                          patch_size = patch_size,
                                                          language_embedder=language_embedder,
@@ -578,16 +710,19 @@ class ResidualTransformerEncoder(TransformerEncoder):
                                                          device=device,
                                                          log_weights=log_weights,
                                                          do_regression=do_regression,
-                                                         do_reconstruction=do_reconstruction)
+                                                         do_reconstruction=do_reconstruction,
+                                                         attention_impl=attention_impl,
+                                                         locality_mask=locality_mask,
+                                                         locality_neighborhood=locality_neighborhood)
         self.do_residual = do_residual
         if self.do_residual:
-            self.next_transformer = Transformer(2*hidden_dim, n_layers_split, n_heads, ff_dim, dropout, init_scale, log_weights) 
+            self.next_transformer = Transformer(2*hidden_dim, n_layers_split, n_heads, ff_dim, dropout, init_scale, log_weights, attention_impl) 
             self.next_mlp_head = nn.Sequential(
                 nn.LayerNorm(2*hidden_dim),
                 nn.Linear(2*hidden_dim, self.output_dim)
             )
         else:
-            self.next_transformer = Transformer(hidden_dim, n_layers_split, n_heads, ff_dim, dropout, init_scale, log_weights) 
+            self.next_transformer = Transformer(hidden_dim, n_layers_split, n_heads, ff_dim, dropout, init_scale, log_weights, attention_impl) 
             self.next_mlp_head = nn.Sequential(
                 nn.LayerNorm(hidden_dim),
                 nn.Linear(hidden_dim, self.output_dim)
@@ -597,11 +732,12 @@ class ResidualTransformerEncoder(TransformerEncoder):
         language = batch_instance['command']
         image = batch_instance['prev_pos_input']
 
-        language_mask = self.get_lang_mask(language) 
-        tfmr_input, mask, n_patches = self._prepare_input(image, language, language_mask) 
+        language_mask = self.get_lang_mask(language, batch_instance.get('command_lengths')) 
+        tfmr_input, mask, n_patches = self._prepare_input(image, language, language_mask, batch_instance.get('command_ids')) 
 
-        tfmr_output, __ = self.start_transformer(tfmr_input, mask) 
-        prev_output, prev_attn_out = self.prev_transformer(tfmr_output, mask) 
+        local_window = self.get_local_window(n_patches) 
+        tfmr_output, __ = self.start_transformer(tfmr_input, mask, local_window = local_window) 
+        prev_output, prev_attn_out = self.prev_transformer(tfmr_output, mask, local_window = local_window) 
 
         if self.do_residual:
             # residually connect shared output with prev output 
@@ -610,7 +746,7 @@ class ResidualTransformerEncoder(TransformerEncoder):
             # only stream through prev_output 
             next_input = prev_output 
         # CHANGE FROM TransformerEncoder: connect from prev_output to next
-        next_output, next_attn_out = self.next_transformer(next_input, mask) 
+        next_output, next_attn_out = self.next_transformer(next_input, mask, local_window = local_window) 
 
         # trim off language 
         prev_just_image_output = prev_output[:, 0:n_patches, :]
@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+""" Append-only, chunked binary store for the per-iteration transition logs.
+
+    Every value of every log is one fixed size (log, row, col, value) record, appended to the current chunk file.
+    Later records override earlier ones with the same (log, row, col), and a length record marks how many rows
+    a log has, so rewriting an old row or shortening a log is also just an append. The chunks are read with
+    np.memmap and each log is assembled with vectorized numpy operations.
+
+    Convert an existing run from the text logs, or export text logs for other tools:
+
+        python transition_log.py logs/2020-01-01-00-00-00/transitions
+        python transition_log.py logs/2020-01-01-00-00-00/transitions --to_text
+"""
+import os
+import json
+import argparse
+from glob import glob
+import numpy as np
+
+TRANSITION_LOG_DIR = 'binary-log'
+
+
+class TransitionLog(object):
+    RECORD_DTYPE = np.dtype([('log', '<u4'), ('row', '<u4'), ('col', '<u4'), ('value', '<f8')])
+    # a record in this column holds the number of rows of the log
+    LENGTH_COL = np.iinfo(np.uint32).max
+
+    def __init__(self, directory, chunk_records=1 << 20):
+        """ Open the transition log stored in directory, creating it if it does not exist.
+
+        # Arguments
+
+            directory: the directory containing the chunk files, usually transitions/binary-log.
+            chunk_records: number of records per chunk file before a new chunk is started.
+        """
+        self.directory = directory
+        self.chunk_records = chunk_records
+        self.names_path = os.path.join(directory, 'names.json')
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.names = []
+        if os.path.exists(self.names_path):
+            with open(self.names_path) as f:
+                self.names = json.load(f)['names']
+        # the last values written for each log, used to only append what changed
+        self.written = {}
+        # rows of list logs replaced in place since the last write, see mark_changed()
+        self.changed_rows = {}
+        self.chunk_path_list = None
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, 'names.json'))
+
+    def __contains__(self, name):
+        return name in self.names
+
+    def chunk_paths(self):
+        return sorted(glob(os.path.join(self.directory, 'chunk-*.bin')))
+
+    def log_id(self, name):
+        if name not in self.names:
+            self.names.append(name)
+            # write the name list atomically, it is the only file that is ever rewritten
+            tmp_path = self.names_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'names': self.names}, f)
+            os.replace(tmp_path, self.names_path)
+        return self.names.index(name)
+
+    def append(self, name, rows, cols, values, length):
+        """ Append values at (rows, cols) of log name and set its number of rows to length.
+        """
+        records = np.empty(len(values) + 1, dtype=self.RECORD_DTYPE)
+        records['log'] = self.log_id(name)
+        records['row'][:-1] = rows
+        records['col'][:-1] = cols
+        records['value'][:-1] = values
+        records['row'][-1] = 0
+        records['col'][-1] = self.LENGTH_COL
+        records['value'][-1] = length
+
+        if self.chunk_path_list is None:
+            self.chunk_path_list = self.chunk_paths()
+        chunk_paths = self.chunk_path_list
+        start = 0
+        while start < len(records):
+            count = 0
+            if chunk_paths:
+                size = os.path.getsize(chunk_paths[-1])
+                if size % self.RECORD_DTYPE.itemsize:
+                    # drop a partially written record, e.g. if the program was killed mid write
+                    os.truncate(chunk_paths[-1], size - size % self.RECORD_DTYPE.itemsize)
+                count = size // self.RECORD_DTYPE.itemsize
+            if not chunk_paths or count >= self.chunk_records:
+                chunk_paths.append(os.path.join(self.directory, 'chunk-%06d.bin' % len(chunk_paths)))
+                count = 0
+            free = self.chunk_records - count
+            with open(chunk_paths[-1], 'ab') as f:
+                f.write(records[start:start + free].tobytes())
+            start += free
+
+    def mark_changed(self, name, row):
+        """ Mark a row of a list log that was replaced in place, so the next write() appends it again.
+        """
+        self.changed_rows.setdefault(name, set()).add(row)
+
+    def write(self, name, log):
+        """ Store the current contents of a log, a list of rows or an array like Logger.write_to_log() receives.
+
+        Only rows that are new or changed since the last write are appended. Lists are expected to only grow,
+        so when the same list is written again only the rows after those already written are appended, plus
+        rows passed to mark_changed(). Rows before the last written row are not compared, arrays, other lists
+        and lists whose last written row changed are compared in full.
+        """
+        previous = self.written.get(name)
+        if isinstance(log, list) and isinstance(previous, tuple) and previous[0] is log and name in self:
+            _, written_len, last_row = previous
+            if 0 < written_len <= len(log):
+                check_row = as_2d(log[written_len - 1:written_len])
+                if check_row.shape == last_row.shape and np.all((check_row == last_row) | (np.isnan(check_row) & np.isnan(last_row))):
+                    rows = sorted(row for row in self.changed_rows.pop(name, ()) if row < written_len - 1)
+                    rows += range(written_len, len(log))
+                    if rows:
+                        new_rows = as_2d([log[row] for row in rows])
+                        if new_rows.shape[1] == last_row.shape[1]:
+                            row_index, cols = np.nonzero(np.ones(new_rows.shape, dtype=bool))
+                            self.append(name, np.asarray(rows)[row_index], cols, new_rows[row_index, cols], len(log))
+                            self.written[name] = (log, len(log), as_2d(log[-1:]))
+                            return
+                    else:
+                        return
+        new_log = as_2d(log)
+        if previous is None or isinstance(previous, tuple):
+            previous = self.read(name) if name in self else np.zeros((0, new_log.shape[1]))
+        previous = as_2d(previous)
+        if previous.shape[1] != new_log.shape[1]:
+            # the number of columns changed, rewrite everything
+            previous = np.zeros((0, new_log.shape[1]))
+        overlap = min(len(previous), len(new_log))
+        changed = np.zeros(new_log.shape, dtype=bool)
+        changed[:overlap] = ~((previous[:overlap] == new_log[:overlap]) | (np.isnan(previous[:overlap]) & np.isnan(new_log[:overlap])))
+        changed[overlap:] = True
+        if changed.any() or len(new_log) != len(previous) or name not in self:
+            rows, cols = np.nonzero(changed)
+            self.append(name, rows, cols, new_log[rows, cols], len(new_log))
+        self.changed_rows.pop(name, None)
+        if isinstance(log, list):
+            # the rows written and a copy of the last one, to check the list was only appended to
+            self.written[name] = (log, len(log), as_2d(log[-1:]))
+        else:
+            self.written[name] = new_log.copy()
+
+    def records(self):
+        """ All records in the order they were written, memory mapped from the chunk files.
+        """
+        records = []
+        for chunk_path in self.chunk_paths():
+            # ignore a partially written record at the end of the file
+            count = os.path.getsize(chunk_path) // self.RECORD_DTYPE.itemsize
+            if count > 0:
+                records.append(np.memmap(chunk_path, dtype=self.RECORD_DTYPE, mode='r', shape=(count,)))
+        if not records:
+            return np.zeros(0, dtype=self.RECORD_DTYPE)
+        return np.concatenate(records) if len(records) > 1 else records[0]
+
+    def read(self, name, records=None):
+        """ Returns log name as a 2D float64 array of shape (rows, cols), or None if it was never written.
+        """
+        if name not in self:
+            return None
+        if records is None:
+            records = self.records()
+        records = records[records['log'] == self.names.index(name)]
+        is_length = records['col'] == self.LENGTH_COL
+        length = int(records['value'][is_length][-1]) if is_length.any() else 0
+        records = records[~is_length]
+        num_cols = int(records['col'].max()) + 1 if len(records) else 0
+        log = np.full((length, num_cols), np.nan)
+        # the last record written to each (row, col) wins
+        records = records[records['row'] < length][::-1]
+        flat_index = records['row'].astype(np.int64) * num_cols + records['col']
+        _, last = np.unique(flat_index, return_index=True)
+        log[records['row'][last], records['col'][last]] = records['value'][last]
+        return log
+
+    def read_all(self):
+        """ Returns a dict of every log name to its 2D float64 array.
+        """
+        records = self.records()
+        return {name: self.read(name, records) for name in self.names}
+
+
+def as_2d(log):
+    """ Convert a log to a 2D float64 array with the same layout as np.savetxt, 1D logs have one value per row.
+    """
+    log = np.asarray(log, dtype=np.float64)
+    if log.ndim < 2:
+        log = log.reshape(-1, 1)
+    return log
+
+
+def transition_log_directory(transitions_directory):
+    return os.path.join(transitions_directory, TRANSITION_LOG_DIR)
+
+
+def load_transition_log(transitions_directory, name, ndmin=0):
+    """ Load log name from the binary transition log if there is one, otherwise from the name.log.txt text file.
+
+    Returns None if the log does not exist. ndmin squeezes the result the same way np.loadtxt does.
+    """
+    log = None
+    log_directory = transition_log_directory(transitions_directory)
+    if TransitionLog.exists(log_directory):
+        log = TransitionLog(log_directory).read(name)
+    if log is None:
+        text_path = os.path.join(transitions_directory, '%s.log.txt' % name)
+        if not os.path.exists(text_path):
+            return None
+        return np.loadtxt(text_path, delimiter=' ', ndmin=ndmin)
+    if log.ndim > ndmin:
+        log = np.squeeze(log)
+    if log.ndim < ndmin:
+        log = np.atleast_1d(log) if ndmin == 1 else np.atleast_2d(log).T
+    return log
+
+
+def convert_text_logs(transitions_directory):
+    """ Convert every numeric name.log.txt file in transitions_directory into the binary transition log.
+    """
+    transition_log = TransitionLog(transition_log_directory(transitions_directory))
+    for text_path in sorted(glob(os.path.join(transitions_directory, '*.log.txt'))):
+        name = os.path.basename(text_path)[:-len('.log.txt')]
+        try:
+            log = np.loadtxt(text_path, delimiter=' ', ndmin=2)
+        except ValueError:
+            print('convert_text_logs(): skipping non numeric log ' + text_path)
+            continue
+        transition_log.write(name, log)
+        print('convert_text_logs(): converted ' + name + ' with shape ' + str(log.shape))
+    return transition_log
+
+
+def export_text_logs(transitions_directory):
+    """ Write every log in the binary transition log as a name.log.txt text file, for tools that read the text layout.
+    """
+    transition_log = TransitionLog(transition_log_directory(transitions_directory))
+    for name, log in transition_log.read_all().items():
+        np.savetxt(os.path.join(transitions_directory, '%s.log.txt' % name), log, delimiter=' ')
+        print('export_text_logs(): wrote ' + name + ' with shape ' + str(log.shape))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert between the text transition logs and the binary transition log.')
+    parser.add_argument('transitions_directory', help='the transitions directory of a logging session')
+    parser.add_argument('--to_text', dest='to_text', action='store_true', default=False, help='export the binary log as text logs instead of converting the text logs')
+    args = parser.parse_args()
+    if args.to_text:
+        export_text_logs(args.transitions_directory)
+    else:
+        convert_text_logs(args.transitions_directory)
@@ -10,6 +10,7 @@ import torch.nn.functional as F
 from image_encoder import FinalClassificationLayer
 from mlp import MLP 
 from language import SourceAttention 
+from language_embedders import embed_batch
 
 
 class BaseUNet(torch.nn.Module):
@@ -222,8 +223,7 @@ class UNetWithLanguage(BaseUNet):
         lengths = lengths.to(self.device) 
 
         # embed langauge 
-        lang_embedded = torch.cat([self.lang_embedder(lang_input[i]).unsqueeze(0) for i in range(len(lang_input))], 
-                                    dim=0)
+        lang_embedded = embed_batch(self.lang_embedder, lang_input, data_batch.get("command_ids"))
 
         # encode
         lang_output = self.lang_encoder(lang_embedded, lengths) 
@@ -349,8 +349,7 @@ class UNetWithBlocks(UNetWithLanguage):
         lengths = lengths.to(self.device) 
 
         # embed language 
-        lang_embedded = torch.cat([self.lang_embedder(lang_input[i]).unsqueeze(0) for i in range(len(lang_input))], 
-                                    dim=0)
+        lang_embedded = embed_batch(self.lang_embedder, lang_input, data_batch.get("command_ids"))
 
         # encode
         lang_output = self.lang_encoder(lang_embedded, lengths) 
@@ -510,8 +509,7 @@ class UNetWithAttention(BaseUNet):
         lengths = lengths.to(self.device) 
 
         # embed langauge 
-        lang_embedded = torch.cat([self.lang_embedder(lang_input[i]).unsqueeze(0) for i in range(len(lang_input))], 
-                                    dim=0)
+        lang_embedded = embed_batch(self.lang_embedder, lang_input, data_batch.get("command_ids"))
 
         # encode
         lang_output = self.lang_encoder(lang_embedded, lengths) 
@@ -676,8 +674,7 @@ class UNetForBERT(UNetWithAttention):
         lengths = lengths.to(self.device) 
 
         # embed langauge 
-        lang_embedded = torch.cat([self.lang_embedder(lang_input[i]).unsqueeze(0) for i in range(len(lang_input))], 
-                                    dim=0)
+        lang_embedded = embed_batch(self.lang_embedder, lang_input, data_batch.get("command_ids"))
 
         # already encoded with BERT! 
         lang_output = {"output": lang_embedded} 
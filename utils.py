@@ -1,5 +1,6 @@
 import struct
 import math
+import itertools
 import numpy as np
 import warnings
 import cv2
@@ -9,7 +10,6 @@ import os
 import json
 import yaml
 import torch
-from scipy.special import softmax
 import pathlib
 import matplotlib.pyplot as plt
 import pygame
@@ -22,7 +22,7 @@ from spacy.tokenizer import Tokenizer
 from encoders import LSTMEncoder
 from language_embedders import RandomEmbedder, GloveEmbedder, BERTEmbedder
 from unet_shared import SharedUNet
-from transformer import TransformerEncoder, tiles_to_image
+from transformer import TransformerEncoder
 from train_language_encoder import get_free_gpu, load_data, get_vocab, LanguageTrainer, FlatLanguageTrainer
 #except ImportError:
 #    print('Unable to import the language embedder, language trainer, or transformer encoder. This is OK if you are not using the language model.')
@@ -126,68 +126,109 @@ def get_heightmap(color_img, depth_img, cam_intrinsics, cam_pose, workspace_limi
     """ Note:
     Arg median_filter_pixels is used for the depth image.
     Arg color_median_filter_pixels is used for the color image.
+
+    Use a HeightmapProjector directly to reuse the camera geometry across calls.
+    """
+    projector = HeightmapProjector(cam_intrinsics, cam_pose, workspace_limits, heightmap_resolution)
+    return projector.project(color_img, depth_img, background_heightmap=background_heightmap,
+                             median_filter_pixels=median_filter_pixels, color_median_filter_pixels=color_median_filter_pixels)
+
+
+class HeightmapProjector(object):
+    """ Projects RGB-D images into orthographic top-down color and depth heightmaps, see get_heightmap().
+
+    The pixel grid and heightmap bins only depend on the camera and workspace, which are fixed for a session,
+    so they are computed once. Instead of sorting every point by z so the highest point is written last,
+    each heightmap cell takes the highest point with a scatter-max. The output matches the sorting version
+    exactly, except that when several points in a cell have exactly the same highest z the color now always
+    comes from the last of them in image order, where the unstable sort picked an arbitrary one.
     """
+    def __init__(self, cam_intrinsics, cam_pose, workspace_limits, heightmap_resolution):
+        self.cam_intrinsics = np.array(cam_intrinsics)
+        self.cam_pose = np.array(cam_pose)
+        self.workspace_limits = np.array(workspace_limits)
+        self.heightmap_resolution = heightmap_resolution
+        # Compute heightmap size
+        self.heightmap_size = np.round(((workspace_limits[1][1] - workspace_limits[1][0])/heightmap_resolution, (workspace_limits[0][1] - workspace_limits[0][0])/heightmap_resolution)).astype(int)
+        # pixel coordinates relative to the principal point, keyed by image (height, width)
+        self.pixel_offsets = {}
+
+    def matches(self, cam_intrinsics, cam_pose, workspace_limits, heightmap_resolution):
+        """ True if this projector was created with the same camera and workspace.
+        """
+        return (np.array_equal(self.cam_intrinsics, cam_intrinsics) and np.array_equal(self.cam_pose, cam_pose) and
+                np.array_equal(self.workspace_limits, workspace_limits) and self.heightmap_resolution == heightmap_resolution)
+
+    def get_pixel_offsets(self, im_h, im_w):
+        if (im_h, im_w) not in self.pixel_offsets:
+            pix_x, pix_y = np.meshgrid(np.linspace(0, im_w-1, im_w), np.linspace(0, im_h-1, im_h))
+            self.pixel_offsets[(im_h, im_w)] = (pix_x - self.cam_intrinsics[0][2], pix_y - self.cam_intrinsics[1][2])
+        return self.pixel_offsets[(im_h, im_w)]
 
-    if median_filter_pixels > 0:
-        depth_img = ndimage.median_filter(depth_img, size=median_filter_pixels)
-
-    # Compute heightmap size
-    heightmap_size = np.round(((workspace_limits[1][1] - workspace_limits[1][0])/heightmap_resolution, (workspace_limits[0][1] - workspace_limits[0][0])/heightmap_resolution)).astype(int)
-    depth_heightmap = np.zeros(heightmap_size)
-
-    # Get 3D point cloud from RGB-D images
-    surface_pts, color_pts = get_pointcloud(color_img, depth_img, cam_intrinsics)
-
-    # Transform 3D point cloud from camera coordinates to robot coordinates
-    surface_pts = np.transpose(np.dot(cam_pose[0:3,0:3],np.transpose(surface_pts)) + np.tile(cam_pose[0:3,3:],(1,surface_pts.shape[0])))
-
-    # Sort surface points by z value
-    sort_z_ind = np.argsort(surface_pts[:,2])
-    surface_pts = surface_pts[sort_z_ind]
-    color_pts = color_pts[sort_z_ind]
-
-    # Filter out surface points outside heightmap boundaries
-    heightmap_valid_ind = np.logical_and(np.logical_and(np.logical_and(np.logical_and(surface_pts[:,0] >= workspace_limits[0][0], surface_pts[:,0] < workspace_limits[0][1]), surface_pts[:,1] >= workspace_limits[1][0]), surface_pts[:,1] < workspace_limits[1][1]), surface_pts[:,2] < workspace_limits[2][1])
-    surface_pts = surface_pts[heightmap_valid_ind]
-    color_pts = color_pts[heightmap_valid_ind]
-
-    # Create orthographic top-down-view RGB-D depth heightmap
-    heightmap_pix_x = np.floor((surface_pts[:,0] - workspace_limits[0][0])/heightmap_resolution).astype(int)
-    heightmap_pix_y = np.floor((surface_pts[:,1] - workspace_limits[1][0])/heightmap_resolution).astype(int)
-    depth_heightmap[heightmap_pix_y,heightmap_pix_x] = surface_pts[:,2]
-    z_bottom = workspace_limits[2][0]
-    depth_heightmap = depth_heightmap - z_bottom
-    depth_heightmap[depth_heightmap < 0] = 0
-    if median_filter_pixels > 0:
-        depth_heightmap = ndimage.median_filter(depth_heightmap, size=median_filter_pixels)
-    depth_heightmap[depth_heightmap == -z_bottom] = np.nan
-    # subtract out the scene background heights, if available
-    if background_heightmap is not None:
-        depth_heightmap -= background_heightmap
-        min_z = np.nanmin(depth_heightmap)
-        if min_z < 0:
-            depth_heightmap = np.clip(depth_heightmap, 0, None)
-            if min_z < -0.005:
-                print('WARNING: get_heightmap() depth_heightmap contains negative heights with min ' + str(min_z) + ', '
-                    'saved depth heightmap png files may be invalid! '
-                    'See README.md for instructions to collect the depth heightmap again. '
-                    'Clipping the minimum to 0 for now.')
-
-    # Create orthographic top-down-view RGB-D color heightmaps
-    color_heightmap_r = np.zeros((heightmap_size[0], heightmap_size[1], 1), dtype=np.uint8)
-    color_heightmap_g = np.zeros((heightmap_size[0], heightmap_size[1], 1), dtype=np.uint8)
-    color_heightmap_b = np.zeros((heightmap_size[0], heightmap_size[1], 1), dtype=np.uint8)
-    color_heightmap_r[heightmap_pix_y,heightmap_pix_x] = color_pts[:,[0]]
-    color_heightmap_g[heightmap_pix_y,heightmap_pix_x] = color_pts[:,[1]]
-    color_heightmap_b[heightmap_pix_y,heightmap_pix_x] = color_pts[:,[2]]
-    if color_median_filter_pixels > 0:
-        color_heightmap_r = ndimage.median_filter(color_heightmap_r, size=color_median_filter_pixels)
-        color_heightmap_b = ndimage.median_filter(color_heightmap_b, size=color_median_filter_pixels)
-        color_heightmap_g = ndimage.median_filter(color_heightmap_g, size=color_median_filter_pixels)
-    color_heightmap = np.concatenate((color_heightmap_r, color_heightmap_g, color_heightmap_b), axis=2)
-
-
-    return color_heightmap, depth_heightmap
+    def project(self, color_img, depth_img, background_heightmap=None, median_filter_pixels=5, color_median_filter_pixels=5):
+        """ Returns the color_heightmap and depth_heightmap, with the same arguments and results as get_heightmap().
+        """
+        workspace_limits = self.workspace_limits
+        heightmap_resolution = self.heightmap_resolution
+        heightmap_size = self.heightmap_size
+        if median_filter_pixels > 0:
+            depth_img = ndimage.median_filter(depth_img, size=median_filter_pixels)
+
+        # Project depth into 3D point cloud in camera coordinates, laid out like get_pointcloud()
+        im_h, im_w = depth_img.shape[:2]
+        offset_x, offset_y = self.get_pixel_offsets(im_h, im_w)
+        cam_pts = np.empty((im_h * im_w, 3))
+        cam_pts[:, 0] = np.multiply(offset_x, depth_img/self.cam_intrinsics[0][0]).reshape(-1)
+        cam_pts[:, 1] = np.multiply(offset_y, depth_img/self.cam_intrinsics[1][1]).reshape(-1)
+        cam_pts[:, 2] = depth_img.reshape(-1)
+
+        # Transform 3D point cloud from camera coordinates to robot coordinates, one row per axis
+        surface_pts = np.dot(self.cam_pose[0:3, 0:3], np.transpose(cam_pts)) + self.cam_pose[0:3, 3:]
+
+        # Filter out surface points outside heightmap boundaries
+        valid_ind = np.nonzero((surface_pts[0] >= workspace_limits[0][0]) & (surface_pts[0] < workspace_limits[0][1]) &
+                               (surface_pts[1] >= workspace_limits[1][0]) & (surface_pts[1] < workspace_limits[1][1]) &
+                               (surface_pts[2] < workspace_limits[2][1]))[0]
+        surface_pts = surface_pts[:, valid_ind]
+
+        # Find the highest point in each heightmap cell with a scatter-max
+        heightmap_pix_x = np.floor((surface_pts[0] - workspace_limits[0][0])/heightmap_resolution).astype(int)
+        heightmap_pix_y = np.floor((surface_pts[1] - workspace_limits[1][0])/heightmap_resolution).astype(int)
+        cell = heightmap_pix_y * heightmap_size[1] + heightmap_pix_x
+        max_z = np.full(heightmap_size[0] * heightmap_size[1], -np.inf)
+        np.maximum.at(max_z, cell, surface_pts[2])
+        # points in image order that are the highest in their cell, the last one written wins on exact ties
+        top_ind = np.nonzero(surface_pts[2] == max_z[cell])[0]
+        top_cell = cell[top_ind]
+
+        # Create orthographic top-down-view RGB-D depth heightmap
+        depth_heightmap = np.zeros(heightmap_size)
+        depth_heightmap.reshape(-1)[top_cell] = surface_pts[2, top_ind]
+        z_bottom = workspace_limits[2][0]
+        depth_heightmap = depth_heightmap - z_bottom
+        depth_heightmap[depth_heightmap < 0] = 0
+        if median_filter_pixels > 0:
+            depth_heightmap = ndimage.median_filter(depth_heightmap, size=median_filter_pixels)
+        depth_heightmap[depth_heightmap == -z_bottom] = np.nan
+        # subtract out the scene background heights, if available
+        if background_heightmap is not None:
+            depth_heightmap -= background_heightmap
+            min_z = np.nanmin(depth_heightmap)
+            if min_z < 0:
+                depth_heightmap = np.clip(depth_heightmap, 0, None)
+                if min_z < -0.005:
+                    print('WARNING: get_heightmap() depth_heightmap contains negative heights with min ' + str(min_z) + ', '
+                        'saved depth heightmap png files may be invalid! '
+                        'See README.md for instructions to collect the depth heightmap again. '
+                        'Clipping the minimum to 0 for now.')
+
+        # Create orthographic top-down-view RGB-D color heightmap, all channels are filtered in one call
+        color_heightmap = np.zeros((heightmap_size[0], heightmap_size[1], 3), dtype=np.uint8)
+        color_heightmap.reshape(-1, 3)[top_cell] = color_img.reshape(-1, 3)[valid_ind[top_ind]]
+        if color_median_filter_pixels > 0:
+            color_heightmap = ndimage.median_filter(color_heightmap, size=(color_median_filter_pixels, color_median_filter_pixels, 1))
+
+        return color_heightmap, depth_heightmap
 
 def common_sense_action_failure_heuristic(heightmap, heightmap_resolution=0.002, gripper_width=0.06, min_contact_height=0.02, push_length=0.0, z_buffer=0.01):
     """ Get heuristic scores for the grasp Q value at various pixels. 0 means our model confidently indicates no progress will be made, 1 means progress may be possible.
@@ -255,6 +296,56 @@ def common_sense_action_space_mask(depth_heightmap, push_predictions=None, grasp
     return push_predictions, grasp_predictions, place_predictions
 
 
+def language_position_probs(language_data, new_w, tile_size = 4, from_transformer = True):
+    """
+    Converts language model position logits into a (new_w, new_w) tensor of yes probabilities on the same device.
+
+    language_data: transformer output with shape [1, num_tiles, 2, 1], or a per pixel output with shape [1, 2, h, w]
+    """
+    if from_transformer:
+        # each tile is a tile_size x tile_size square of the image, in row major order
+        probs = torch.softmax(language_data.squeeze(-1), dim = 2)[0, :, 1]
+        tiles_per_row = int(math.sqrt(probs.shape[0]))
+        probs = probs.reshape(tiles_per_row, tiles_per_row)
+        probs = probs.repeat_interleave(tile_size, dim = 0).repeat_interleave(tile_size, dim = 1)
+    else:
+        probs = torch.softmax(language_data, dim = 1)[0, 1]
+    # nearest neighbor resize with the same source pixels as cv2.INTER_NEAREST
+    src_w = probs.shape[0]
+    idxs = torch.floor(torch.arange(new_w, dtype = torch.float64) * (1.0 / (new_w / src_w))).long().clamp(max = src_w - 1).to(probs.device)
+    return probs.float()[idxs][:, idxs]
+
+def language_action_masks(language_data, curr_masks, single_max, threshold = 0.1, tile_size = 4, from_transformer = True, block_width = 16):
+    """
+    Language masks of several actions in one batched pass on the device of the language model output.
+
+    language_data: list of position logits, see language_position_probs()
+    curr_masks: list of (height, width) common sense masks of the actions, 1 where the action is masked
+    single_max: list of bools, True to keep only the block under the most likely pixel, otherwise
+        every block touching a pixel with probability above threshold
+    returns a (num_actions, height, width) bool array, True where the action is masked
+    """
+    with torch.no_grad():
+        device = language_data[0].device
+        new_w = curr_masks[0].shape[1]
+        probs = torch.stack([language_position_probs(data, new_w, tile_size, from_transformer) for data in language_data])
+        # unmasked pixels are the blocks
+        block_pixels = torch.from_numpy(np.logical_not(np.stack(curr_masks))).to(device)
+        num_masks, height, width = probs.shape
+
+        # most likely block pixel, the first maximum in column major order
+        block_probs = (probs * block_pixels).transpose(1, 2).reshape(num_masks, -1)
+        max_idxs = torch.argmax(block_probs, dim = 1)
+        max_pixel = torch.zeros((num_masks, width * height), dtype = torch.bool, device = device)
+        max_pixel[torch.arange(num_masks, device = device), max_idxs] = True
+        max_pixel = max_pixel.reshape(num_masks, width, height).transpose(1, 2)
+
+        single_max = torch.tensor(single_max, dtype = torch.bool, device = device).reshape(-1, 1, 1)
+        seeds = torch.where(single_max, max_pixel, probs > threshold)
+        # expand out: if any pixel of a block is yes under language mask, then whole block is yes
+        infected = infect_masks(seeds & block_pixels, block_pixels, block_width)
+    return torch.logical_not(infected).cpu().numpy()
+
 def process_prediction_language_masking(language_data, predictions, show_heightmap=False, color_heightmap=None, tile_size = 4, threshold = 0.9, single_max = True, abs_threshold = 0.10, from_transformer = True, baseline_language_mask = False):
     """
     Adds a language mask to the predictions array.
@@ -270,152 +361,80 @@ def process_prediction_language_masking(language_data, predictions, show_heightm
         else:
             raise TypeError("predictions passed into the process_prediction_language_masking function should be np.ma.masked_array or np.ndarray objects.")
 
-    # Extract current masks
-    curr_mask = np.ma.getmask(predictions).copy()
-
-    # Peform data processing on the language model output to convert float values to logits
-    # NOTE(zhe) should the function be more generic and take in a reformatted list?
-    # language_data should have shape torch([1, 256, 2, 1])
-    if from_transformer:
-        language_data = tiles_to_image(language_data, tile_size = tile_size, output_type="per-patch")
-
-    language_data = softmax(language_data, axis = 1)
-    # take prob yes
-    language_mask = language_data[:,1,:,:]
-    language_mask = np.float32(language_mask).reshape(64,64, 1).copy()
-    new_w = curr_mask.shape[1]
-    if single_max:
-        language_mask_before = language_mask.copy()
-        # mask out non-blocks
-        language_mask = cv2.resize(language_mask, (new_w, new_w), interpolation=cv2.INTER_NEAREST)
-
-        language_mask *= 1 - curr_mask[0,:,:]
-        language_mask = torch.tensor(language_mask)
-        # get max pixel
-        row_values, row_indices = torch.max(language_mask, axis=0)
-        col_values, col_idx = torch.max(row_values, dim=0)
-        row_idx = row_indices[col_idx]
-        threshold = None
-        # abs_threshold = 0.10
-        language_mask *= 0
-        language_mask[row_idx, col_idx] = 1
-        language_mask[language_mask != 1] = 0
-        language_mask = language_mask.detach().cpu().numpy()
-    else:
-        language_mask_before = language_mask.copy()
-        # mask out non-blocks
-        language_mask = cv2.resize(language_mask, (new_w, new_w), interpolation=cv2.INTER_NEAREST)
-        language_mask[language_mask > threshold] = 1
-        language_mask[language_mask <= threshold] = 0
-
-    if threshold is not None:
-
-        language_mask[language_mask > threshold] = 1
-        language_mask[language_mask <= threshold] = 0
-
-    # largest_four = np.argpartition(language_mask_before, -64, axis=None)[-64:]
-    # largest_four_values = language_mask_before.reshape(-1)[largest_four]
-    # threshold = np.min(largest_four_values) - 0.00001
-    # language_mask_before[language_mask_before >= threshold] = 1
-    # language_mask_before[language_mask_before < threshold] = 0
-
-    # TODO(zhe) Should we erode/dilate the mask array? The current mask lets the whole block pass. We may want to increase or decrease the mask area.
-    # Scale language masks to match the prediction array sizes
-
-    language_mask = cv2.resize(language_mask, (new_w, new_w), interpolation=cv2.INTER_NEAREST)
-    language_mask = np.broadcast_to(language_mask, predictions.shape, subok=True)
-    language_mask_before = cv2.resize(language_mask_before, (new_w, new_w), interpolation=cv2.INTER_NEAREST)
-
-    # Catching errors
-    assert language_mask.shape == curr_mask.shape and language_mask.shape == predictions.shape, print("ERROR: Shape missmatch in language masking")
+    # the random baseline keeps only the existing masks
+    if baseline_language_mask:
+        return predictions
 
-    # Combine language mask with existing masks if necessary
-    if curr_mask is np.ma.nomask:
-        predictions.mask = language_mask
-    else:
-        # TODO (elias) why not just multiply probs in with the mask
-        if (threshold is not None or single_max) and not baseline_language_mask:
-            # intersection_mask = 1 - np.logical_and(1 - curr_mask,  language_mask)
-            # expand out: if any pixel of a block is yes under language mask, then whole block is yes
-            predictions.mask = infect_mask(language_mask.astype(bool), curr_mask.copy().astype(bool))
+    curr_mask = np.ma.getmaskarray(predictions)
+    language_mask = language_action_masks([language_data], [curr_mask[0]], [single_max], threshold = threshold, tile_size = tile_size, from_transformer = from_transformer)[0]
+    predictions = np.ma.masked_array(predictions.data, np.broadcast_to(language_mask, predictions.shape))
 
     if show_heightmap:
         # visualize the common sense function results
         # show the heightmap
-        fig, ax = plt.subplots(2,3)
-        ax[0,0].imshow(curr_mask[0,:,:])
-        ax[0,1].imshow(1 - language_mask_before)
-        ax[0,2].imshow(predictions.mask[0,:,:])
-        # ax[1,0].imshow((curr_mask[0,:,:] + 1 - language_mask[0,:,:])/2)
-        ax[1,0].imshow((curr_mask[0,:,:] + 1 - language_mask_before)/2)
-
+        fig, ax = plt.subplots(1,3)
+        ax[0].imshow(curr_mask[0,:,:])
+        ax[1].imshow(predictions.mask[0,:,:])
         if color_heightmap is not None:
-            ax[1,1].imshow(color_heightmap)
+            ax[2].imshow(color_heightmap)
 
         plt.show(block=True)
     return predictions
 
-def infect_mask(language_mask, curr_mask, block_width = 16):
-    # expand out from intersection: if any pixel of a block is yes under language mask, then whole block should be yes
-    curr_mask = 1 - curr_mask
-    intersection_mask = np.logical_and(curr_mask,  language_mask).astype(float)
-    # use inf as sentinel value
-    orig_intersection_mask = intersection_mask.copy()
-    intersection_mask *= 1000
-    # top-down, left to right across mask
-    language_mask = language_mask[0]
-    curr_mask = curr_mask[0]
-    intersection_mask = intersection_mask[0]
-    curr_mask[intersection_mask == 1000] = 1000
-
-    def get_neighbors(idxs):
-        neighbors = []
-        for (x,y) in idxs:
-            neighbors.append((x-1, y))
-            neighbors.append((x+1, y))
-            neighbors.append((x, y-1))
-            neighbors.append((x, y+1))
-            neighbors.append((x-1, y-1))
-            neighbors.append((x+1, y+1))
-            neighbors.append((x-1, y+1))
-            neighbors.append((x-1, y+1))
-        return neighbors
-
-    total_infected = 0
-    total_it = 0
+# pixel offsets a block pixel infects in one infect_masks() step, the original neighbor list skipped (x+1, y-1)
+INFECT_MASK_OFFSETS = [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (1, 1), (-1, 1)]
+
+def infect_masks(seeds, block_pixels, block_width = 16):
+    """ Grow a (num_masks, height, width) bool tensor of seed pixels into the blocks they touch.
+
+    Each mask grows one pixel per step through block_pixels, for at most 2*block_width steps or until
+    it covers (2*block_width)**2 pixels.
+    """
+    # pixels further than 2*block_width steps from every seed can not be reached, only grow inside their bounding box
     max_it = block_width * 2
-    # for it in range(block_width * 2):
-    while total_infected < (2*block_width)**2 and total_it < max_it:
-        # get selected indices
-
-        curr_idxs = np.where(curr_mask == 1000)
-        curr_idxs = list(zip(curr_idxs[0], curr_idxs[1]))
-        total_infected = len(curr_idxs)
-        # look one pix in each direction
-        neighbors = get_neighbors(curr_idxs)
-        done = []
-        for x,y in neighbors:
-            try:
-                if curr_mask[x,y] == 1000:
-                    continue
-                if curr_mask[x,y] == 1:
-                    curr_mask[x,y] = 1000
-                else:
-                    # if you hit a zero, that's the border
-                    continue
-            except IndexError:
-                continue
-        total_it += 1
+    seed_rows = torch.nonzero(seeds.any(dim = 2).any(dim = 0))
+    seed_cols = torch.nonzero(seeds.any(dim = 1).any(dim = 0))
+    if len(seed_rows) == 0:
+        return seeds.clone()
+    num_masks, height, width = seeds.shape
+    top, bottom = max(int(seed_rows[0]) - max_it, 0), min(int(seed_rows[-1]) + max_it + 1, height)
+    left, right = max(int(seed_cols[0]) - max_it, 0), min(int(seed_cols[-1]) + max_it + 1, width)
+    infected = seeds[:, top:bottom, left:right].clone()
+    block_window = block_pixels[:, top:bottom, left:right]
+    height, width = bottom - top, right - left
+
+    active = torch.ones(num_masks, dtype = torch.bool, device = seeds.device)
+    total_infected = torch.zeros(num_masks, dtype = torch.long, device = seeds.device)
+    for it in range(max_it):
+        active &= total_infected < (2 * block_width) ** 2
+        if not active.any():
+            break
+        total_infected = infected.sum(dim = (1, 2))
+        grown = infected.clone()
+        for dx, dy in INFECT_MASK_OFFSETS:
+            grown[:, max(dx, 0):height + min(dx, 0), max(dy, 0):width + min(dy, 0)] |= \
+                infected[:, max(-dx, 0):height + min(-dx, 0), max(-dy, 0):width + min(-dy, 0)]
+        grown &= block_window
+        # masks whose touched blocks are filled stop growing
+        active &= (grown != infected).flatten(1).any(dim = 1)
+        infected = torch.where(active.reshape(-1, 1, 1), grown, infected)
+
+    output = torch.zeros_like(seeds)
+    output[:, top:bottom, left:right] = infected
+    return output
+
+def infect_mask(language_mask, curr_mask, block_width = 16):
+    """ Expand out from the intersection of the language mask and the blocks: if any pixel of a block is yes
+    under the language mask, then the whole block should be yes.
 
-    curr_mask[curr_mask < 1000] = 0
-    curr_mask[curr_mask == 1000] = 1
-    curr_mask = curr_mask.astype(bool).reshape(1, 224, 224)
-    curr_mask = np.tile(curr_mask, (16, 1, 1))
-    # fig, ax = plt.subplots(1,2)
-    # ax[0].imshow(orig_intersection_mask[0,:,:])
-    # ax[1].imshow(curr_mask[0,:,:])
-    # plt.show(block=True)
-    return 1 - curr_mask
+    The masks have shape (num_rotations, height, width) and only the first rotation is used, see infect_masks().
+    Returns the new mask with the same shape, 1 where actions are masked.
+    """
+    # unmasked pixels are the blocks
+    block_pixels = torch.from_numpy(np.logical_not(curr_mask[0]))[None]
+    seeds = torch.from_numpy(np.logical_and(language_mask[0], np.logical_not(curr_mask[0])))[None]
+    infected = infect_masks(seeds, block_pixels, block_width)[0].numpy()
+    return np.tile(np.logical_not(infected).astype(int), (curr_mask.shape[0], 1, 1))
 
 
 # TODO(zhe) implement language model masking using language model output. The inputs should already be np.masked_arrays
@@ -429,7 +448,6 @@ def common_sense_language_model_mask(language_output, push_predictions=None, gra
     #push_predictions = 1 - push_predictions * np.inf
     push_predictions = np.ones_like(push_predictions) * -np.inf
 
-    #push_predictions = process_prediction_language_masking(language_output['prev_position'], push_predictions, color_heightmap=color_heightmap, threshold = 0.6)
     from_transformer = True 
     if type(language_output) == tuple: 
         next_pos, prev_pos = language_output
@@ -439,14 +457,23 @@ def common_sense_language_model_mask(language_output, push_predictions=None, gra
     else:
         prev_pos, next_pos = language_output['prev_position'], language_output['next_position']
 
+    predictions = []
+    for action_predictions in [grasp_predictions, place_predictions]:
+        if not isinstance(action_predictions, np.ma.MaskedArray):
+            action_predictions = np.ma.masked_array(action_predictions, mask=False)
+        predictions.append(action_predictions)
+    grasp_predictions, place_predictions = predictions
+
     if baseline_language_mask:
+        # the random baseline keeps only the existing masks
         print(f"RUNNING RANDOM BASELINE FOR LANGUAGE")
-        prev_pos = torch.ones(prev_pos.shape).to(prev_pos.device)
-        next_pos = torch.ones(next_pos.shape).to(next_pos.device)
-
-    grasp_predictions = process_prediction_language_masking(prev_pos, grasp_predictions, color_heightmap=color_heightmap, threshold = 0.1, abs_threshold = 0.03, from_transformer = from_transformer, baseline_language_mask=baseline_language_mask)
-    place_predictions = process_prediction_language_masking(next_pos, place_predictions, color_heightmap=color_heightmap, threshold = 0.1, abs_threshold = 0.10, single_max = not check_row, from_transformer = from_transformer, baseline_language_mask=baseline_language_mask)
+        return push_predictions, grasp_predictions, place_predictions
 
+    # grasp the most likely block, place on the most likely block or anywhere likely when building rows
+    curr_masks = [np.ma.getmaskarray(grasp_predictions)[0], np.ma.getmaskarray(place_predictions)[0]]
+    grasp_mask, place_mask = language_action_masks([prev_pos, next_pos], curr_masks, [True, not check_row], threshold = 0.1, from_transformer = from_transformer)
+    grasp_predictions = np.ma.masked_array(grasp_predictions.data, np.broadcast_to(grasp_mask, grasp_predictions.shape))
+    place_predictions = np.ma.masked_array(place_predictions.data, np.broadcast_to(place_mask, place_predictions.shape))
 
     return push_predictions, grasp_predictions, place_predictions
 
@@ -489,7 +516,7 @@ def load_language_model_from_config(configYamlPath, weightsPath):
     elif config['embedder'] == "glove":
         embedder = GloveEmbedder(tokenizer, train_vocab, config["embedding_file"], config["embedding_dim"], trainable=True)
     elif config['embedder'].startswith("bert"):
-        embedder = BERTEmbedder(model_name = config["embedder"],  max_seq_len = config["max_seq_length"])
+        embedder = BERTEmbedder(model_name = config["embedder"],  max_seq_len = config["max_seq_length"], cache_dir = config.get("bert_cache_dir"))
     else:
         raise NotImplementedError(f'No embedder {config["embedder"]}')
 
@@ -511,14 +538,17 @@ def load_language_model_from_config(configYamlPath, weightsPath):
                                     positional_encoding_type = config["pos_encoding_type"],
                                     # device = device,
                                     log_weights = config["test"],
-                                    do_reconstruction = config['do_reconstruction'])
+                                    do_reconstruction = config['do_reconstruction'],
+                                    attention_impl = config.get("attention_impl", "sdpa"),
+                                    locality_mask = config.get("locality_mask", False),
+                                    locality_neighborhood = config.get("locality_neighborhood", 5))
     else:
         if config['embedder'] == "random":
             embedder = RandomEmbedder(tokenizer, train_vocab, config['embedding_dim'], trainable=True)
         elif config['embedder'] == "glove":
             embedder = GloveEmbedder(tokenizer, train_vocab, config['embedding_file'], config['embedding_dim'], trainable=True) 
         elif config['embedder'].startswith("bert"): 
-            embedder = BERTEmbedder(model_name = config['embedder'],  max_seq_len = config['max_seq_length']) 
+            embedder = BERTEmbedder(model_name = config['embedder'],  max_seq_len = config['max_seq_length'], cache_dir = config.get('bert_cache_dir')) 
         else:
             raise NotImplementedError(f"No embedder {config['embedder']}") 
         # get the encoder from args  
@@ -1000,6 +1030,150 @@ def polyfit(*args, **kwargs):
         out = np.polyfit(*args, **kwargs)
     return out
 
+
+def polyfit_lines(xs, ys):
+    """Batched polyfit(x, y, 1) over the rows of xs and ys.
+
+    Uses the same column scaling and singular value cutoff as np.polyfit, so rank deficient rows
+    (e.g. all xs equal) get the same minimum norm fit instead of a division by zero.
+
+    :param xs: (num_lines, num_points) x values
+    :param ys: (num_lines, num_points) y values
+    :returns: slopes, intercepts, each (num_lines,)
+    """
+    lhs = np.stack([xs, np.ones_like(xs)], axis=-1)
+    scale = np.sqrt((lhs * lhs).sum(axis=1, keepdims=True))
+    # np.polyfit fails outright when every x is 0, fit y = b there instead
+    scale[scale == 0] = 1.0
+    lhs = lhs / scale
+    rcond = xs.shape[1] * np.finfo(lhs.dtype).eps
+    coefficients = np.matmul(np.linalg.pinv(lhs, rcond=rcond), ys[..., None])[..., 0] / scale[:, 0]
+    return coefficients[:, 0], coefficients[:, 1]
+
+
+def check_separations(values, distance_threshold, small_distance_threshold = 0.05):
+    """Batched check_separation() over the rows of values, where an unsorted row fails instead of raising.
+
+    :param values: (num_rows, num_values) array of values, each row expected to be sorted from low to high
+    :returns: (num_rows,) bool array of successes
+    """
+    x, y = values[:, :-1], values[:, 1:]
+    # written as negations of the check_separation() failure conditions so nan values fail the same way
+    separated = (x < y) & ~(y < x + small_distance_threshold / 2.) & ~(np.abs(y - x) > distance_threshold)
+    return separated.all(axis=1)
+
+
+def permutation_chunks(num_obj, length, chunk_size=4096, first_chunk_size=16):
+    """Yield the itertools.permutations(range(num_obj), length) as (n, length) int arrays, in the same order.
+
+    The chunks start with first_chunk_size permutations and double up to chunk_size, so a search that
+    stops early only builds a few small chunks while a full search still runs in large ones.
+    """
+    permutations = itertools.permutations(range(num_obj), length)
+    size = min(first_chunk_size, chunk_size)
+    while True:
+        chunk = list(itertools.islice(permutations, size))
+        if len(chunk) == 0:
+            return
+        yield np.array(chunk, dtype=int).reshape(len(chunk), length)
+        size = min(2 * size, chunk_size)
+
+
+def check_rows(pos, block_indices, distance_threshold, separation_threshold, sort_by_x=True):
+    """Check many candidate rows of blocks at once.
+
+    Each candidate is rotated so its x, y line of best fit is the x axis, like Robot.check_specific_blocks_for_row().
+    A candidate is a row if every block is within distance_threshold of the line and of the median height,
+    and the blocks along the line pass check_separation().
+
+    # Arguments
+
+        pos: (num_obj, 3) array of block positions.
+        block_indices: (num_candidates, row_length) array of indices into pos.
+        sort_by_x: sort the blocks along the line before checking separation, otherwise they must already be in order.
+
+    # Returns
+
+        (num_candidates,) bool array, True where the candidate is a row.
+    """
+    block_pos = pos[block_indices]
+    slopes, intercepts = polyfit_lines(block_pos[:, :, 0], block_pos[:, :, 1])
+    theta = np.arctan(slopes)[:, None]
+    c, s = np.cos(theta), np.sin(theta)
+    x, y, z = block_pos[:, :, 0], block_pos[:, :, 1] - intercepts[:, None], block_pos[:, :, 2]
+    # aligned_x runs along the line of best fit, so aligned_y should be small
+    aligned_x = c * x + s * y
+    aligned_y = -s * x + c * y
+    median_z = np.median(z, axis=1, keepdims=True)
+    off_row = (np.abs(aligned_y) > distance_threshold) | (np.abs(z - median_z) > distance_threshold)
+    aligned = ~off_row.any(axis=1)
+    if sort_by_x:
+        aligned_x = np.sort(aligned_x, axis=1)
+    return aligned & check_separations(aligned_x, separation_threshold)
+
+
+def find_row(pos, row_length, distance_threshold, separation_threshold, num_obj=None,
+             color_names=None, object_color_sequence=None, sort_by_x=True, chunk_size=4096):
+    """Find the first ordered subset of blocks, in itertools.permutations order, that forms a row.
+
+    # Arguments
+
+        pos: (num_obj, 3) array of block positions.
+        row_length: number of blocks in the row.
+        num_obj: only blocks 0 to num_obj-1 are considered, all of them if None.
+        color_names: names of each block's color. If set, the row's colors must match those of
+            object_color_sequence read forwards or backwards.
+        chunk_size: the most permutations checked at once, which bounds memory for many blocks.
+            The first chunks are smaller so a row found early returns quickly, see permutation_chunks().
+
+    # Returns
+
+        (success, row_size, block_indices), where row_size is row_length on success and 1 otherwise,
+        and block_indices is the list of indices of the row or [] if there isn't one.
+    """
+    pos = np.asarray(pos, dtype=float)
+    if num_obj is None:
+        num_obj = len(pos)
+    if color_names is not None:
+        color_names = np.asarray(color_names)
+        expected_colors = color_names[np.asarray(object_color_sequence[0:row_length], dtype=int)]
+    for block_indices in permutation_chunks(num_obj, row_length, chunk_size):
+        found = check_rows(pos, block_indices, distance_threshold, separation_threshold, sort_by_x=sort_by_x)
+        if color_names is not None:
+            min_len = len(expected_colors)
+            forward = (color_names[block_indices[:, 0:min_len]] == expected_colors).all(axis=1)
+            backward = (color_names[block_indices[:, ::-1][:, 0:min_len]] == expected_colors).all(axis=1)
+            found &= forward | backward
+        if found.any():
+            return True, row_length, [int(i) for i in block_indices[np.argmax(found)]]
+    return False, 1, []
+
+
+def check_stack_sequences(pos, sequences, checks, vert_distance_threshold):
+    """Check candidate stack orders at once, like the sequence loop of Robot.check_stack().
+
+    Each consecutive pair of blocks in the first checks+1 blocks of a sequence must be stacked:
+    the top block at least half of vert_distance_threshold higher and within vert_distance_threshold of the bottom.
+
+    # Returns
+
+        (working_seq_found, max_height), where max_height is the largest failed check index plus one
+        over the sequences up to and including the first one that works.
+    """
+    if len(sequences) == 0 or checks <= 0:
+        return True, 0
+    pos = np.asarray(pos, dtype=float)
+    sequences = np.asarray(sequences, dtype=int).reshape(len(sequences), -1)
+    bottom_pos = pos[sequences[:, 0:checks]]
+    top_pos = pos[sequences[:, 1:checks + 1]]
+    too_low = top_pos[:, :, 2] < (bottom_pos[:, :, 2] + vert_distance_threshold / 2.0)
+    too_far = np.linalg.norm(bottom_pos - top_pos, axis=-1) > vert_distance_threshold
+    failed = too_low | too_far
+    working = ~failed.any(axis=1)
+    last_checked = np.argmax(working) if working.any() else len(sequences) - 1
+    failed_heights = np.where(failed[0:last_checked + 1], np.arange(1, checks + 1), 0)
+    return bool(working.any()), int(failed_heights.max())
+
 def is_jsonable(x):
     try:
         json.dumps(x)
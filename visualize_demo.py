@@ -3,6 +3,7 @@ import os
 import argparse
 import numpy as np
 from utils import get_prediction_vis
+from transition_log import load_transition_log
 
 if __name__ == '__main__':
     # parse arguments
@@ -11,7 +12,7 @@ if __name__ == '__main__':
     args = parser.parse_args()
 
     # load executed actions
-    action_log = np.loadtxt(os.path.join(args.demo_dir, 'transitions', 'executed-actions-0.log.txt'))
+    action_log = load_transition_log(os.path.join(args.demo_dir, 'transitions'), 'executed-actions-0')
 
     # get all heightmap paths
     heightmap_paths = os.listdir(os.path.join(args.demo_dir, 'data', 'depth-heightmaps'))